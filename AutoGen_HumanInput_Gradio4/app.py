@@ -1,5 +1,4 @@
 import os
-import sys
 import threading
 from itertools import chain
 import anyio
@@ -10,9 +9,10 @@ from autogen.code_utils import extract_code
 from gradio import ChatInterface, Request
 from gradio.helpers import special_args
 from modules import llm
+from modules.cancellation import CancelToken, install_checkpoints
 from modules.db import SQLManager
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.orm import sessionmaker
+from modules.session_store import SessionStore
+from modules.tracing import instrument_agents, tracer
 
 from dotenv import load_dotenv  
 
@@ -20,6 +20,11 @@ load_dotenv()
 
 LOG_LEVEL = "INFO"
 TIMEOUT = 60
+# how long a timed-out chat gets to reach its next checkpoint before the agents are handed to the next message
+CANCEL_GRACE = 5
+# agents of a browser session are kept this long after its last message, and for this many sessions at most
+SESSION_IDLE_SECONDS = int(os.environ.get("SESSION_IDLE_SECONDS", 30 * 60))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 100))
 
 # Variabes
 DB_URL = os.environ.get("DATABASE_URL")
@@ -33,14 +38,11 @@ print(DB_URL)
 
 
 #Integrating SQL Databases Start
-# SQLAlchemy setup
-engine = create_engine(DB_URL)
-Session = sessionmaker(bind=engine)
-
 # Constants
 POSTGRES_TABLE_DEFINITIONS_CAP_REF = "TABLE_DEFINITIONS"
 RESPONSE_FORMAT_CAP_REF = "RESPONSE_FORMAT"
 SQL_DELIMITER = "---------"
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
 
 #Integrating SQL Databases End
 
@@ -67,12 +69,15 @@ with SQLManager() as db:
     db.connect_with_url(DB_URL)
 
     table_definitions = db.get_table_definitions_for_prompt()
-    prompt = llm.add_cap_ref(
+    prompt, budget_report = llm.add_cap_ref_within_budget(
         "",  # Assuming you want to add the prompt to an empty string, replace it accordingly
         f"Use these {POSTGRES_TABLE_DEFINITIONS_CAP_REF} to satisfy the database query.",
         POSTGRES_TABLE_DEFINITIONS_CAP_REF,
         table_definitions,
+        PROMPT_TOKEN_BUDGET,
     )
+    if budget_report.trimmed:
+        print(budget_report)
 
 with gr.Blocks() as demo:
 
@@ -115,44 +120,19 @@ with gr.Blocks() as demo:
     def flatten_chain(list_of_lists):
         return list(chain.from_iterable(list_of_lists))
 
-    class thread_with_trace(threading.Thread):
-        # https://www.geeksforgeeks.org/python-different-ways-to-kill-a-thread/
-        # https://stackoverflow.com/questions/6893968/how-to-get-the-return-value-from-a-thread
-        def __init__(self, *args, **keywords):
-            threading.Thread.__init__(self, *args, **keywords)
-            self.killed = False
+    class cancellable_thread(threading.Thread):
+        # runs target with token active, so the agents' checkpoints stop it once the token is cancelled;
+        # unlike a sys.settrace tracer this costs nothing while the chat runs
+        def __init__(self, token, *args, **keywords):
+            threading.Thread.__init__(self, *args, daemon=True, **keywords)
+            self.token = token
             self._return = None
 
-        def start(self):
-            self.__run_backup = self.run
-            self.run = self.__run
-            threading.Thread.start(self)
-
-        def __run(self):
-            sys.settrace(self.globaltrace)
-            self.__run_backup()
-            self.run = self.__run_backup
-
         def run(self):
-            if self._target is not None:
+            with self.token.active():
                 self._return = self._target(*self._args, **self._kwargs)
 
-        def globaltrace(self, frame, event, arg):
-            if event == "call":
-                return self.localtrace
-            else:
-                return None
-
-        def localtrace(self, frame, event, arg):
-            if self.killed:
-                if event == "line":
-                    raise SystemExit()
-            return self.localtrace
-
-        def kill(self):
-            self.killed = True
-
-        def join(self, timeout=0):
+        def join(self, timeout=None):
             threading.Thread.join(self, timeout)
             return self._return
 
@@ -203,11 +183,17 @@ with gr.Blocks() as demo:
             code_execution_config={
                 "work_dir": "coding",
                 "use_docker": False,  # set to True or image name like "python:3" to use docker
+                # code runs in a subprocess the checkpoints cannot stop, the timeout does
+                "timeout": TIMEOUT,
             },
         )
 
         # assistant.register_reply([Agent, None], update_agent_history)
         # userproxy.register_reply([Agent, None], update_agent_history)
+        # every reply first checks whether the chat timed out, see chatbot_reply_thread
+        install_checkpoints([assistant, userproxy])
+        # spans to TRACE_FILE when set, see modules/tracing.py
+        instrument_agents([assistant, userproxy])
 
         return assistant, userproxy
 
@@ -226,13 +212,13 @@ with gr.Blocks() as demo:
             messages.append({"content": msg[1], "role": "assistant"})
         return messages
 
-    def oai_message_to_chat(oai_messages, sender):
-        """Convert OpenAI message format to chat history."""
+    def oai_message_to_chat(oai_messages, sender, start=0):
+        """Convert OpenAI message format to chat history, from messages[start] on."""
         chat_history = []
         messages = oai_messages[sender]
         if LOG_LEVEL == "DEBUG":
-            print(f"oai_message_to_chat: {messages}")
-        for i in range(0, len(messages), 2):
+            print(f"oai_message_to_chat: {messages[start:]}")
+        for i in range(start, len(messages), 2):
             chat_history.append(
                 [
                     messages[i]["content"],
@@ -253,7 +239,7 @@ with gr.Blocks() as demo:
             )
         return chat_history
 
-    def initiate_chat(config_list, user_message, chat_history):
+    def initiate_chat(config_list, user_message, chat_history, session_id):
         if LOG_LEVEL == "DEBUG":
             print(f"chat_history_init: {chat_history}")
         # agent_history = flatten_chain(chat_history)
@@ -271,8 +257,6 @@ with gr.Blocks() as demo:
                 "timeout": TIMEOUT,
                 "config_list": config_list,
             }
-            assistant.llm_config.update(llm_config)
-            assistant.client = OpenAIWrapper(**assistant.llm_config)
 
         if user_message.strip().lower().startswith("show file:"):
             filename = user_message.strip().lower().replace("show file:", "").strip()
@@ -283,39 +267,54 @@ with gr.Blocks() as demo:
                 chat_history.append([user_message, f"File {filename} not found."])
             return chat_history
 
-        assistant.reset()
-        oai_messages = chat_to_oai_message(chat_history)
-        assistant._oai_system_message_origin = assistant._oai_system_message.copy()
-        assistant._oai_system_message += oai_messages
+        # this session's agents hold the conversation so far, the message is appended to it
+        with sessions.acquire(session_id) as session:
+            assistant, userproxy = session.agents
+            if assistant.llm_config.get("config_list") != config_list:
+                assistant.llm_config.update(llm_config)
+                assistant.client = OpenAIWrapper(**assistant.llm_config)
+            if session.turns == 0 and chat_history:
+                # new agents of a session that was evicted or ran before a restart, they catch up once
+                assistant._oai_messages[userproxy] += chat_to_oai_message(chat_history)
+            start = len(userproxy.chat_messages[assistant])
+
+            try:
+                with tracer.chat(question=user_message):
+                    userproxy.initiate_chat(assistant, message=user_message, clear_history=False)
+                messages = userproxy.chat_messages
+                chat_history += oai_message_to_chat(messages, assistant, start)
+                # agent_history = flatten_chain(chat_history)
+            except Exception as e:
+                # agent_history += [user_message, str(e)]
+                # chat_history[:] = agent_history_to_chat(agent_history)
+                chat_history.append([user_message, str(e)])
+                # the agents may hold half a turn, the next message gets new ones
+                sessions.discard(session_id)
 
-        try:
-            userproxy.initiate_chat(assistant, message=user_message)
-            messages = userproxy.chat_messages
-            chat_history += oai_message_to_chat(messages, assistant)
-            # agent_history = flatten_chain(chat_history)
-        except Exception as e:
-            # agent_history += [user_message, str(e)]
-            # chat_history[:] = agent_history_to_chat(agent_history)
-            chat_history.append([user_message, str(e)])
-
-        assistant._oai_system_message = assistant._oai_system_message_origin.copy()
         if LOG_LEVEL == "DEBUG":
             print(f"chat_history: {chat_history}")
             # print(f"agent_history: {agent_history}")
         return chat_history
 
-    def chatbot_reply_thread(input_text, chat_history, config_list):
+    def chatbot_reply_thread(input_text, chat_history, config_list, session_id):
         """Chat with the agent through terminal."""
-        thread = thread_with_trace(target=initiate_chat, args=(config_list, input_text, chat_history))
+        token = CancelToken(TIMEOUT)
+        # a copy: a timed-out chat may still append to its history on the way out
+        thread = cancellable_thread(
+            token, target=initiate_chat, args=(config_list, input_text, list(chat_history), session_id)
+        )
         thread.start()
         try:
             messages = thread.join(timeout=TIMEOUT)
             if thread.is_alive():
-                thread.kill()
-                thread.join()
-                messages = [
-                    input_text,
-                    "Timeout Error: Please check your API keys and try again later.",
+                # the round in progress ends within the LLM's HTTP timeout, the checkpoint after it stops the chat
+                token.cancel("timed out")
+                thread.join(timeout=CANCEL_GRACE)
+                messages = chat_history + [
+                    [
+                        input_text,
+                        "Timeout Error: Please check your API keys and try again later.",
+                    ]
                 ]
         except Exception as e:
             messages = [
@@ -326,10 +325,10 @@ with gr.Blocks() as demo:
             ]
         return messages
 
-    def chatbot_reply_plain(input_text, chat_history, config_list):
+    def chatbot_reply_plain(input_text, chat_history, config_list, session_id):
         """Chat with the agent through terminal."""
         try:
-            messages = initiate_chat(config_list, input_text, chat_history)
+            messages = initiate_chat(config_list, input_text, chat_history, session_id)
         except Exception as e:
             messages = [
                 [
@@ -339,9 +338,9 @@ with gr.Blocks() as demo:
             ]
         return messages
 
-    def chatbot_reply(input_text, chat_history, config_list):
+    def chatbot_reply(input_text, chat_history, config_list, session_id):
         """Chat with the agent through terminal."""
-        return chatbot_reply_thread(input_text, chat_history, config_list)
+        return chatbot_reply_thread(input_text, chat_history, config_list, session_id)
 
     def get_description_text():
         return """
@@ -370,28 +369,27 @@ with gr.Blocks() as demo:
         aoai_key = os.environ["AZURE_OPENAI_API_KEY"] 
         aoai_base = os.environ["AZURE_OPENAI_API_BASE"]
 
-    def respond(message, chat_history):
+    def respond(message, chat_history, request: Request):
         config_list = update_config()
-        chat_history[:] = chatbot_reply(message, chat_history, config_list)
+        # one browser tab is one gradio session, with its own agents
+        session_id = request.session_hash if request is not None else "default"
+        chat_history[:] = chatbot_reply(message, chat_history, config_list, session_id)
         if LOG_LEVEL == "DEBUG":
             print(f"return chat_history: {chat_history}")
         return ""
 
 
-    config_list, assistant, userproxy = (
-        [
-            {
-                "api_key": "",
-                "base_url": "",
-                "api_type": "azure",
-                "api_version": "2023-07-01-preview",
-                "model": "gpt-35-turbo",
-            }
-        ],
-        None,
-        None,
-    )
-    assistant, userproxy = initialize_agents(config_list)
+    config_list = [
+        {
+            "api_key": "",
+            "base_url": "",
+            "api_type": "azure",
+            "api_version": "2023-07-01-preview",
+            "model": "gpt-35-turbo",
+        }
+    ]
+    # (assistant, userproxy) per browser session, given the real config on their first message
+    sessions = SessionStore(lambda: initialize_agents(config_list), SESSION_IDLE_SECONDS, SESSION_MAX)
 
     description = gr.Markdown(get_description_text())
 
@@ -0,0 +1,888 @@
+"""
+Purpose:
+    Local benchmarks for the modules package, no LLM or SQL Server needed.
+    Run from this directory:
+        python benchmarks.py async-db --sessions 64 --queries 10 --latency-ms 20
+        python benchmarks.py row-limit --iterations 2000
+        python benchmarks.py llm --prompts 200 --concurrency 16 --latency-ms 200 --error-rate 0.1
+        python benchmarks.py completion-cache --entries 5000 --processes 4
+        python benchmarks.py llm-stream --prompts 20 --token-ms 20
+        python benchmarks.py team --requests 200
+        python benchmarks.py load --concurrency 1 2 4 8 16 --chats 32 --latency-ms 200 --llm-limit 24
+        python benchmarks.py speaker-selection --chats 20 --reviews 2
+        python benchmarks.py chat-stream --chats 5 --latency-ms 200
+        python benchmarks.py plan-cache --plans 2000
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+
+def make_sqlite_db(path, rows=20000):
+    """A small stand-in for the alert warehouse."""
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE IndividualAlarmsUS (Id INTEGER PRIMARY KEY, SiteId INT, AlarmType TEXT, "
+        "DateTimeAlarmClosed TEXT, ResponseTime REAL)"
+    )
+    con.executemany(
+        "INSERT INTO IndividualAlarmsUS VALUES (?, ?, ?, ?, ?)",
+        [
+            (i, i % 200, ("Motion", "Contact", "Loitering")[i % 3], f"2023-11-{i % 28 + 1:02d}T10:00:00", i % 90)
+            for i in range(rows)
+        ],
+    )
+    con.commit()
+    con.close()
+
+
+def add_server_latency(sync_engine, latency_ms):
+    """Registers sleep_ms() so a query can spend time 'on the server' like SQL Server would."""
+
+    @event.listens_for(sync_engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("sleep_ms", 1, lambda ms: time.sleep(ms / 1000) or 0)
+
+
+def _queries(n, latency_ms):
+    return [
+        f"SELECT sleep_ms({latency_ms}) AS waited, AlarmType, COUNT(*) AS n, AVG(ResponseTime) AS avg_response "
+        f"FROM IndividualAlarmsUS WHERE SiteId = {i % 200} GROUP BY AlarmType"
+        for i in range(n)
+    ]
+
+
+def bench_async_db(args):
+    from modules.async_db import AsyncSQLManager, get_async_engine
+    from modules.db import SQLManager
+    from modules.engine_registry import registry
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "alerts.db")
+        make_sqlite_db(path)
+        url = f"sqlite:///{path}"
+        queries = _queries(args.sessions * args.queries, args.latency_ms)
+
+        # sync path: one Gradio worker thread per chat session waiting on the database
+        registry.configure(pool_size=args.threads, max_overflow=0)
+        add_server_latency(registry.get_engine(url), args.latency_ms)
+        db = SQLManager()
+        db.connect_with_url(url)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(db.run_sql, queries))
+        sync_elapsed = time.perf_counter() - start
+
+        # async path: every session is a coroutine on one thread
+        async def run_async():
+            registry.configure(pool_size=args.sessions, max_overflow=0)
+            add_server_latency(get_async_engine(url).sync_engine, args.latency_ms)
+            adb = AsyncSQLManager()
+            await adb.connect_with_url(url)
+
+            async def session(i):
+                for sql in queries[i :: args.sessions]:
+                    await adb.run_sql(sql)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(session(i) for i in range(args.sessions)))
+            elapsed = time.perf_counter() - start
+            await adb.engine.dispose()
+            return elapsed
+
+        async_elapsed = asyncio.run(run_async())
+        registry.dispose()
+
+    print(f"{len(queries)} queries, {args.sessions} sessions, {args.latency_ms} ms simulated server time")
+    print(f"sync  ({args.threads:>3} threads): {len(queries) / sync_elapsed:8.1f} queries/s")
+    print(f"async (  1 thread ): {len(queries) / async_elapsed:8.1f} queries/s")
+
+
+# the kind of SQL the agents write, see the examples in the prompts in main.py
+TYPICAL_QUERIES = [
+    "SELECT COUNT(*) AS TotalAlerts FROM fact.IndividualAlarmsUS WHERE DateTimeAlarmClosed >= '2023-11-01'",
+    "SELECT s.Name, COUNT(*) AS Alerts FROM fact.IndividualAlarmsUS i JOIN dim.Site s ON s.Id = i.SiteId "
+    "WHERE i.DateTimeAlarmClosed BETWEEN '2023-11-01' AND '2023-11-30' GROUP BY s.Name ORDER BY Alerts DESC;",
+    "WITH daily AS (SELECT CAST(DateTimeAlarmClosed AS date) AS Day, AVG(ResponseTime) AS AvgResponse "
+    "FROM fact.IndividualAlarmsUS WHERE SiteId IN (SELECT Id FROM dim.Site WHERE ReferenceCode LIKE 'SUS-%') "
+    "GROUP BY CAST(DateTimeAlarmClosed AS date)) SELECT Day, AvgResponse FROM daily ORDER BY Day",
+    "SELECT DISTINCT AlarmType FROM fact.IndividualAlarmsUS -- every type seen\n",
+]
+
+
+def bench_row_limit(args):
+    from modules.row_limit import limit_rows
+
+    print(f"{'dialect':<12}{'mean us':>10}{'p95 us':>10}{'max us':>10}")
+    for dialect in ("mssql", "postgresql", "sqlite"):
+        timings = []
+        for _ in range(args.iterations):
+            for sql in TYPICAL_QUERIES:
+                start = time.perf_counter()
+                limit_rows(sql, dialect, 501)
+                timings.append((time.perf_counter() - start) * 1e6)
+        timings.sort()
+        mean = sum(timings) / len(timings)
+        p95 = timings[int(len(timings) * 0.95)]
+        print(f"{dialect:<12}{mean:10.1f}{p95:10.1f}{timings[-1]:10.1f}")
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI-compatible /chat/completions that echoes the prompt after latency_ms.
+    With "stream": true the echo is sent word by word as server-sent events, token_ms apart,
+    each event split over two writes so clients see partial chunks.
+    More than max_in_flight requests at once are answered with 429, like a deployment's rate limit.
+    """
+
+    latency_ms = 0
+    error_rate = 0.0
+    token_ms = 0
+    max_in_flight = None
+    in_flight = 0
+    in_flight_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, request, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else " " + word}
+            chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta}]}
+            event = f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+            for part in (event[: len(event) // 2], event[len(event) // 2 :]):
+                self.wfile.write(part)
+                self.wfile.flush()
+            time.sleep(self.token_ms / 1000)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        cls = type(self)
+        with cls.in_flight_lock:
+            limited = self.max_in_flight is not None and cls.in_flight >= self.max_in_flight
+            if not limited:
+                cls.in_flight += 1
+        if limited:
+            return self._send_json(429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": "0.2"})
+        try:
+            self._answer(request)
+        finally:
+            with cls.in_flight_lock:
+                cls.in_flight -= 1
+
+    def _answer(self, request):
+        time.sleep(self.latency_ms / 1000)
+        if random.random() < self.error_rate:
+            return self._send_json(429, {"error": {"message": "Rate limit reached"}})
+        content = "echo: " + request["messages"][-1]["content"]
+        if request.get("stream"):
+            return self._send_stream(request, content)
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "model": request.get("model", "stub"),
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            },
+        )
+
+
+class WorkflowStubLLMHandler(StubLLMHandler):
+    """
+    Plays the SQL team: the Engineer writes SQL, the analyst calls run_sql and sums up, and the
+    Product Manager sends the work back to the Engineer until its reviews-th review, which is APPROVED.
+    Speaker selection requests are answered with the speaker the workflow expects.
+    """
+
+    reviews = 1
+    calls = None
+    # prompt and completion tokens answered, when set to a Counter
+    tokens = None
+
+    def _answer(self, request):
+        time.sleep(self.latency_ms / 1000)
+        messages = request["messages"]
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        last = messages[-1]
+        kind = "selection" if system.startswith("You are in a role play game") else "reply"
+        with self.in_flight_lock:
+            self.calls[kind] += 1
+
+        message = {"role": "assistant", "content": None}
+        if kind == "selection":
+            spoken = [m for m in messages[1:-1] if m["role"] != "system"]
+            last_spoken = spoken[-1] if spoken else {}
+            if last_spoken.get("role") == "function":
+                message["content"] = "Sr_Data_Analyst"
+            else:
+                next_speaker = {"Engineer": "Sr_Data_Analyst", "Sr_Data_Analyst": "Product_Manager"}
+                message["content"] = next_speaker.get(last_spoken.get("name"), "Engineer")
+        elif system.startswith("Engineer"):
+            message["content"] = "SELECT COUNT(*) FROM fact.IndividualAlarmsUS WHERE SiteId = 42"
+        elif system.startswith("Analyst") and last.get("role") == "function":
+            message["content"] = "Site 42 had 12 alerts."
+        elif system.startswith("Analyst"):
+            message["function_call"] = {"name": "run_sql", "arguments": json.dumps({"sql": "SELECT 12"})}
+        elif system.startswith("Product manager"):
+            review = "Engineer, the date filter is missing."
+            done = sum(m.get("content") == review for m in messages) + 1 >= self.reviews
+            message["content"] = "APPROVED" if done else review
+        else:
+            message["content"] = "ok"
+        # words stand in for tokens
+        prompt_tokens = sum(len(str(m.get("content") or "").split()) for m in messages)
+        completion_tokens = len(str(message["content"] or message.get("function_call")).split())
+        if self.tokens is not None:
+            with self.in_flight_lock:
+                self.tokens.update(prompt=prompt_tokens, completion=completion_tokens)
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": 0},
+            },
+        )
+
+
+def start_stub_llm_server(latency_ms=0, error_rate=0.0, token_ms=0, max_in_flight=None, handler=StubLLMHandler):
+    """Serves the stub on a free local port in a daemon thread, returns (server, base_url)."""
+    handler = type(
+        "ConfiguredStubLLMHandler",
+        (handler,),
+        {
+            "latency_ms": latency_ms,
+            "error_rate": error_rate,
+            "token_ms": token_ms,
+            "max_in_flight": max_in_flight,
+            "in_flight": 0,
+            "in_flight_lock": threading.Lock(),
+        },
+    )
+    # the default listen backlog of 5 drops connections under load, which shows up as 1 s connect stalls
+    server_class = type("StubLLMServer", (ThreadingHTTPServer,), {"request_queue_size": 128, "daemon_threads": True})
+    server = server_class(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def bench_llm(args):
+    from modules.llm import AsyncLLMClient
+
+    server, base_url = start_stub_llm_server(args.latency_ms, args.error_rate)
+    prompts = [f"question {i}" for i in range(args.prompts)]
+
+    async def run():
+        async with AsyncLLMClient(
+            base_url=base_url, api_key="stub", model="stub", api_version=None, max_concurrency=args.concurrency
+        ) as client:
+            start = time.perf_counter()
+            answers = await client.prompt_many(prompts, return_exceptions=True)
+            return time.perf_counter() - start, answers, client.latency.snapshot()
+
+    try:
+        elapsed, answers, stats = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    failed = sum(isinstance(answer, Exception) for answer in answers)
+    print(f"{len(prompts)} prompts, concurrency {args.concurrency}, {args.latency_ms} ms stub latency")
+    print(f"{len(prompts) / elapsed:.1f} prompts/s, {failed} failed")
+    print(
+        f"p50 {stats['p50_ms']:.0f} ms  p95 {stats['p95_ms']:.0f} ms  p99 {stats['p99_ms']:.0f} ms  "
+        f"max {stats['max_ms']:.0f} ms  retries {stats['retries']}"
+    )
+
+
+def bench_llm_stream(args):
+    from modules.llm import AsyncLLMClient
+
+    server, base_url = start_stub_llm_server(args.latency_ms, 0.0, args.token_ms)
+    prompt = " ".join(f"word{i}" for i in range(args.words))
+    client = AsyncLLMClient(base_url=base_url, api_key="stub", model="stub", api_version=None, cache=None)
+    try:
+        first, full = [], []
+        for _ in range(args.prompts):
+            stream = client.stream_sync(prompt)
+            text = "".join(stream)
+            assert text == "echo: " + prompt, text
+            first.append(stream.time_to_first_token)
+            full.append(stream.elapsed)
+    finally:
+        asyncio.run(client.aclose())
+        server.shutdown()
+
+    print(f"{args.prompts} streamed prompts, {args.words + 1} tokens each, {args.token_ms} ms per token")
+    print(f"time to first token: {1000 * sum(first) / len(first):7.1f} ms mean")
+    print(f"full completion:     {1000 * sum(full) / len(full):7.1f} ms mean")
+
+
+def _fill_completion_cache(path, worker, entries, max_bytes):
+    from modules.completion_cache import CompletionCache
+
+    cache = CompletionCache(path, max_bytes=max_bytes)
+    for i in range(entries):
+        messages = [{"role": "user", "content": f"Summarize table {i % (entries // 2 or 1)}"}]
+        cache.get_or_call("autogen", messages, lambda: f"summary {i} from worker {worker} " + "x" * 500)
+
+
+def bench_completion_cache(args):
+    from modules.completion_cache import CompletionCache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "completions.sqlite")
+        max_bytes = args.max_kb * 1024
+
+        # several processes reading and writing the same file at once
+        start = time.perf_counter()
+        workers = [
+            multiprocessing.Process(target=_fill_completion_cache, args=(path, worker, args.entries, max_bytes))
+            for worker in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        fill_elapsed = time.perf_counter() - start
+        failed = sum(worker.exitcode != 0 for worker in workers)
+
+        cache = CompletionCache(path, max_bytes=max_bytes)
+        messages = [{"role": "user", "content": "Summarize table 1"}]
+        cache.get_or_call("autogen", messages, lambda: "summary")
+        timings = []
+        for _ in range(args.lookups):
+            start = time.perf_counter()
+            cache.get("autogen", messages)
+            timings.append((time.perf_counter() - start) * 1e6)
+        timings.sort()
+        stats = cache.stats()
+
+    print(f"{args.processes} processes x {args.entries} lookups in {fill_elapsed:.2f}s, {failed} failed")
+    print(f"{stats['entries']} entries, {stats['bytes'] / 1024:.0f} KB of {args.max_kb} KB")
+    print(
+        f"warm get: mean {sum(timings) / len(timings):.1f} us  p95 {timings[int(len(timings) * 0.95)]:.1f} us  "
+        f"max {timings[-1]:.1f} us"
+    )
+
+
+def bench_team(args):
+    from modules.team import TeamPrompts, build_team, get_team_pool
+
+    llm_config = {
+        "temperature": 0,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": "http://127.0.0.1:9/v1"}],
+    }
+    prompts = TeamPrompts(*(f"{name} prompt. " * 200 for name in ("admin", "engineer", "analyst", "manager")))
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        build_team(llm_config, prompts)
+    build_elapsed = time.perf_counter() - start
+
+    pool = get_team_pool(llm_config, prompts)
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        with pool.acquire({"run_sql": lambda sql: "[]"}) as team:
+            team.groupchat.messages.append({"role": "user", "content": "hi"})
+    pool_elapsed = time.perf_counter() - start
+
+    print(f"{args.requests} requests")
+    print(f"build per request: {1000 * build_elapsed / args.requests:8.3f} ms")
+    print(f"pooled team:       {1000 * pool_elapsed / args.requests:8.3f} ms  {pool.stats()}")
+
+
+def bench_speaker_selection(args):
+    """LLM calls per question with the default speaker selection vs the SQL team's transition graph."""
+    from modules.speaker_selection import selection_totals
+    from modules.team import TeamPrompts, build_team
+
+    handler = type("CountingWorkflowStub", (WorkflowStubLLMHandler,), {"reviews": args.reviews, "calls": Counter()})
+    server, base_url = start_stub_llm_server(args.latency_ms, handler=handler)
+    llm_config = {
+        "temperature": 0,
+        "seed": None,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": base_url}],
+    }
+    prompts = TeamPrompts("Admin.", "Engineer.", "Analyst.", "Product manager.")
+
+    print(f"{args.chats} chats, approved at review {args.reviews}, {args.latency_ms} ms per LLM call")
+    print(f"{'selection':>14}{'calls/chat':>12}{'selection':>11}{'reply':>7}{'rounds':>8}{'s/chat':>8}")
+    try:
+        for speaker_selection in ("auto", "state_machine"):
+            team = build_team(llm_config, prompts, max_round=args.rounds, speaker_selection=speaker_selection)
+            team.bind_functions({"run_sql": lambda sql: "[[12]]"})
+            handler.calls.clear()
+            rounds = 0
+            start = time.perf_counter()
+            for i in range(args.chats):
+                team.reset()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    team.initiate_chat(f"How many alerts did site {i} have last week?")
+                rounds += len(team.groupchat.messages)
+            elapsed = (time.perf_counter() - start) / args.chats
+            team.reset()
+            calls = handler.calls
+            print(
+                f"{speaker_selection:>14}{sum(calls.values()) / args.chats:>12.1f}"
+                f"{calls['selection'] / args.chats:>11.1f}{calls['reply'] / args.chats:>7.1f}"
+                f"{rounds / args.chats:>8.1f}{elapsed:>8.2f}"
+            )
+        print(selection_totals.stats())
+    finally:
+        server.shutdown()
+
+
+def bench_stall(args):
+    """Rounds, LLM calls and tokens of a team that never gets approved, with and without stall detection."""
+    from modules.stall_detector import stall_totals
+    from modules.team import TeamPrompts, build_team
+
+    # the Product Manager never approves, so the Engineer and the analyst repeat themselves until max_round
+    handler = type(
+        "LoopingWorkflowStub",
+        (WorkflowStubLLMHandler,),
+        {"reviews": args.rounds, "calls": Counter(), "tokens": Counter()},
+    )
+    server, base_url = start_stub_llm_server(handler=handler)
+    llm_config = {
+        "temperature": 0,
+        "seed": None,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": base_url}],
+    }
+    prompts = TeamPrompts("Admin.", "Engineer.", "Analyst.", "Product manager.")
+
+    print(f"{args.chats} chats that never get approved, max_round {args.rounds}, words stand in for tokens")
+    print(f"{'selection':>14}{'patience':>10}{'rounds':>8}{'calls':>7}{'tokens':>9}")
+    try:
+        for speaker_selection in ("auto", "state_machine"):
+            for patience in (None, args.patience):
+                team = build_team(llm_config, prompts, args.rounds, speaker_selection, stall_patience=patience)
+                team.bind_functions({"run_sql": lambda sql: "[[12]]"})
+                handler.calls.clear()
+                handler.tokens.clear()
+                rounds = 0
+                for i in range(args.chats):
+                    team.reset()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        team.initiate_chat(f"How many alerts did site {i} have last week?")
+                    rounds += len(team.groupchat.messages)
+                report = team.stall_report()
+                team.reset()
+                print(
+                    f"{speaker_selection:>14}{str(patience):>10}{rounds / args.chats:>8.1f}"
+                    f"{sum(handler.calls.values()) / args.chats:>7.1f}{sum(handler.tokens.values()) / args.chats:>9.0f}"
+                )
+                if report:
+                    print(f"{'':>14}last chat: {report}")
+        print(stall_totals.stats())
+    finally:
+        server.shutdown()
+
+
+class LineTracedThread(threading.Thread):
+    """The sys.settrace thread app.py used to kill timed-out chats with, kept here for comparison."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, daemon=True, **kwargs)
+        self.killed = False
+
+    def run(self):
+        sys.settrace(self.globaltrace)
+        super().run()
+
+    def globaltrace(self, frame, event, arg):
+        return self.localtrace if event == "call" else None
+
+    def localtrace(self, frame, event, arg):
+        if self.killed and event == "line":
+            raise SystemExit()
+        return self.localtrace
+
+    def kill(self):
+        self.killed = True
+
+
+def bench_cancellation(args):
+    """CPU time per chat round under the old line tracer vs cooperative checkpoints, and time to stop a chat."""
+    from modules.cancellation import CancelToken, ChatCancelled
+    from modules.team import TeamPrompts, build_team
+
+    handler = type("CancelWorkflowStub", (WorkflowStubLLMHandler,), {"reviews": args.reviews, "calls": Counter()})
+    # the stub's latency is spent on its own threads, the CPU time of the chat thread does not include it
+    server, base_url = start_stub_llm_server(args.latency_ms, handler=handler)
+    llm_config = {
+        "temperature": 0,
+        "seed": None,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": base_url}],
+    }
+    prompts = TeamPrompts("Admin.", "Engineer.", "Analyst.", "Product manager.")
+    team = build_team(llm_config, prompts, speaker_selection="state_machine")
+    team.bind_functions({"run_sql": lambda sql: "[[12]]"})
+
+    def chats(result, token=None):
+        start = time.thread_time()
+        rounds = 0
+        try:
+            with token.active() if token else contextlib.nullcontext():
+                for i in range(args.chats):
+                    team.reset()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        team.initiate_chat(f"How many alerts did site {i} have last week?")
+                    rounds += len(team.groupchat.messages)
+        except ChatCancelled:
+            pass
+        result.update(cpu=time.thread_time() - start, rounds=rounds)
+
+    print(f"{args.chats} chats, approved at review {args.reviews}, CPU time of the chat thread")
+    print(f"{'thread':>14}{'ms/round':>10}{'ms/chat':>9}")
+    try:
+        for name in ("plain", "settrace", "checkpoints"):
+            result = {}
+            if name == "settrace":
+                thread = LineTracedThread(target=chats, args=(result,))
+            else:
+                thread = threading.Thread(target=chats, args=(result, CancelToken() if name == "checkpoints" else None))
+            thread.start()
+            thread.join()
+            print(
+                f"{name:>14}{1000 * result['cpu'] / result['rounds']:>10.2f}{1000 * result['cpu'] / args.chats:>9.1f}"
+            )
+
+        # a chat that never ends, cancelled mid-way: it stops at the next reply
+        handler.reviews = 1000
+        token = CancelToken()
+        thread = threading.Thread(target=chats, args=({}, token), daemon=True)
+        thread.start()
+        time.sleep(args.cancel_after_ms / 1000)
+        start = time.perf_counter()
+        token.cancel()
+        thread.join()
+        print(
+            f"cancelled after {args.cancel_after_ms} ms, stopped {1000 * (time.perf_counter() - start):.0f} ms later "
+            f"({args.latency_ms} ms per LLM call)"
+        )
+    finally:
+        team.reset()
+        server.shutdown()
+
+
+def bench_sessions(args):
+    """Work per turn of app.py before a new message: replaying the Chatbot history vs the session's live agents."""
+    from autogen import AssistantAgent, UserProxyAgent
+
+    from modules.session_store import SessionStore
+
+    server, base_url = start_stub_llm_server()
+    config_list = [{"model": "stub", "api_key": "stub", "base_url": base_url}]
+
+    def agents():
+        assistant = AssistantAgent("assistant", llm_config={"config_list": config_list, "seed": None})
+        # one reply per message, like a message without a python block in app.py
+        userproxy = UserProxyAgent(
+            "userproxy", human_input_mode="NEVER", code_execution_config=False, is_termination_msg=lambda m: True
+        )
+        return assistant, userproxy
+
+    def to_oai(chat_history):
+        # app.py's chat_to_oai_message
+        messages = []
+        for user, reply in chat_history:
+            messages.append({"content": user, "role": "user"})
+            messages.append({"content": reply, "role": "assistant"})
+        return messages
+
+    def replay_turn(pair, chat_history, message):
+        # what app.py did every turn: rebuild the history into the system message, run, restore
+        assistant, userproxy = pair
+        start = time.thread_time()
+        assistant.reset()
+        origin = assistant._oai_system_message.copy()
+        assistant._oai_system_message += to_oai(chat_history)
+        prepare = time.thread_time() - start
+        userproxy.initiate_chat(assistant, message=message, silent=True)
+        assistant._oai_system_message = origin
+        return prepare, time.thread_time() - start
+
+    def session_turn(store, message):
+        start = time.thread_time()
+        with store.acquire("bench") as session:
+            assistant, userproxy = session.agents
+            offset = len(userproxy.chat_messages[assistant])
+            prepare = time.thread_time() - start
+            userproxy.initiate_chat(assistant, message=message, clear_history=False, silent=True)
+            userproxy.chat_messages[assistant][offset:]
+        return prepare, time.thread_time() - start
+
+    words = " ".join(["alarm"] * args.words)
+    print(f"{args.turns} turns per history length, {args.words} words per message, CPU time of the request thread")
+    print(f"{'history':>8}{'replay prepare':>16}{'session prepare':>17}{'replay turn':>13}{'session turn':>14}")
+    try:
+        for length in args.history:
+            chat_history = [[f"question {i} {words}", f"answer {i} {words}"] for i in range(length)]
+            pair = agents()
+            store = SessionStore(agents)
+            with store.acquire("bench") as session:
+                assistant, userproxy = session.agents
+                assistant._oai_messages[userproxy] += to_oai(chat_history)
+            replay = [replay_turn(pair, chat_history, f"question {i} {words}") for i in range(args.turns)]
+            live = [session_turn(store, f"question {i} {words}") for i in range(args.turns)]
+            print(
+                f"{length:>8}{1000 * sum(p for p, _ in replay) / args.turns:>13.3f} ms"
+                f"{1000 * sum(p for p, _ in live) / args.turns:>14.3f} ms"
+                f"{1000 * sum(t for _, t in replay) / args.turns:>10.2f} ms"
+                f"{1000 * sum(t for _, t in live) / args.turns:>11.2f} ms"
+            )
+    finally:
+        server.shutdown()
+
+
+def bench_chat_stream(args):
+    """Time until the first agent reply is visible when streaming, vs the whole chat before."""
+    from modules.chat_stream import ChatStream
+    from modules.team import TeamPrompts, build_team
+
+    handler = type("StreamWorkflowStub", (WorkflowStubLLMHandler,), {"reviews": args.reviews, "calls": Counter()})
+    server, base_url = start_stub_llm_server(args.latency_ms, handler=handler)
+    llm_config = {
+        "temperature": 0,
+        "seed": None,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": base_url}],
+    }
+    prompts = TeamPrompts("Admin.", "Engineer.", "Analyst.", "Product manager.")
+    team = build_team(llm_config, prompts, speaker_selection="state_machine")
+    team.bind_functions({"run_sql": lambda sql: "[[12]]"})
+
+    print(f"{args.chats} chats, approved at review {args.reviews}, {args.latency_ms} ms per LLM call")
+    print(f"{'question':>10}{'first reply':>13}{'full chat':>11}{'messages':>10}")
+    try:
+        for i in range(args.chats):
+            team.reset()
+            stream = ChatStream()
+            seen = {}
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                question = f"How many alerts did site {i} have last week?"
+                for name, _ in stream.run(lambda: team.initiate_chat(question, listener=stream.listener)):
+                    seen.setdefault(name, time.perf_counter() - start)
+                    seen["messages"] = seen.get("messages", 0) + 1
+            elapsed = time.perf_counter() - start
+            print(
+                f"{seen['Admin'] * 1000:>8.1f}ms{seen['Engineer'] * 1000:>11.1f}ms{elapsed * 1000:>9.1f}ms"
+                f"{seen['messages']:>10}"
+            )
+    finally:
+        server.shutdown()
+
+
+# (stored question, incoming question, should it reuse the stored plan)
+PLAN_CACHE_QUESTIONS = [
+    ("SLA breaches last month", "How many SLA breaches did we have last month?", True),
+    ("SLA breaches last month", "show me last month's SLA breaches", True),
+    ("SLA breaches last month", "SLA breaches this month", False),
+    ("alerts handled by CARS last week", "how many alarms were handled by CARS last week", True),
+    ("alerts handled by CARS last week", "alerts not handled by CARS last week", False),
+    ("average response time per site last month", "what was the average response time per site last month", True),
+    ("average response time per site last month", "max response time per site last month", False),
+    ("alarms at site s-us-0042 yesterday", "alarms at site s-us-0043 yesterday", False),
+    ("top 10 specialists by alarms handled last week", "last week's top 10 specialists by alarms handled", True),
+    ("top 10 specialists by alarms handled last week", "top 5 specialists by alarms handled last week", False),
+]
+
+
+def bench_plan_cache(args):
+    from modules.plan_cache import PlanCache
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = PlanCache(os.path.join(directory, "plans.sqlite"), threshold=args.threshold)
+        print(f"threshold {args.threshold}")
+        print(f"{'decision':>15}{'similarity':>12}{'expected':>10}  question")
+        correct = 0
+        for stored, incoming, reuse in PLAN_CACHE_QUESTIONS:
+            cache.clear()
+            cache.store(stored, "SELECT 1")
+            decision = cache.lookup(incoming)
+            correct += (decision.decision == "hit") == reuse
+            similarity = f"{decision.similarity:.3f}" if decision.similarity is not None else "-"
+            print(f"{decision.decision:>15}{similarity:>12}{'hit' if reuse else 'miss':>10}  {incoming}")
+        print(f"{correct}/{len(PLAN_CACHE_QUESTIONS)} as expected")
+
+        cache.clear()
+        for i in range(args.plans):
+            cache.store(f"alarms of type {i} per site for customer {i * 7} last week", f"SELECT {i}")
+        cache.store("SLA breaches last month", "SELECT 1")
+        start = time.perf_counter()
+        for _ in range(args.lookups):
+            cache.lookup("how many SLA breaches did we have last month")
+        elapsed = (time.perf_counter() - start) / args.lookups
+        print(f"lookup among {args.plans + 1} plans: {elapsed * 1000:.2f} ms  {cache.stats()}")
+
+
+def bench_load(args):
+    """Group chats run the way Gradio's queue runs respond: one worker thread per allowed concurrent chat."""
+    from modules.team import TeamPrompts, get_team_pool
+
+    server, base_url = start_stub_llm_server(args.latency_ms, max_in_flight=args.llm_limit)
+    llm_config = {
+        "temperature": 0,
+        # no autogen disk cache, every chat has to reach the LLM
+        "seed": None,
+        "config_list": [{"model": "stub", "api_key": "stub", "base_url": base_url}],
+    }
+    prompts = TeamPrompts("Admin.", "Engineer.", "Analyst.", "Product manager.")
+
+    def chat(pool, i):
+        with pool.acquire({"run_sql": lambda sql: "[]"}) as team:
+            team.initiate_chat(f"How many alerts did site {i} have last week?")
+            return len(team.chat_history())
+
+    print(f"{args.chats} chats of {args.rounds} rounds, {args.latency_ms} ms per LLM call, LLM limit {args.llm_limit}")
+    print(f"{'concurrency':>11}{'chats/s':>10}{'speedup':>9}{'failed':>8}")
+    baseline = None
+    try:
+        for concurrency in args.concurrency:
+            pool = get_team_pool(llm_config, prompts, max_round=args.rounds, max_idle=concurrency)
+            start = time.perf_counter()
+            # autogen prints every message, keep the table readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                with ThreadPoolExecutor(max_workers=concurrency) as workers:
+                    futures = [workers.submit(chat, pool, i) for i in range(args.chats)]
+                    failed = sum(future.exception() is not None for future in futures)
+            throughput = args.chats / (time.perf_counter() - start)
+            baseline = baseline or throughput
+            print(f"{concurrency:>11}{throughput:>10.2f}{throughput / baseline:>8.1f}x{failed:>8}")
+    finally:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    async_db = subparsers.add_parser("async-db", help="SQLManager vs AsyncSQLManager throughput on SQLite")
+    async_db.add_argument("--sessions", type=int, default=64, help="concurrent chat sessions")
+    async_db.add_argument("--queries", type=int, default=10, help="queries per session")
+    async_db.add_argument("--threads", type=int, default=8, help="worker threads for the sync path")
+    async_db.add_argument("--latency-ms", type=int, default=20, help="simulated server time per query")
+    async_db.set_defaults(func=bench_async_db)
+
+    row_limit = subparsers.add_parser("row-limit", help="time to check and rewrite one generated query")
+    row_limit.add_argument("--iterations", type=int, default=2000, help="passes over the typical queries")
+    row_limit.set_defaults(func=bench_row_limit)
+
+    llm = subparsers.add_parser("llm", help="AsyncLLMClient.prompt_many against a local stub server")
+    llm.add_argument("--prompts", type=int, default=200)
+    llm.add_argument("--concurrency", type=int, default=16, help="max requests in flight")
+    llm.add_argument("--latency-ms", type=int, default=200, help="stub server time per request")
+    llm.add_argument("--error-rate", type=float, default=0.1, help="share of requests answered with 429")
+    llm.set_defaults(func=bench_llm)
+
+    llm_stream = subparsers.add_parser("llm-stream", help="time to first token vs full completion on the stub")
+    llm_stream.add_argument("--prompts", type=int, default=20)
+    llm_stream.add_argument("--words", type=int, default=50, help="words in the echoed prompt")
+    llm_stream.add_argument("--latency-ms", type=int, default=100, help="stub server time before the first token")
+    llm_stream.add_argument("--token-ms", type=int, default=20, help="stub server time per token")
+    llm_stream.set_defaults(func=bench_llm_stream)
+
+    team = subparsers.add_parser("team", help="building the agent team per request vs TeamPool")
+    team.add_argument("--requests", type=int, default=200)
+    team.set_defaults(func=bench_team)
+
+    load = subparsers.add_parser("load", help="concurrent group chats against the stub LLM")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="CHAT_CONCURRENCY values")
+    load.add_argument("--chats", type=int, default=32)
+    load.add_argument("--rounds", type=int, default=4, help="max_round of each group chat")
+    load.add_argument("--latency-ms", type=int, default=200, help="stub server time per LLM call")
+    load.add_argument("--llm-limit", type=int, default=24, help="LLM calls in flight before the stub answers 429")
+    load.set_defaults(func=bench_load)
+
+    speaker_selection = subparsers.add_parser(
+        "speaker-selection", help="LLM calls per question, auto vs state machine speaker selection"
+    )
+    speaker_selection.add_argument("--chats", type=int, default=20)
+    speaker_selection.add_argument("--reviews", type=int, default=2, help="Product Manager review that approves")
+    speaker_selection.add_argument("--rounds", type=int, default=20, help="max_round of each group chat")
+    speaker_selection.add_argument("--latency-ms", type=int, default=0, help="stub server time per LLM call")
+    speaker_selection.set_defaults(func=bench_speaker_selection)
+
+    chat_stream = subparsers.add_parser("chat-stream", help="time to the first streamed agent reply vs the full chat")
+    chat_stream.add_argument("--chats", type=int, default=5)
+    chat_stream.add_argument("--reviews", type=int, default=2, help="Product Manager review that approves")
+    chat_stream.add_argument("--latency-ms", type=int, default=200, help="stub server time per LLM call")
+    chat_stream.set_defaults(func=bench_chat_stream)
+
+    cancellation = subparsers.add_parser(
+        "cancellation", help="CPU time per round, sys.settrace thread vs cooperative checkpoints"
+    )
+    cancellation.add_argument("--chats", type=int, default=10)
+    cancellation.add_argument("--reviews", type=int, default=2, help="Product Manager review that approves")
+    cancellation.add_argument("--latency-ms", type=int, default=100, help="stub server time per LLM call")
+    cancellation.add_argument("--cancel-after-ms", type=int, default=500)
+    cancellation.set_defaults(func=bench_cancellation)
+
+    sessions = subparsers.add_parser("sessions", help="app.py turn cost vs history length, replay vs live session")
+    sessions.add_argument("--history", type=int, nargs="+", default=[10, 100, 1000], help="turns already in the chat")
+    sessions.add_argument("--turns", type=int, default=20, help="timed turns per history length")
+    sessions.add_argument("--words", type=int, default=50, help="words per message")
+    sessions.set_defaults(func=bench_sessions)
+
+    stall = subparsers.add_parser("stall", help="rounds and tokens of looping chats with and without stall detection")
+    stall.add_argument("--chats", type=int, default=5)
+    stall.add_argument("--rounds", type=int, default=20, help="max_round of each group chat")
+    stall.add_argument("--patience", type=int, default=2, help="messages without progress before the Admin steps in")
+    stall.set_defaults(func=bench_stall)
+
+    plan_cache = subparsers.add_parser("plan-cache", help="PlanCache decisions on rewordings and lookup time")
+    plan_cache.add_argument("--plans", type=int, default=2000, help="stored plans for the lookup timing")
+    plan_cache.add_argument("--lookups", type=int, default=100)
+    plan_cache.add_argument("--threshold", type=float, default=0.85)
+    plan_cache.set_defaults(func=bench_plan_cache)
+
+    completion_cache = subparsers.add_parser("completion-cache", help="CompletionCache shared by several processes")
+    completion_cache.add_argument("--entries", type=int, default=5000, help="lookups per process, half of them repeats")
+    completion_cache.add_argument("--processes", type=int, default=4)
+    completion_cache.add_argument("--max-kb", type=int, default=1024, help="cache size limit")
+    completion_cache.add_argument("--lookups", type=int, default=10000, help="timed warm lookups")
+    completion_cache.set_defaults(func=bench_completion_cache)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import os
 import dotenv
-import autogen
 from modules import llm
+from modules.cancellation import CancelToken
+from modules.chat_stream import ChatStream
+from modules.cost_guard import CostGuard
 from modules.db import SQLManager
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from modules.plan_cache import DEFAULT_THRESHOLD, PlanCache
+from modules.result_cache import ResultCache
+from modules.team import TeamPrompts, get_team_pool, is_empty_result, is_function_error
+from modules.tracing import tracer
 import gradio as gr
 
 dotenv.load_dotenv()
@@ -18,213 +22,283 @@ print(DB_URL)
 print(OPENAI_API_KEY)
 print(OPENAI_BASE_URL)
 
-# SQLAlchemy setup
-engine = create_engine(DB_URL)
-Session = sessionmaker(bind=engine)
+# Only the tables relevant to the question go into the prompt
+TABLE_DEFINITIONS_TOP_K = int(os.environ.get("TABLE_DEFINITIONS_TOP_K", 8))
+# The table definitions are trimmed (bookkeeping columns, then the least relevant tables) to keep
+# the whole prompt within this many tokens. TABLE_DEFINITIONS_TOKEN_BUDGET is a deprecated alias,
+# read only when PROMPT_TOKEN_BUDGET is not set: the prompt then gets it plus 200 tokens
+PROMPT_TOKEN_BUDGET = int(
+    os.environ.get("PROMPT_TOKEN_BUDGET") or int(os.environ.get("TABLE_DEFINITIONS_TOKEN_BUDGET", 3000)) + 200
+)
+
+# Opt-in cache of run_sql results, shared by every chat in this process
+RESULT_CACHE = ResultCache() if os.environ.get("SQL_RESULT_CACHE", "0") == "1" else None
+
+# Result encoding for run_sql: auto picks the most readable format within the token budget
+SQL_OUTPUT_FORMAT = os.environ.get("SQL_OUTPUT_FORMAT", "auto")
+SQL_RESULT_TOKEN_BUDGET = int(os.environ.get("SQL_RESULT_TOKEN_BUDGET", 2000))
+
+# Estimate the plan of every generated query and reject the ones that would tie up the warehouse
+COST_GUARD = CostGuard() if os.environ.get("SQL_COST_GUARD", "1") == "1" else None
+
+# Group chats that run at once; each one holds a pooled agent team and a Gradio worker thread.
+# Keep CHAT_CONCURRENCY x LLM calls per round under the deployment's rate limit,
+# see `python benchmarks.py load`
+CHAT_CONCURRENCY = int(os.environ.get("CHAT_CONCURRENCY", 4))
+# Admission control: requests waiting beyond this are turned away with "queue full" instead of waiting
+CHAT_QUEUE_SIZE = int(os.environ.get("CHAT_QUEUE_SIZE", 32))
+
+# Opt-in: run literals as bound parameters, so queries of the same shape share one SQL Server plan
+SQL_PARAMETERIZE = os.environ.get("SQL_PARAMETERIZE", "0") == "1"
+
+# "state_machine" follows the Admin -> Engineer -> Sr_Data_Analyst -> Product_Manager workflow and only asks
+# the LLM for the next speaker after the review, "auto" asks it every round
+SPEAKER_SELECTION = os.environ.get("SPEAKER_SELECTION", "state_machine")
+
+# Messages in a row that repeat earlier ones (the same SQL, the same function call, the same request)
+# before the Admin tells the team to move on; the next stall stops the chat. 0 lets a chat run to max_round.
+STALL_PATIENCE = int(os.environ.get("STALL_PATIENCE", 2))
+
+# Seconds a group chat may run before it stops at the next agent reply, 0 for no limit. A chat also
+# stops there when the browser goes away. LLM_TIMEOUT bounds the LLM request in progress.
+CHAT_TIMEOUT = float(os.environ.get("CHAT_TIMEOUT", 0))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 120))
+
+# Chat messages waiting to be shown before the agents wait for the UI
+CHAT_STREAM_BUFFER = int(os.environ.get("CHAT_STREAM_BUFFER", 64))
+
+# Opt-in store of approved question -> SQL plans, e.g. PLAN_CACHE=.cache/plans.sqlite: a rewording of a
+# question the team already answered re-runs the approved SQL instead of a group chat.
+# Decisions are printed and kept in the file's decisions table.
+PLAN_CACHE_PATH = os.environ.get("PLAN_CACHE")
+PLAN_CACHE_THRESHOLD = float(os.environ.get("PLAN_CACHE_THRESHOLD", DEFAULT_THRESHOLD))
+PLAN_CACHE = PlanCache(PLAN_CACHE_PATH, threshold=PLAN_CACHE_THRESHOLD) if PLAN_CACHE_PATH else None
 
 # Constants
 POSTGRES_TABLE_DEFINITIONS_CAP_REF = "TABLE_DEFINITIONS"
 RESPONSE_FORMAT_CAP_REF = "RESPONSE_FORMAT"
 SQL_DELIMITER = "---------"
 
-# Define the function for Gradio
+# Agent prompts and LLM configuration, parsed once at import instead of on every request
+COMPLETION_PROMPT = "If everything looks good, respond with APPROVED"
+COMPANY_INFORMATION = "You work at a multinational company that deals with security and this is a database of alerts from cameras. They are using AI on the edge, and use software to handle some of the alerts. They use 'talk downs' or 'audio warnings' to speak to potential intruders."
+
+USER_PROXY_PROMPT = (
+    "A human admin. Interact with the Product Manager to discuss the plan. Plan execution needs to be approved by this admin."
+    + COMPANY_INFORMATION
+    + COMPLETION_PROMPT
+)
+DATA_ENGINEER_PROMPT = (
+    "A Data Engineer. You follow an approved plan. Generate the initial SQL based on the requirements provided. Send it to the Sr Data Analyst to be executed."
+    + "Some notes are as follows:"
+    + "- The database use SQL Server, so don't use LIMIT, EXTRACT, and remember that 'Order' is a reserved word."
+    + "- Alerts are grouped."
+    + "- These are very large databases, do not return all records."
+    #+ "- When filtering datetimes, use temporary tables to improve performance before applying additional filters."
+    + "- Not all the columns are indexed, so for datetime queries use columns such as DateTimeAlarmClosed and is recorded in UTC."
+    + "- To get SLAs we use Group alarms."
+    + "- SLA for response time (ResponseTime column) is 30 seconds."
+    + "- CARS standards for 'Cratos Alarm Reduction System'."
+    + "- When asked for volumes of alerts, we should be querying the individual alerts rather than group alerts."
+    + "- Group Alerts has multiple alerts in that group. You should consider the count of alerts in each group or individual alerts when asked about number of alerts."
+    + "- Always exclude alarms with alarm type equal to 'ViewSiteInformation', 'ArchivePlayback', 'UserCall'."
+    + "- When asked for the last month, take that to mean the previous calendar month. Same for weeks."
+    + "- 'IsSoftwareHandled' or 'ClosedbyCARS' means that the alarm is handled by a computer (software) rather than a human."
+    + "- CARS is not a user (or specialist as we call them), it is a system."
+    + "- A system is made up of multiple cameras plugged into the same NVR (Network Video Recorder, also called a Transmitter)."
+    + "- A site (an office, or warehouse of example) is made up of one of more systems."
+    + "- We don't care for SLAs if the site isn't live, i.e. CommissionStatus is 1 for Live (although this column is on the group alerts and individual alerts table)."
+    + "- We have 'IsCurrent' for operators, customers, sites, system, and system device (camera)."
+    + "- Use GETUTCDATE() rather than GETDATE() as we are working with UTC datetimes."
+    + "- We have IndividualAlarmsUS_Day which aggregates alerts and SLAs into days which can be more efficient to query."
+    + "- We have GroupAlarmsUS_Day which aggregates group alarms and SLAs into days which can be more efficient to query."
+    + "- When asked about users, or specialists, consider this is IsHuman is true (i.e. not handled by software or CARS)."
+    + "- Sites have reference codes that are used in other systems such as Salesforce."
+    + "- We use reference codes of the format s**-****-xxxx ('s' for site, then 'us' for US, or 'c' for customer, or 'o' for operator)."
+    + "- A customer can have multiple sites."
+    + "- A dealer can have multiple customers."
+    + "- All dealers are operators, but not all operators are dealers."
+    + "- Operators/Specialists sometimes refer to alerts as a 'quad' (because an alert shows 3 images and a video in a quad layout)."
+    + "- Quad alerts consist of AnalyticsDetection (ID of 1), ContactAlarm (ID of 2), TriggerAlarm (ID of 3), MotionDetection (ID of 4), and Loitering (ID of 11)."
+    + "- A hub is a team of people that alerts."
+    + "- An event is an alarm or an alert."
+    + "- Cams is the name of the application that users use."
+    + "- An incident is an alarm (or alarms) of interest."
+    + "- An isolation is instruction for our software to handle the alarm instead of a human."
+    + "- Tables are often suffixed with their region, e.g. 'US', 'EMEA'."
+    + COMPANY_INFORMATION
+    + COMPLETION_PROMPT
+)
+SR_DATA_ANALYST_PROMPT = (
+    "Sr Data Analyst. You follow an approved plan. You run the SQL query, generate the response, summarize the results, and send it to the product manager for final review."
+    + "Some things to consider are:"
+    + "- Users are also known as specialists."
+    + "- An event is an alarm or an alert."
+    + "- An incident is an alarm (or alarms) of interest."
+    + "- An isolation is instruction for our software to handle the alarm instead of a human."
+    + "- We don't care for SLAs if the site isn't live, i.e. CommissionStatus is 1 for Live (although this column is on the group alerts and individual alerts table)."
+    + "- 'CARS - EMLI - Incoming' is not a 'user', it is a computer system."
+    + "- Cams is the name of the application that users use."
+    + "- Users with [Dev] are IT users and might be doing operational work on the system and you should consider ignoring their results."
+    + COMPANY_INFORMATION
+    #+ COMPLETION_PROMPT
+)
+PRODUCT_MANAGER_PROMPT = (
+    "Product Manager. Validate the response to make sure it's correct."
+    + COMPANY_INFORMATION
+    + COMPLETION_PROMPT
+)
+
+autogen_config_list = [
+    {
+        'api_type': 'azure',
+        'model': 'autogen',
+        'api_key': OPENAI_API_KEY,
+        'base_url': OPENAI_BASE_URL,
+        "api_version": "2023-07-01-preview",
+    }
+]
+azureai_config = {
+    #"use_cache": False,
+    "temperature": 0,
+    "config_list": autogen_config_list,
+    "timeout": LLM_TIMEOUT,
+    "functions": [
+        {
+            "name": "run_sql",
+            "description": "Run a SQL query against the SQL database",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "sql": {
+                        "type": "string",
+                        "description": "The SQL query to run",
+                    }
+                },
+                "required": ["sql"],
+            },
+        }
+    ],
+}
+
+TEAM_POOL = get_team_pool(
+    azureai_config,
+    TeamPrompts(
+        user_proxy=USER_PROXY_PROMPT,
+        data_engineer=DATA_ENGINEER_PROMPT,
+        sr_data_analyst=SR_DATA_ANALYST_PROMPT,
+        product_manager=PRODUCT_MANAGER_PROMPT,
+    ),
+    max_round=20,
+    max_idle=CHAT_CONCURRENCY,
+    speaker_selection=SPEAKER_SELECTION,
+    stall_patience=STALL_PATIENCE or None,
+)
+
+def replay_plan(question, db):
+    """The answer from the cached plan of an equivalent question, as gr.Chatbot history; None to ask the team."""
+    decision = PLAN_CACHE.lookup(question)
+    print(decision)
+    plan = decision.plan if decision.decision == "hit" else None
+    if plan is None:
+        return None
+    try:
+        result = db.run_sql(plan.sql)
+    except Exception as e:
+        result = f"Error: {e}"
+    if is_function_error(result):
+        # e.g. a renamed column, the team writes a new plan
+        print(PLAN_CACHE.invalidate(plan, question, result[:200]))
+        return None
+    if is_empty_result(result):
+        # no rows today, the approved summary of the plan's own run would not match
+        return None
+    history = [
+        ["Admin", question],
+        [
+            "Plan cache",
+            f"Same question as {plan.question!r} (similarity {decision.similarity:.2f}), "
+            f"re-running its approved SQL:\n{plan.sql}",
+        ],
+        ["run_sql", result],
+    ]
+    if plan.summary:
+        history.append(["Sr_Data_Analyst", f"Approved summary of {plan.question!r}, from its own run:\n{plan.summary}"])
+    return history
+
+
+# Define the function for Gradio, a generator: each agent message is shown as soon as it is sent
 def respond(prompt):
+    history = []
     try:
+        question = prompt
         prompt = f"Fulfill this database query: {prompt}. "
 
-        with SQLManager() as db:
+        with SQLManager(
+            stream_results=True,
+            result_cache=RESULT_CACHE,
+            cost_guard=COST_GUARD,
+            output_format=SQL_OUTPUT_FORMAT,
+            token_budget=SQL_RESULT_TOKEN_BUDGET,
+            parameterize=SQL_PARAMETERIZE,
+        ) as db:
             db.connect_with_url(DB_URL)
 
-            table_definitions = db.get_table_definitions_for_prompt()
-            prompt = llm.add_cap_ref(
+            if PLAN_CACHE is not None:
+                cached_history = replay_plan(question, db)
+                if cached_history is not None:
+                    yield cached_history
+                    return
+
+            table_definitions = db.get_table_definitions_for_prompt(
+                question=question,
+                top_k=TABLE_DEFINITIONS_TOP_K,
+            )
+            prompt, budget_report = llm.add_cap_ref_within_budget(
                 prompt,
                 f"Use these {POSTGRES_TABLE_DEFINITIONS_CAP_REF} to satisfy the database query.",
                 POSTGRES_TABLE_DEFINITIONS_CAP_REF,
                 table_definitions,
+                PROMPT_TOKEN_BUDGET,
             )
-        autogen_config_list = [
-            {
-                'api_type': 'azure',
-                'model': 'autogen',
-                'api_key': OPENAI_API_KEY,
-                'base_url': OPENAI_BASE_URL,
-                "api_version": "2023-07-01-preview",
-        }
-        ]
-            # Your existing autogen configuration and agent setup code
-            # Replace the following placeholders with your actual implementation
-        azureai_config = {
-            #"use_cache": False,
-            "temperature": 0,
-            "config_list": autogen_config_list,
-            #"request_timeout": 120,
-            "functions": [
-                {
-                    "name": "run_sql",
-                    "description": "Run a SQL query against the SQL database",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "sql": {
-                                "type": "string",
-                                "description": "The SQL query to run",
-                            }
-                        },
-                        "required": ["sql"],
-                    },
-                }
-            ],
-        }
-        function_map = {
-                "run_sql": db.run_sql,
-            }
-
-        # create our terminate msg function
-
-        def is_termination_msg(content):
-            have_content = content.get("content", None) is not None
-            if have_content and "APPROVED" in content["content"]:
-                return True
-            return False
-        COMPLETION_PROMPT = "If everything looks good, respond with APPROVED"
-        COMPANY_INFORMATION = "You work at a multinational company that deals with security and this is a database of alerts from cameras. They are using AI on the edge, and use software to handle some of the alerts. They use 'talk downs' or 'audio warnings' to speak to potential intruders."
-
-        USER_PROXY_PROMPT = (
-            "A human admin. Interact with the Product Manager to discuss the plan. Plan execution needs to be approved by this admin."
-            + COMPANY_INFORMATION
-            + COMPLETION_PROMPT
-        )
-        DATA_ENGINEER_PROMPT = (
-            "A Data Engineer. You follow an approved plan. Generate the initial SQL based on the requirements provided. Send it to the Sr Data Analyst to be executed."
-            + "Some notes are as follows:"
-            + "- The database use SQL Server, so don't use LIMIT, EXTRACT, and remember that 'Order' is a reserved word."
-            + "- Alerts are grouped."
-            + "- These are very large databases, do not return all records."
-            #+ "- When filtering datetimes, use temporary tables to improve performance before applying additional filters."
-            + "- Not all the columns are indexed, so for datetime queries use columns such as DateTimeAlarmClosed and is recorded in UTC."
-            + "- To get SLAs we use Group alarms."
-            + "- SLA for response time (ResponseTime column) is 30 seconds."
-            + "- CARS standards for 'Cratos Alarm Reduction System'."
-            + "- When asked for volumes of alerts, we should be querying the individual alerts rather than group alerts."
-            + "- Group Alerts has multiple alerts in that group. You should consider the count of alerts in each group or individual alerts when asked about number of alerts."
-            + "- Always exclude alarms with alarm type equal to 'ViewSiteInformation', 'ArchivePlayback', 'UserCall'."
-            + "- When asked for the last month, take that to mean the previous calendar month. Same for weeks."
-            + "- 'IsSoftwareHandled' or 'ClosedbyCARS' means that the alarm is handled by a computer (software) rather than a human."
-            + "- CARS is not a user (or specialist as we call them), it is a system."
-            + "- A system is made up of multiple cameras plugged into the same NVR (Network Video Recorder, also called a Transmitter)."
-            + "- A site (an office, or warehouse of example) is made up of one of more systems."
-            + "- We don't care for SLAs if the site isn't live, i.e. CommissionStatus is 1 for Live (although this column is on the group alerts and individual alerts table)."
-            + "- We have 'IsCurrent' for operators, customers, sites, system, and system device (camera)."
-            + "- Use GETUTCDATE() rather than GETDATE() as we are working with UTC datetimes."
-            + "- We have IndividualAlarmsUS_Day which aggregates alerts and SLAs into days which can be more efficient to query."
-            + "- We have GroupAlarmsUS_Day which aggregates group alarms and SLAs into days which can be more efficient to query."
-            + "- When asked about users, or specialists, consider this is IsHuman is true (i.e. not handled by software or CARS)."
-            + "- Sites have reference codes that are used in other systems such as Salesforce."
-            + "- We use reference codes of the format s**-****-xxxx ('s' for site, then 'us' for US, or 'c' for customer, or 'o' for operator)."
-            + "- A customer can have multiple sites."
-            + "- A dealer can have multiple customers."
-            + "- All dealers are operators, but not all operators are dealers."
-            + "- Operators/Specialists sometimes refer to alerts as a 'quad' (because an alert shows 3 images and a video in a quad layout)."
-            + "- Quad alerts consist of AnalyticsDetection (ID of 1), ContactAlarm (ID of 2), TriggerAlarm (ID of 3), MotionDetection (ID of 4), and Loitering (ID of 11)."
-            + "- A hub is a team of people that alerts."
-            + "- An event is an alarm or an alert."
-            + "- Cams is the name of the application that users use."
-            + "- An incident is an alarm (or alarms) of interest."
-            + "- An isolation is instruction for our software to handle the alarm instead of a human."
-            + "- Tables are often suffixed with their region, e.g. 'US', 'EMEA'."
-            + COMPANY_INFORMATION
-            + COMPLETION_PROMPT
-        )
-        SR_DATA_ANALYST_PROMPT = (
-            "Sr Data Analyst. You follow an approved plan. You run the SQL query, generate the response, summarize the results, and send it to the product manager for final review."
-            + "Some things to consider are:"
-            + "- Users are also known as specialists."
-            + "- An event is an alarm or an alert."
-            + "- An incident is an alarm (or alarms) of interest."
-            + "- An isolation is instruction for our software to handle the alarm instead of a human."
-            + "- We don't care for SLAs if the site isn't live, i.e. CommissionStatus is 1 for Live (although this column is on the group alerts and individual alerts table)."
-            + "- 'CARS - EMLI - Incoming' is not a 'user', it is a computer system."
-            + "- Cams is the name of the application that users use."
-            + "- Users with [Dev] are IT users and might be doing operational work on the system and you should consider ignoring their results."
-            + COMPANY_INFORMATION
-            #+ COMPLETION_PROMPT
-        )
-        PRODUCT_MANAGER_PROMPT = (
-            "Product Manager. Validate the response to make sure it's correct."
-            + COMPANY_INFORMATION
-            + COMPLETION_PROMPT
-        )
-# admin user proxy agent - takes in the prompt and manages the group chat
-        user_proxy = autogen.UserProxyAgent(
-            name="Admin",
-            #llm_config=azureai_config,
-            system_message=USER_PROXY_PROMPT,
-            code_execution_config=False,#{"work_dir": "web"},
-            human_input_mode="NEVER",
-            is_termination_msg=is_termination_msg,
-        )
-
-        # data engineer agent - generates the sql query
-        data_engineer = autogen.AssistantAgent(
-            name="Engineer",
-            llm_config=azureai_config,
-            system_message=DATA_ENGINEER_PROMPT,
-            code_execution_config=False,
-            human_input_mode="NEVER",
-            is_termination_msg=is_termination_msg,
-        )
-
-        # sr data analyst agent - run the sql query and generate the response
-        sr_data_analyst = autogen.AssistantAgent(
-            name="Sr_Data_Analyst",
-            llm_config=azureai_config,
-            system_message=SR_DATA_ANALYST_PROMPT,
-            code_execution_config=False,
-            human_input_mode="NEVER",
-            is_termination_msg=is_termination_msg,
-            function_map=function_map,
-        )
-
-        # product manager - validate the response to make sure it's correct
-        product_manager = autogen.AssistantAgent(
-            name="Product_Manager",
-            llm_config=azureai_config,
-            system_message=PRODUCT_MANAGER_PROMPT,
-            code_execution_config=False,
-            human_input_mode="NEVER",
-            is_termination_msg=is_termination_msg,
-        )
-
-            # Create a group chat and initiate the chat.
-        groupchat = autogen.GroupChat(
-            agents=[user_proxy, data_engineer, sr_data_analyst, product_manager],
-            messages=[],
-            max_round=20,
-        )
-        manager = autogen.GroupChatManager(groupchat=groupchat, llm_config=azureai_config)
-        user_proxy.initiate_chat(manager, clear_history=False, message=prompt)
-        chat_history = manager.chat_messages.values()
-        print(type(chat_history))
-        print(chat_history)
-
-
-        # Convert the chat history to the correct format  
-        # This assumes that chat_history is a list of dictionaries with keys 'name' and 'message'  
-        formatted_response = [
-    [message.get('name'), message.get('content')]
-    for messages in chat_history  # chat_history is dict_values containing lists
-    for message in messages  # each item in chat_history is a list of messages
-    if 'content' in message  # make sure 'content' key exists in the message
-]
+            if budget_report.trimmed:
+                print(budget_report)
 
+        # checked by every agent before it replies, see modules/cancellation.py
+        cancel_token = CancelToken(CHAT_TIMEOUT or None)
 
+        def run_chat():
+            # a reset team from the pool, built on first use and never shared by two requests at once
+            with cancel_token.active(), TEAM_POOL.acquire({"run_sql": db.run_sql}) as team:
+                # spans to TRACE_FILE when set, summarize with `python -m modules.tracing <file>`
+                with tracer.chat(question=question, speaker_selection=SPEAKER_SELECTION):
+                    team.initiate_chat(prompt, listener=stream.listener)
+                plan = team.approved_plan() if PLAN_CACHE is not None else None
+                if plan is not None:
+                    print(PLAN_CACHE.store(question, *plan))
+                selection_stats = team.selection_stats()
+                if selection_stats:
+                    print(selection_stats)
+                stall_report = team.stall_report()
+                if stall_report and stall_report["stalls"]:
+                    print(stall_report)
 
-        return formatted_response  
+        # the chat runs on its own thread, its messages come back through a bounded queue
+        stream = ChatStream(CHAT_STREAM_BUFFER)
+        try:
+            for message in stream.run(run_chat):
+                # [name, content], the format of gr.Chatbot
+                history.append(message)
+                yield history
+        finally:
+            # the client went away or the chat failed: the team stops at its next reply instead of max_round
+            cancel_token.cancel("cancelled")
+        print(history)
     except Exception as e:  
         # Return the error message as part of the response to help with debugging  
         error_message = f"An error occurred: {e}"  
         print(error_message)  # Print the error to the console for debugging  
-        return [["Error", error_message]]  # Return the error in a format compatible with gr.Chatbot  
+        yield history + [["Error", error_message]]  # Keep what was shown, in a format compatible with gr.Chatbot
 
 # Initialize Gradio components
 txt_input = gr.Textbox(
@@ -248,5 +322,9 @@ iface = gr.Interface(
     live=False  # Disable live mode to require explicit submission  
 )  
   
+# each submission gets its own SQLManager and its own agent team, so chats can run side by side
+iface.queue(default_concurrency_limit=CHAT_CONCURRENCY, max_size=CHAT_QUEUE_SIZE)
+
 if __name__ == "__main__":  
-    iface.launch()  
+    # sync handlers run on Gradio's thread pool, 40 threads unless told otherwise
+    iface.launch(max_threads=max(40, CHAT_CONCURRENCY))  
@@ -0,0 +1,211 @@
+"""
+Purpose:
+    Async counterpart of SQLManager built on SQLAlchemy's AsyncEngine.
+    A chat session waiting on the database awaits instead of holding a Gradio worker thread.
+"""
+import asyncio
+import json
+import threading
+import weakref
+from functools import partial
+from typing import Dict
+
+from sqlalchemy import MetaData, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from modules.cost_guard import QueryRejected
+from modules.db import DEFAULT_MAX_BYTES, DEFAULT_MAX_ROWS, FETCH_SIZE, SCHEMAS, BoundedRowEncoder, datetime_handler
+from modules.engine_registry import registry
+from modules.parameterize import parameterize, template_stats
+from modules.row_limit import DEFAULT_ROW_LIMIT, limit_rows
+from modules.schema_cache import schema_cache
+from modules.table_index import DEFAULT_TOP_K, select_table_definitions
+
+# sync driver -> async driver for the same backend
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mssql": "mssql+aioodbc",
+    "mysql": "mysql+aiomysql",
+}
+
+_engines: Dict[str, AsyncEngine] = {}
+_sessionmakers: Dict[str, async_sessionmaker] = {}
+_engines_lock = threading.Lock()
+
+# coroutines reflecting one engine take turns, so its schemas are reflected once; an asyncio.Lock
+# only works on the event loop it was first used on, hence one per loop and engine
+_schema_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Lock]]"
+_schema_locks = weakref.WeakKeyDictionary()
+
+
+def to_async_url(url) -> str:
+    """
+    Swaps the driver of a sync URL for its async counterpart.
+    Example
+        to_async_url('mssql+pyodbc://user:pw@host/db?driver=ODBC+Driver+18+for+SQL+Server')
+        returns 'mssql+aioodbc://user:pw@host/db?driver=ODBC+Driver+18+for+SQL+Server'
+    """
+    url = make_url(url)
+    if url.get_dialect().is_async:
+        return url.render_as_string(hide_password=False)
+    drivername = ASYNC_DRIVERS.get(url.get_backend_name())
+    if drivername is None:
+        raise ValueError(f"No async driver known for {url.get_backend_name()}")
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def _schema_lock(url: str) -> asyncio.Lock:
+    with _engines_lock:
+        locks = _schema_locks.setdefault(asyncio.get_running_loop(), {})
+        return locks.setdefault(url, asyncio.Lock())
+
+
+def get_async_engine(url) -> AsyncEngine:
+    url = to_async_url(url)
+    with _engines_lock:
+        if url not in _engines:
+            # same pool settings as the sync engines, see modules/engine_registry.py
+            _engines[url] = create_async_engine(url, **registry.engine_options(url))
+            _sessionmakers[url] = async_sessionmaker(bind=_engines[url])
+        return _engines[url]
+
+
+class AsyncSQLManager:
+    """Same surface as SQLManager with every database call awaited."""
+
+    def __init__(
+        self,
+        stream_results=False,
+        max_rows=DEFAULT_MAX_ROWS,
+        max_bytes=DEFAULT_MAX_BYTES,
+        result_cache=None,
+        cost_guard=None,
+        output_format=None,
+        token_budget=None,
+        schemas=None,
+        row_limit=DEFAULT_ROW_LIMIT,
+        parameterize=False,
+    ):
+        self.schemas = list(schemas or SCHEMAS)
+        # TOP / LIMIT added to queries without one, None leaves queries unlimited
+        self.row_limit = row_limit
+        # run literals in WHERE / ON / HAVING as bound parameters so the server reuses plans
+        self.parameterize = parameterize
+        self.stream_results = stream_results
+        self.output_format = output_format
+        self.token_budget = token_budget
+        self.last_token_counts = None
+        self.result_cache = result_cache
+        self.cost_guard = cost_guard
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.url = None
+        self.engine = None
+        self.Session = None
+        self.metadata = MetaData()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # sessions are opened per call, there is nothing held between calls
+        pass
+
+    async def connect_with_url(self, url):
+        self.url = to_async_url(url)
+        self.engine = get_async_engine(self.url)
+        self.Session = _sessionmakers[self.url]
+
+    async def get(self, table_name, _id):
+        select_stmt = text(f"SELECT * FROM {table_name} WHERE id = :id")
+        async with self.Session() as session:
+            result = await session.execute(select_stmt, {'id': _id})
+            return result.fetchone()
+
+    async def get_all(self, table_name):
+        select_all_stmt = text(f"SELECT * FROM {table_name}")
+        async with self.Session() as session:
+            result = await session.execute(select_all_stmt)
+            return result.fetchall()
+
+    async def run_sql(self, sql) -> str:
+        try:
+            # estimated as written, see SQLManager.run_sql
+            execute = partial(self._run_sql, estimate_sql=sql)
+            sql = limit_rows(sql, self.engine.dialect.name, self.row_limit)
+            if self.result_cache is not None:
+                scope = (
+                    self.url,
+                    self.stream_results,
+                    self.max_rows,
+                    self.max_bytes,
+                    self.output_format,
+                    self.token_budget,
+                    self.row_limit,
+                    self.parameterize,
+                )
+                return await self.result_cache.aget_or_execute(scope, sql, execute)
+            return await execute(sql)
+        except QueryRejected as e:
+            return e.to_json()
+
+    async def _check_cost(self, session, sql):
+        if self.cost_guard is not None:
+            await session.run_sync(lambda sync_session: self.cost_guard.check(sync_session.connection(), sql))
+
+    def _statement(self, sql):
+        if not self.parameterize:
+            return text(sql), {}
+        query = parameterize(sql)
+        template_stats.record(query.template)
+        return query.clause(), query.params
+
+    async def _run_sql(self, sql, estimate_sql=None) -> str:
+        if self.stream_results or self.output_format is not None:
+            return await self.run_sql_streaming(sql, estimate_sql=estimate_sql)
+
+        async with self.Session() as session:
+            await self._check_cost(session, estimate_sql or sql)
+            result = await session.execute(*self._statement(sql))
+            columns = result.keys()
+            rows = result.fetchall()
+        list_of_dicts = [dict(zip(columns, row)) for row in rows]
+        return json.dumps(list_of_dicts, indent=4, default=datetime_handler)
+
+    async def run_sql_streaming(self, sql, max_rows=None, max_bytes=None, estimate_sql=None) -> str:
+        max_rows = self.max_rows if max_rows is None else max_rows
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        async with self.Session() as session:
+            await self._check_cost(session, estimate_sql or sql)
+            result = await session.stream(*self._statement(sql), execution_options={"max_row_buffer": FETCH_SIZE})
+            encoder = BoundedRowEncoder(
+                result.keys(), max_rows, max_bytes, self.output_format or "json", self.token_budget
+            )
+            async for rows in result.partitions(FETCH_SIZE):
+                if not all(encoder.add(row) for row in rows):
+                    break
+            await result.close()
+        json_result = encoder.getvalue()
+        self.last_token_counts = encoder.token_counts
+        return json_result
+
+    async def get_table_definitions_for_prompt(self, question=None, token_budget=None, top_k=DEFAULT_TOP_K):
+        async with _schema_lock(self.url):
+            async with self.engine.connect() as connection:
+                entry = await connection.run_sync(self._cached_schema)
+        self.metadata = entry.metadata
+        if question is None and token_budget is None:
+            return entry.text
+        return select_table_definitions(entry, question, token_budget, top_k)
+
+    def _cached_schema(self, sync_connection):
+        # one connection here, so the schemas are reflected one after another
+        def reflect(metadata, tables_by_schema):
+            for schema, only in tables_by_schema.items():
+                metadata.reflect(bind=sync_connection, schema=schema, only=only)
+
+        # this runs on the event loop, it must not wait for a sync SQLManager holding the cache's lock
+        return schema_cache.get_unlocked(sync_connection, self.schemas, reflect)
@@ -0,0 +1,87 @@
+"""
+Purpose:
+    Cooperative timeout and cancellation of agent chats. Each agent checks the chat's CancelToken
+    before every reply, so a cancelled chat stops at the next round instead of being killed by a
+    line tracer; the LLM's HTTP timeout bounds how long the round in progress can still take.
+    Example
+        token = CancelToken(timeout=60)
+        with token.active():
+            userproxy.initiate_chat(assistant, message=question)  # raises ChatCancelled after 60 s
+        # from another thread
+        token.cancel("the client went away")
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+from autogen import Agent
+
+# the CancelToken of the chat running on this thread, see CancelToken.active
+_current: ContextVar = ContextVar("cancel_token", default=None)
+
+
+class ChatCancelled(Exception):
+    """Raised at the checkpoint after a chat was cancelled or ran out of time."""
+
+
+class CancelToken:
+    """Cancellation flag of one chat, set by cancel() or by the deadline passing, safe to share between threads."""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("timed out")
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline, None without one."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self.cancelled:
+            raise ChatCancelled(f"chat {self.reason}")
+
+    @contextmanager
+    def active(self):
+        """Makes this the token the checkpoints of agents running on this thread check."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+
+def checkpoint():
+    """Raises ChatCancelled when the chat running on this thread was cancelled."""
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+def checkpoint_reply(recipient, messages=None, sender=None, config=None):
+    # never replies, only stops the chat before the next reply
+    checkpoint()
+    return False, None
+
+
+def install_checkpoints(agents: Iterable):
+    """Checks the current CancelToken first thing in each reply of each agent, once."""
+    for agent in agents:
+        if getattr(agent, "_cancellable", False):
+            continue
+        agent._cancellable = True
+        agent.register_reply([Agent, None], checkpoint_reply)
@@ -0,0 +1,90 @@
+"""
+Purpose:
+    Hand group chat messages from the thread running the chat to a generator feeding gr.Chatbot,
+    through a bounded queue, so each agent message shows up as soon as the manager receives it.
+    Example
+        stream = ChatStream()
+        for message in stream.run(lambda: team.initiate_chat(prompt, listener=stream.listener)):
+            history.append(message)
+            yield history
+"""
+import queue
+import threading
+from typing import Callable, Dict, Iterator, List, Optional
+
+# messages waiting for the UI before the chat thread waits for it in turn
+DEFAULT_MAX_SIZE = 64
+# how often a blocked put checks whether the UI went away
+POLL_SECONDS = 0.5
+
+_DONE = object()
+
+
+def chatbot_message(message: Dict, sender_name: str) -> List[Optional[str]]:
+    """[name, content] of one chat message, as shown by gr.Chatbot."""
+    if "function_call" in message:
+        # a dict, or the client's FunctionCall model when it comes straight from the LLM reply
+        function_call = dict(message["function_call"])
+        return [sender_name, f"Suggested function call: {function_call.get('name')}({function_call.get('arguments')})"]
+    if message.get("role") == "function":
+        # a function result is named after the function, e.g. run_sql
+        return [message.get("name", sender_name), message.get("content")]
+    return [sender_name, message.get("content")]
+
+
+class ChatStream:
+    """
+    A bounded queue between one producer thread and one consumer. A full queue slows the chat
+    down to the pace of the UI; once the consumer is closed, puts are dropped so the chat can finish.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self._queue = queue.Queue(maxsize=max_size)
+        self._closed = threading.Event()
+        self.dropped = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+        self.dropped += 1
+
+    def listener(self, message: Dict, sender):
+        """Manager listener, see AgentTeam.initiate_chat."""
+        self.put(chatbot_message(message, sender.name))
+
+    def close(self):
+        self._closed.set()
+
+    def run(self, target: Callable[[], None]) -> Iterator:
+        """
+        Runs target on a new thread and yields what it puts until it returns.
+        An exception raised by target is raised here once the messages before it are yielded.
+        """
+
+        def produce():
+            try:
+                target()
+            except BaseException as error:
+                self.put(error)
+            finally:
+                self.put(_DONE)
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
@@ -0,0 +1,170 @@
+"""
+Purpose:
+    Persistent cache of LLM completions in a local SQLite file, shared by every process on the host.
+    Keyed by a hash of the model and the canonical request, so the same prompt sent again
+    (e.g. a table summary built with add_cap_ref) is answered from disk instead of the LLM.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# a hit only rewrites its access time when it is older than this, so warm reads stay reads
+TOUCH_INTERVAL = 60.0
+# eviction frees space down to this share of max_bytes, so the next puts do not evict again
+EVICT_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed);
+"""
+
+
+def canonical_request(model: str, messages: List[Dict[str, Any]], **options) -> str:
+    """
+    The request as canonical JSON: line endings and trailing whitespace in the messages do not
+    change the answer, so they do not change the key either.
+    """
+    messages = [
+        {**message, "content": "\n".join(line.rstrip() for line in message["content"].splitlines()).strip()}
+        if isinstance(message.get("content"), str)
+        else message
+        for message in messages
+    ]
+    return json.dumps(
+        {"model": model, "messages": messages, "options": options},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+def cache_key(model: str, messages: List[Dict[str, Any]], **options) -> str:
+    return hashlib.sha256(canonical_request(model, messages, **options).encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Content-addressed completion cache, evicting least recently used entries once the file
+    holds more than max_bytes of completions.
+    WAL mode lets readers in other processes carry on while one process writes;
+    each thread uses its own connection.
+    Example
+        cache = CompletionCache('.cache/completions.sqlite')
+        cache.get_or_call('autogen', messages, lambda: llm_call(messages))
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES, touch_interval: float = TOUCH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # autocommit, every statement is its own short transaction
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # with WAL, NORMAL only syncs at checkpoints: a crash can lose the last completions, never corrupt
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    def get(self, model: str, messages: List[Dict[str, Any]], **options) -> Optional[str]:
+        key = cache_key(model, messages, **options)
+        connection = self._connection()
+        row = connection.execute("SELECT value, accessed FROM completions WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        value, accessed = row
+        now = time.time()
+        if now - accessed > self.touch_interval:
+            connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+        return value
+
+    def put(self, model: str, messages: List[Dict[str, Any]], value: str, **options):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        key = cache_key(model, messages, **options)
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO completions (key, model, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, value, size, now, now),
+        )
+        self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection):
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * EVICT_TO)
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes do not evict the same rows
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            freed = 0
+            keys = []
+            for key, size in connection.execute("SELECT key, size FROM completions ORDER BY accessed"):
+                if freed >= target:
+                    break
+                keys.append((key,))
+                freed += size
+            connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self.evictions += len(keys)
+
+    def get_or_call(self, model: str, messages: List[Dict[str, Any]], call, **options) -> str:
+        """The cached completion, or call() stored for next time. Empty completions are not stored."""
+        value = self.get(model, messages, **options)
+        if value is None:
+            value = call()
+            if value:
+                self.put(model, messages, value, **options)
+        return value
+
+    def clear(self):
+        self._connection().execute("DELETE FROM completions")
+
+    def stats(self) -> Dict[str, Any]:
+        entries, size = (
+            self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        )
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+            }
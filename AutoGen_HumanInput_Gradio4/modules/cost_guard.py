@@ -0,0 +1,221 @@
+"""
+Purpose:
+    Estimate the cost of LLM generated SQL before running it, and reject queries that would
+    tie up the warehouse. Uses SHOWPLAN on SQL Server, EXPLAIN on PostgreSQL and
+    EXPLAIN QUERY PLAN plus table sizes on SQLite, the local stand-in.
+"""
+import json
+import os
+import xml.etree.ElementTree as ET
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from modules.sql_utils import tokenize, words
+
+# SQL Server subtree cost and PostgreSQL cost units are not comparable, so each dialect has its own limit
+DEFAULT_MAX_COST = {
+    "mssql": float(os.environ.get("SQL_GUARD_MAX_COST_MSSQL", 500)),
+    "postgresql": float(os.environ.get("SQL_GUARD_MAX_COST_POSTGRESQL", 1_000_000)),
+    # rows read by full scans
+    "sqlite": float(os.environ.get("SQL_GUARD_MAX_COST_SQLITE", 1_000_000)),
+}
+DEFAULT_MAX_ROWS = float(os.environ.get("SQL_GUARD_MAX_ROWS", 100_000))
+
+
+class QueryRejected(Exception):
+    """Raised instead of running a query; to_json() is what the agent gets back from run_sql."""
+
+    def __init__(self, reason: str, message: str, **details):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.details = details
+
+    def to_dict(self):
+        return {"error": "query_rejected", "reason": self.reason, "message": self.message, **self.details}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+@dataclass
+class PlanEstimate:
+    rows: Optional[float]
+    cost: Optional[float]
+    source: str
+
+
+# ------------------ estimators ------------------
+
+# words that can follow a table name but are not an alias
+SQL_CLAUSE_WORDS = set(
+    "WHERE JOIN INNER LEFT RIGHT FULL CROSS ON GROUP ORDER HAVING LIMIT UNION EXCEPT INTERSECT".split()
+)
+AGGREGATE_WORDS = {"GROUP", "COUNT", "SUM", "AVG", "MIN", "MAX", "DISTINCT"}
+
+
+def estimate_mssql(connection, sql) -> PlanEstimate:
+    connection.exec_driver_sql("SET SHOWPLAN_XML ON")
+    try:
+        plan = connection.exec_driver_sql(sql).scalar()
+    finally:
+        connection.exec_driver_sql("SET SHOWPLAN_XML OFF")
+
+    rows, cost = None, None
+    for element in ET.fromstring(plan).iter():
+        if element.tag.endswith("StmtSimple"):
+            if "StatementEstRows" in element.attrib:
+                rows = max(rows or 0.0, float(element.attrib["StatementEstRows"]))
+            if "StatementSubTreeCost" in element.attrib:
+                cost = max(cost or 0.0, float(element.attrib["StatementSubTreeCost"]))
+    return PlanEstimate(rows=rows, cost=cost, source="showplan")
+
+
+def estimate_postgresql(connection, sql) -> PlanEstimate:
+    plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]["Plan"]
+    return PlanEstimate(rows=float(top["Plan Rows"]), cost=float(top["Total Cost"]), source="explain")
+
+
+def _sqlite_table_aliases(sql):
+    """{alias or table name: table} for every table after FROM or JOIN."""
+    tokens = tokenize(sql)
+    aliases = {}
+    for i, (kind, value) in enumerate(tokens):
+        if kind != "word" or value.upper() not in ("FROM", "JOIN"):
+            continue
+        j = i + 1
+        parts = []
+        while j < len(tokens) and tokens[j].kind in ("word", "qident"):
+            parts.append(tokens[j].value.strip('[]"`'))
+            if j + 1 < len(tokens) and tokens[j + 1].value == ".":
+                j += 2
+                continue
+            j += 1
+            break
+        if not parts:
+            continue
+        table = ".".join(parts)
+        aliases[parts[-1]] = table
+        if j < len(tokens) and tokens[j].kind == "word" and tokens[j].value.upper() == "AS":
+            j += 1
+        if j < len(tokens) and tokens[j].kind in ("word", "qident") and tokens[j].value.upper() not in SQL_CLAUSE_WORDS:
+            aliases[tokens[j].value.strip('[]"`')] = table
+    return aliases
+
+
+def _sqlite_row_count(connection, table) -> Optional[int]:
+    """
+    Rows of a table from sqlite_stat1 (kept by ANALYZE), else its largest rowid, both without a scan.
+    None for names that are not tables, e.g. the alias of a subquery or a CTE.
+    """
+    schema, _, name = table.rpartition(".")
+    prefix = f'"{schema}".' if schema else ""
+    exists = connection.execute(
+        text(f"SELECT 1 FROM {prefix}sqlite_master WHERE type = 'table' AND name = :name COLLATE NOCASE"),
+        {"name": name},
+    ).first()
+    if exists is None:
+        return None
+    try:
+        # the first number of a stat row is the table's row count, also on the rows of its indexes
+        stat = connection.execute(
+            text(f"SELECT stat FROM {prefix}sqlite_stat1 WHERE tbl = :name COLLATE NOCASE ORDER BY idx IS NOT NULL"),
+            {"name": name},
+        ).scalar()
+    except SQLAlchemyError:
+        # no ANALYZE yet
+        stat = None
+    if stat:
+        return int(stat.split()[0])
+    # rowids are handed out in order, so the largest is an upper bound found through the b-tree
+    return connection.execute(text(f'SELECT COALESCE(MAX(rowid), 0) FROM {prefix}"{name}"')).scalar()
+
+
+def estimate_sqlite(connection, sql) -> PlanEstimate:
+    # sqlite has no cost model in its plan output: add up the rows behind every full scan instead
+    aliases = _sqlite_table_aliases(sql)
+    scanned = []
+    for _, _, _, detail in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql):
+        step = detail.split()
+        if len(step) >= 2 and step[0] == "SCAN" and step[1] not in ("CONSTANT", "SUBQUERY"):
+            rows = _sqlite_row_count(connection, aliases.get(step[1], step[1]))
+            if rows is not None:
+                scanned.append(rows)
+    if not scanned:
+        return PlanEstimate(rows=None, cost=0.0, source="sqlite")
+    # rows read is only a fair guess of rows returned when nothing is aggregated
+    tokens = tokenize(sql)
+    aggregated = any(word in AGGREGATE_WORDS for word in words(tokens))
+    rows = None if aggregated else float(max(scanned))
+    for i, (kind, value) in enumerate(tokens[:-1]):
+        if rows is not None and kind == "word" and value.upper() == "LIMIT" and tokens[i + 1].kind == "number":
+            rows = min(rows, float(tokens[i + 1].value))
+    return PlanEstimate(rows=rows, cost=float(sum(scanned)), source="sqlite")
+
+
+ESTIMATORS = {
+    "mssql": estimate_mssql,
+    "postgresql": estimate_postgresql,
+    "sqlite": estimate_sqlite,
+}
+
+
+# ------------------ guard ------------------
+
+
+class CostGuard:
+    """
+    Checks the estimated plan of a query against max_rows and a per-dialect max_cost.
+    Dialects without an estimator, and queries the estimator fails on, are let through:
+    a broken query fails when it runs, with the database's own error for the agent.
+    """
+
+    def __init__(self, max_rows: Optional[float] = DEFAULT_MAX_ROWS, max_cost: Optional[dict] = None):
+        self.max_rows = max_rows
+        self.max_cost = {**DEFAULT_MAX_COST, **(max_cost or {})}
+        self.checked = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def estimate(self, connection, sql) -> Optional[PlanEstimate]:
+        estimator = ESTIMATORS.get(connection.dialect.name)
+        if estimator is None:
+            return None
+        try:
+            return estimator(connection, sql)
+        except (SQLAlchemyError, ET.ParseError, KeyError, IndexError, TypeError, ValueError) as e:
+            self.failed += 1
+            return PlanEstimate(rows=None, cost=None, source=f"unknown: {type(e).__name__}")
+
+    def check(self, connection, sql) -> Optional[PlanEstimate]:
+        """Raises QueryRejected when the estimate is over a limit, returns the estimate otherwise."""
+        estimate = self.estimate(connection, sql)
+        self.checked += 1
+        if estimate is None:
+            return None
+
+        max_cost = self.max_cost.get(connection.dialect.name)
+        if max_cost is not None and estimate.cost is not None and estimate.cost > max_cost:
+            self.rejected += 1
+            raise QueryRejected(
+                "estimated_cost_exceeded",
+                "The query is too expensive to run. Filter on an indexed column such as DateTimeAlarmClosed, "
+                "narrow the date range, or query the _Day aggregate tables instead.",
+                limit=max_cost,
+                **asdict(estimate),
+            )
+        if self.max_rows is not None and estimate.rows is not None and estimate.rows > self.max_rows:
+            self.rejected += 1
+            raise QueryRejected(
+                "estimated_rows_exceeded",
+                "The query would return too many rows. Aggregate the results or add TOP to return fewer rows.",
+                limit=self.max_rows,
+                **asdict(estimate),
+            )
+        return estimate
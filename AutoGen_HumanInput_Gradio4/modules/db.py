@@ -1,29 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import json
+import os
+import threading
 import sqlalchemy
-from sqlalchemy import create_engine, text, MetaData, Table, select, inspect
+from sqlalchemy import and_, create_engine, or_, text, MetaData, Table, select, inspect
 from sqlalchemy.orm import sessionmaker
+from modules.cost_guard import QueryRejected
+from modules.engine_registry import registry
+from modules.formats import choose_format, estimate_token_counts, get_format, shorten_row
+from modules.parameterize import parameterize, template_stats
+from modules.row_limit import DEFAULT_ROW_LIMIT, limit_rows
+from modules.schema_cache import schema_cache
+from modules.table_index import DEFAULT_TOP_K, select_table_definitions
+
+# schemas exposed to the agents, e.g. DB_SCHEMAS=dim,fact,dbo
+SCHEMAS = [schema.strip() for schema in os.environ.get("DB_SCHEMAS", "dim,fact,dbo").split(",") if schema.strip()]
+# ids per IN (...) in get_many, well under SQL Server's 2100 parameter limit
+ID_CHUNK_SIZE = 500
+# rows per keyset page in iter_all
+PAGE_SIZE = 1000
+# schemas are reflected concurrently, each on its own pooled connection
+REFLECTION_WORKERS = int(os.environ.get("DB_REFLECTION_WORKERS", 4))
+
+# bounds for streamed run_sql results, the LLM never needs more than this
+DEFAULT_MAX_ROWS = 500
+DEFAULT_MAX_BYTES = 64 * 1024
+FETCH_SIZE = 100
+
+
+def datetime_handler(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+class BoundedRowEncoder:
+    """
+    Encodes rows one at a time in output_format until max_rows or max_bytes is reached.
+    With output_format='auto' the shortened rows are kept and the most readable format that fits
+    token_budget, by an estimate from a sample of the rows, is picked and encoded at the end.
+    Shared by the sync and async streaming paths.
+    """
+
+    def __init__(self, columns, max_rows, max_bytes, output_format="json", token_budget=None):
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.output_format = output_format
+        self.token_budget = token_budget
+        self.format = get_format("json" if output_format == "auto" else output_format, self.columns)
+        # encoded rows, or in 'auto' mode the shortened values until the format is picked; the byte
+        # budget is counted in JSON then, the largest of the formats
+        self.pieces = []
+        self.used_bytes = 2  # the surrounding brackets
+        self.truncated = False
+        self.token_counts = None
+
+    def add(self, row) -> bool:
+        """Encodes row, returns False once the budget is spent and reading should stop."""
+        if len(self.pieces) >= self.max_rows:
+            self.truncated = True
+            return False
+        values = shorten_row(row)
+        piece, row_bytes = self.format.encode_row(values)
+        if self.used_bytes + row_bytes > self.max_bytes:
+            self.truncated = True
+            return False
+        self.pieces.append(values if self.output_format == "auto" else piece)
+        self.used_bytes += row_bytes
+        return True
+
+    def getvalue(self) -> str:
+        if self.output_format == "auto":
+            # estimated from a sample of the rows, only the chosen format encodes all of them
+            self.token_counts = estimate_token_counts(self.columns, self.pieces)
+            chosen = choose_format(self.token_counts, self.token_budget)
+            result = get_format(chosen, self.columns).render_rows(self.pieces)
+        else:
+            result = self.format.render(self.pieces)
+        if self.truncated:
+            result += f"\n-- truncated after {len(self.pieces)} rows, add filters or aggregate to see the rest"
+        return result
+
 
 class SQLManager:
-    def __init__(self):
+    def __init__(
+        self,
+        stream_results=False,
+        max_rows=DEFAULT_MAX_ROWS,
+        max_bytes=DEFAULT_MAX_BYTES,
+        result_cache=None,
+        cost_guard=None,
+        output_format=None,
+        token_budget=None,
+        schemas=None,
+        row_limit=DEFAULT_ROW_LIMIT,
+        parameterize=False,
+    ):
+        self.schemas = list(schemas or SCHEMAS)
+        # TOP / LIMIT added to queries without one, None leaves queries unlimited
+        self.row_limit = row_limit
+        # run literals in WHERE / ON / HAVING as bound parameters so the server reuses plans
+        self.parameterize = parameterize
+        self.stream_results = stream_results
+        # None keeps the original pretty-printed JSON, see modules/formats.py for the others
+        self.output_format = output_format
+        self.token_budget = token_budget
+        self.last_token_counts = None
+        self.result_cache = result_cache
+        self.cost_guard = cost_guard
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.url = None
         self.engine = None
         self.Session = None
-        self.session = None
         self.metadata = MetaData()
+        self._inspector = None
+        # tables reflected on first access by get_table
+        self._lazy_metadata = MetaData()
+        self._lazy_lock = threading.Lock()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            self.session.close()
+        # sessions are opened per call, there is nothing held between calls
+        pass
 
     def connect_with_url(self, url):
         #try:
-            self.engine = create_engine(url)
-            self.Session = sessionmaker(bind=self.engine)
-            self.session = self.Session()
-            self.metadata.reflect(bind=self.engine)
+            # engines and their connection pools are shared process-wide, see modules/engine_registry.py
+            self.url = url
+            self.engine = registry.get_engine(url)
+            self.Session = registry.get_sessionmaker(url)
+            # nothing is reflected here: schemas are reflected by get_table_definitions_for_prompt
+            # and single tables on first access by get_table
+            self._inspector = None
         #except sqlalchemy.exc.InterfaceError as e:
         #    print("An error occurred while connecting to the database: ", str(e))
 
@@ -50,31 +164,171 @@ class SQLManager:
 
     def get(self, table_name, _id):
         select_stmt = text(f"SELECT * FROM {table_name} WHERE id = :id")
-        result = self.session.execute(select_stmt, {'id': _id})
-        return result.fetchone()
+        with registry.session_scope(self.url) as session:
+            result = session.execute(select_stmt, {'id': _id})
+            return result.fetchone()
 
     def get_all(self, table_name):
         select_all_stmt = text(f"SELECT * FROM {table_name}")
-        result = self.session.execute(select_all_stmt)
-        return result.fetchall()
+        with registry.session_scope(self.url) as session:
+            result = session.execute(select_all_stmt)
+            return result.fetchall()
+
+    @staticmethod
+    def _id_column(table):
+        primary_key = list(table.primary_key.columns)
+        if len(primary_key) == 1:
+            return primary_key[0]
+        for column in table.columns:
+            if column.name.lower() == "id":
+                return column
+        raise ValueError(f"{table.fullname} has no single-column primary key or id column")
+
+    def get_many(self, table_name, ids, chunk_size=ID_CHUNK_SIZE):
+        """
+        Rows of a reflected table by id, one round trip per chunk_size ids.
+        Returns {id: row}, ids that do not exist are left out.
+        Example
+            get_many('dim.Site', [1, 2, 3]) -> {1: (1, 'site 1', ...), 2: ..., 3: ...}
+        """
+        table = self.get_table(table_name)
+        id_column = self._id_column(table)
+        ids = list(dict.fromkeys(ids))
+        rows = {}
+        with registry.session_scope(self.url) as session:
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start : start + chunk_size]
+                for row in session.execute(select(table).where(id_column.in_(chunk))):
+                    rows[row._mapping[id_column]] = row
+        return rows
+
+    def iter_all(self, table_name, page_size=PAGE_SIZE, order_by=None):
+        """
+        Yields every row of a reflected table, page_size rows per round trip.
+        Pages follow the last key seen (keyset pagination) instead of OFFSET, so each page is
+        an index seek and only one page is held in memory. order_by is a list of column names,
+        the primary key (or the id column of a table without one) is appended to make the order unique.
+        Raises ValueError when the key cannot be made unique or has a nullable column:
+        a repeated or NULL key would skip rows between pages.
+        """
+        table = self.get_table(table_name)
+        key = [table.c[name] for name in (order_by or [])]
+        unique = list(table.primary_key.columns) or [self._id_column(table)]
+        key += [column for column in unique if column not in key]
+        nullable = [column.name for column in key if column.nullable and not column.primary_key]
+        if nullable:
+            raise ValueError(f"iter_all cannot page {table.fullname} by nullable columns {nullable}")
+
+        last = None
+        while True:
+            stmt = select(table).order_by(*key).limit(page_size)
+            if last is not None:
+                stmt = stmt.where(self._after(key, last))
+            with registry.session_scope(self.url) as session:
+                page = session.execute(stmt).fetchall()
+            yield from page
+            if len(page) < page_size:
+                return
+            last = [page[-1]._mapping[column] for column in key]
+
+    @staticmethod
+    def _after(key, values):
+        # (a, b) > (x, y) spelled out, row value comparison is not supported on SQL Server
+        clauses = []
+        for i, column in enumerate(key):
+            equal = [key[j] == values[j] for j in range(i)]
+            clauses.append(and_(*equal, column > values[i]))
+        return or_(*clauses)
 
     # def run_sql(self, sql):
     #     self.cur.execute(sql)
     #     return self.cur.fetchall()
 
     def run_sql(self, sql) -> str:
-        result = self.session.execute(text(sql))
-        columns = result.keys()
-        rows = result.fetchall()
+        try:
+            # the cost guard estimates the query as written: under the added TOP / LIMIT every
+            # plan would return at most row_limit rows, and the rows limit could never trip
+            execute = partial(self._run_sql, estimate_sql=sql)
+            sql = limit_rows(sql, self.engine.dialect.name, self.row_limit)
+            if self.result_cache is not None:
+                # the same SQL gives a different answer on another database, with another row cap or output
+                scope = (
+                    self.url,
+                    self.stream_results,
+                    self.max_rows,
+                    self.max_bytes,
+                    self.output_format,
+                    self.token_budget,
+                    self.row_limit,
+                    self.parameterize,
+                )
+                return self.result_cache.get_or_execute(scope, sql, execute)
+            return execute(sql)
+        except QueryRejected as e:
+            # a structured error the agent can act on, rejections are never cached
+            return e.to_json()
+
+    def _check_cost(self, session, sql):
+        if self.cost_guard is not None:
+            self.cost_guard.check(session.connection(), sql)
+
+    def _statement(self, sql):
+        """(text clause, parameters) to execute for sql."""
+        if not self.parameterize:
+            return text(sql), {}
+        query = parameterize(sql)
+        template_stats.record(query.template)
+        return query.clause(), query.params
+
+    def _run_sql(self, sql, estimate_sql=None) -> str:
+        if self.stream_results or self.output_format is not None:
+            return self.run_sql_streaming(sql, estimate_sql=estimate_sql)
+
+        # a fresh pooled session per call, so run_sql stays usable after the `with` block
+        # exits and can be called from several Gradio workers at once
+        with registry.session_scope(self.url) as session:
+            self._check_cost(session, estimate_sql or sql)
+            result = session.execute(*self._statement(sql))
+            columns = result.keys()
+            rows = result.fetchall()
         list_of_dicts = [dict(zip(columns, row)) for row in rows]
 
         json_result = json.dumps(list_of_dicts, indent=4, default=self.datetime_handler)
         return json_result
 
+    def run_sql_streaming(self, sql, max_rows=None, max_bytes=None, estimate_sql=None) -> str:
+        """
+        Like run_sql, but reads the result in FETCH_SIZE batches from a server-side cursor and
+        encodes rows one at a time, stopping once max_rows or max_bytes is reached.
+        Memory stays bounded by the budget, not by the size of the result.
+        The cost guard checks estimate_sql when given, e.g. sql before its row limit was added.
+        """
+        max_rows = self.max_rows if max_rows is None else max_rows
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        with registry.session_scope(self.url) as session:
+            self._check_cost(session, estimate_sql or sql)
+            result = session.execute(
+                *self._statement(sql), execution_options={"stream_results": True, "max_row_buffer": FETCH_SIZE}
+            )
+            encoder = BoundedRowEncoder(
+                result.keys(), max_rows, max_bytes, self.output_format or "json", self.token_budget
+            )
+            reading = True
+            while reading:
+                rows = result.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                reading = all(encoder.add(row) for row in rows)
+            # discards whatever is left on the server-side cursor
+            result.close()
+        json_result = encoder.getvalue()
+        # tokens per format, only measured in 'auto' mode
+        self.last_token_counts = encoder.token_counts
+        return json_result
+
     def datetime_handler(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return str(obj)
+        return datetime_handler(obj)
 
     def get_table_definition(self, table_name):
         metadata = MetaData(bind=self.engine)
@@ -87,34 +341,68 @@ class SQLManager:
         create_table_stmt = create_table_stmt.rstrip(",\n") + "\n);"
         return create_table_stmt
 
+    @property
+    def inspector(self):
+        # one inspector per manager, so its info cache is shared by every schema and table
+        if self._inspector is None:
+            self._inspector = inspect(self.engine)
+        return self._inspector
+
     def reflect_tables(self):
         self.metadata = MetaData()
 
         # Reflect tables for each schema
-        for schema in ['dim', 'fact', 'dbo']:
-            self.metadata.reflect(bind=self.engine, schema=schema)
+        self._reflect_schemas(self.metadata, {schema: None for schema in self.schemas})
+
+    def _reflect_schemas(self, metadata, tables_by_schema):
+        """
+        Reflects {schema: table names, or None for every table} into metadata.
+        Each schema is reflected into its own MetaData on a bounded thread pool, then merged.
+        """
+        if not tables_by_schema:
+            return
+
+        def reflect_schema(item):
+            schema, only = item
+            schema_metadata = MetaData()
+            schema_metadata.reflect(bind=self.inspector, schema=schema, only=only)
+            return schema_metadata
+
+        workers = max(1, min(REFLECTION_WORKERS, len(tables_by_schema)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            reflected = list(pool.map(reflect_schema, tables_by_schema.items()))
+        for schema_metadata in reflected:
+            for table in schema_metadata.sorted_tables:
+                if table.key not in metadata.tables:
+                    table.to_metadata(metadata)
+
+    def get_table(self, table_name):
+        """The Table for 'schema.table' (or 'table' in the default schema), reflected on first access."""
+        for metadata in (self.metadata, self._lazy_metadata):
+            if table_name in metadata.tables:
+                return metadata.tables[table_name]
+        schema, _, name = table_name.rpartition(".")
+        with self._lazy_lock:
+            if table_name not in self._lazy_metadata.tables:
+                Table(name, self._lazy_metadata, schema=schema or None, autoload_with=self.inspector)
+            return self._lazy_metadata.tables[table_name]
 
     def get_all_table_names(self):
         table_names = []
-        for schema in ['dim', 'fact', 'dbo']:
-            inspector = inspect(self.engine)
-            tables = inspector.get_table_names(schema=schema)
+        for schema in self.schemas:
+            tables = self.inspector.get_table_names(schema=schema)
             # Prefix table name with schema
             table_names.extend([f"{schema}.{table}" for table in tables])
         return table_names
 
-    def get_table_definitions_for_prompt(self):
-        self.reflect_tables()
-        table_names = self.get_all_table_names()
-        definitions = []
-        for table_name in table_names:
-            try:
-                # Access table with schema prefix
-                table = self.metadata.tables[table_name]
-                columns = ["{} {}".format(column.name, column.type) for column in table.columns]
-                table_definition = "CREATE TABLE {} (\n  {});".format(table_name, ',\n  '.join(columns))
-                definitions.append(table_definition)
-            except KeyError:
-                print("Error accessing " + table_name)
-                continue
-        return "\n\n".join(definitions)
\ No newline at end of file
+    def get_table_definitions_for_prompt(self, question=None, token_budget=None, top_k=DEFAULT_TOP_K):
+        """
+        CREATE TABLE text for the prompt. With a question only the top_k most relevant tables
+        and their foreign-key neighbours are included, and token_budget caps the total size.
+        """
+        # only tables whose catalog fingerprint changed since the last call are reflected again
+        entry = schema_cache.get(self.engine, self.schemas, self._reflect_schemas)
+        self.metadata = entry.metadata
+        if question is None and token_budget is None:
+            return entry.text
+        return select_table_definitions(entry, question, token_budget, top_k)
@@ -0,0 +1,169 @@
+"""
+Purpose:
+    Process-wide registry of pooled SQLAlchemy engines.
+    Engines are created once per URL and shared by every SQLManager, so a chat turn reuses
+    pooled connections instead of paying the TCP/TLS and login handshakes again.
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_POOL_OPTIONS = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+    # drop connections the server closed while they were idle in the pool
+    "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") != "0",
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+}
+
+# only QueuePool understands sizing options, e.g. sqlite may default to SingletonThreadPool or NullPool
+QUEUE_POOL_ONLY_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class PoolMetrics:
+    """Checkout latency and saturation of one engine pool."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_checked_out = 0
+
+    def record_checkout(self, seconds: float, checked_out: int):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            self._waits.append(seconds)
+
+    def _percentile(self, waits, q):
+        if not waits:
+            return 0.0
+        return waits[min(len(waits) - 1, int(q * len(waits)))]
+
+    def snapshot(self, pool) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = {
+                "checkouts": self.checkouts,
+                "avg_checkout_ms": 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "p95_checkout_ms": 1000 * self._percentile(waits, 0.95),
+                "max_checkout_ms": 1000 * self.max_wait,
+                "peak_checked_out": self.peak_checked_out,
+            }
+        if isinstance(pool, QueuePool):
+            capacity = pool.size() + max(pool._max_overflow, 0)
+            stats.update(
+                {
+                    "pool_size": pool.size(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                    "saturation": pool.checkedout() / capacity if capacity else 0.0,
+                }
+            )
+        return stats
+
+
+def _key(url) -> str:
+    """
+    The registry key of url. str() of a URL object masks the password as ***, which would give
+    URLs that only differ in their password the same engine, and an engine that cannot log in.
+    """
+    if isinstance(url, URL):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+class EngineRegistry:
+    """
+    Hands out one engine and sessionmaker per URL.
+    Sessions are short-lived: every session_scope() checks a connection out of the pool and
+    returns it on exit, so the same SQLManager can be used from concurrent Gradio workers.
+    """
+
+    def __init__(self, **pool_options):
+        self._lock = threading.Lock()
+        self._engines: Dict[str, Any] = {}
+        self._sessionmakers: Dict[str, sessionmaker] = {}
+        self._metrics: Dict[str, PoolMetrics] = {}
+        self.pool_options = {**DEFAULT_POOL_OPTIONS, **pool_options}
+
+    def configure(self, **pool_options):
+        """Change the pool options used for engines created from now on."""
+        self.pool_options.update(pool_options)
+
+    def engine_options(self, url, **pool_options):
+        """create_engine keyword arguments for url, also used for async engines."""
+        options = {**self.pool_options, **pool_options}
+        url = make_url(url)
+        poolclass = options.get("poolclass") or url.get_dialect().get_pool_class(url)
+        if not issubclass(poolclass, QueuePool):
+            for name in QUEUE_POOL_ONLY_OPTIONS:
+                options.pop(name, None)
+        return options
+
+    def get_engine(self, url: str, **pool_options):
+        url = _key(url)
+        engine = self._engines.get(url)
+        if engine is not None:
+            return engine
+        with self._lock:
+            if url not in self._engines:
+                engine = create_engine(url, **self.engine_options(url, **pool_options))
+                self._engines[url] = engine
+                self._sessionmakers[url] = sessionmaker(bind=engine)
+                self._metrics[url] = PoolMetrics()
+            return self._engines[url]
+
+    def get_sessionmaker(self, url: str) -> sessionmaker:
+        self.get_engine(url)
+        return self._sessionmakers[_key(url)]
+
+    @contextmanager
+    def session_scope(self, url: str):
+        url = _key(url)
+        session = self.get_sessionmaker(url)()
+        try:
+            start = time.perf_counter()
+            session.connection()  # checks a connection out of the pool
+            engine = self._engines[url]
+            checked_out = engine.pool.checkedout() if isinstance(engine.pool, QueuePool) else 1
+            self._metrics[url].record_checkout(time.perf_counter() - start, checked_out)
+            yield session
+        finally:
+            session.close()
+
+    def metrics(self, url: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """Pool metrics per engine, keyed by URL with the password hidden."""
+        urls = [_key(url)] if url is not None else list(self._engines)
+        return {
+            make_url(u).render_as_string(hide_password=True): self._metrics[u].snapshot(self._engines[u].pool)
+            for u in urls
+            if u in self._engines
+        }
+
+    def dispose(self, url: Optional[str] = None):
+        with self._lock:
+            urls = [_key(url)] if url is not None else list(self._engines)
+            for u in urls:
+                engine = self._engines.pop(u, None)
+                if engine is not None:
+                    engine.dispose()
+                self._sessionmakers.pop(u, None)
+                self._metrics.pop(u, None)
+
+
+# shared by every SQLManager in the process
+registry = EngineRegistry()
@@ -0,0 +1,217 @@
+"""
+Purpose:
+    Token-efficient encodings of run_sql results for the agents.
+    Rows are encoded one at a time so the bounded, streaming reader can stop at any point.
+"""
+import csv
+import io
+import json
+from datetime import date, datetime, time
+from decimal import Context, Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from modules.tokens import count_tokens
+
+MAX_STRING_CHARS = 200
+
+# most readable first, used by choose_format when several formats fit the budget
+AUTO_PREFERENCE = ("json", "markdown", "tuples", "columnar", "csv")
+# rows a large result's token counts are estimated from, see estimate_token_counts
+TOKEN_SAMPLE_ROWS = 20
+
+
+# ------------------ value shortening ------------------
+
+
+def shorten(value, max_string: int = MAX_STRING_CHARS):
+    """
+    Shortest faithful form of a value for the LLM: numbers keep every digit, only trailing zeros go.
+    Example
+        shorten(datetime(2023, 11, 1, 0, 0)) -> '2023-11-01'
+        shorten(Decimal('12.500000')) -> 12.5
+        shorten(Decimal('1234567.890')) -> 1234567.89
+    """
+    if value is None or isinstance(value, (bool, int)):
+        return value
+    if isinstance(value, datetime):
+        value = value.replace(microsecond=0)
+        if value.time() == time(0) and value.tzinfo is None:
+            return value.date().isoformat()
+        return value.isoformat()
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return str(value)
+        # the default context would round to 28 digits
+        value = value.normalize(Context(prec=max(len(value.as_tuple().digits), 1)))
+        if value == value.to_integral_value():
+            return int(value)
+        # a float when it prints back as the same digits, e.g. not 0.1000000000000000055 or 38 digit money
+        as_float = float(value)
+        if Decimal(repr(as_float)) == value:
+            return as_float
+        # fixed point, normalize() may have switched to an exponent
+        return format(value, "f")
+    if isinstance(value, float):
+        # repr is already the shortest form that reads back as the same float
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    value = str(value)
+    if len(value) > max_string:
+        return value[: max_string - 1] + "…"
+    return value
+
+
+def shorten_row(row) -> List[Any]:
+    return [shorten(value) for value in row]
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+# ------------------ formats ------------------
+
+
+class RowFormat:
+    """encode_row returns (piece, size in bytes), render joins the pieces of all rows."""
+
+    name = ""
+
+    def __init__(self, columns: Sequence[str]):
+        self.columns = list(columns)
+
+    def encode_row(self, values) -> Tuple[Any, int]:
+        raise NotImplementedError
+
+    def render(self, pieces) -> str:
+        raise NotImplementedError
+
+    def render_rows(self, rows) -> str:
+        return self.render([self.encode_row(values)[0] for values in rows])
+
+
+class RecordsFormat(RowFormat):
+    """[{"col": value, ...}, ...], every row repeats every column name."""
+
+    name = "json"
+
+    def encode_row(self, values):
+        piece = _dumps(dict(zip(self.columns, values)))
+        return piece, len(piece.encode("utf-8")) + 1
+
+    def render(self, pieces):
+        return "[" + ",\n".join(pieces) + "]"
+
+
+class ColumnarFormat(RowFormat):
+    """{"col": [values...], ...}"""
+
+    name = "columnar"
+
+    def encode_row(self, values):
+        return values, len(_dumps(values).encode("utf-8"))
+
+    def render(self, pieces):
+        return _dumps({column: [values[i] for values in pieces] for i, column in enumerate(self.columns)})
+
+
+class TuplesFormat(RowFormat):
+    """{"columns": [...], "rows": [[...], ...]}, the schema once and then bare rows."""
+
+    name = "tuples"
+
+    def encode_row(self, values):
+        piece = _dumps(values)
+        return piece, len(piece.encode("utf-8")) + 1
+
+    def render(self, pieces):
+        return '{"columns":' + _dumps(self.columns) + ',"rows":[\n' + ",\n".join(pieces) + "]}"
+
+
+class CsvFormat(RowFormat):
+    name = "csv"
+
+    def _line(self, values):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="").writerow(["" if value is None else value for value in values])
+        return buffer.getvalue()
+
+    def encode_row(self, values):
+        piece = self._line(values)
+        return piece, len(piece.encode("utf-8")) + 1
+
+    def render(self, pieces):
+        return "\n".join([self._line(self.columns)] + list(pieces))
+
+
+class MarkdownFormat(RowFormat):
+    name = "markdown"
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return ""
+        return str(value).replace("|", "\\|").replace("\n", " ")
+
+    def _line(self, values):
+        return "| " + " | ".join(self._cell(value) for value in values) + " |"
+
+    def encode_row(self, values):
+        piece = self._line(values)
+        return piece, len(piece.encode("utf-8")) + 1
+
+    def render(self, pieces):
+        header = [self._line(self.columns), "|" + "---|" * len(self.columns)]
+        return "\n".join(header + list(pieces))
+
+
+FORMATS = {cls.name: cls for cls in (RecordsFormat, ColumnarFormat, TuplesFormat, CsvFormat, MarkdownFormat)}
+
+
+def get_format(name: str, columns: Sequence[str]) -> RowFormat:
+    if name not in FORMATS:
+        raise ValueError(f"Unknown output format {name!r}, expected one of {sorted(FORMATS)} or 'auto'")
+    return FORMATS[name](columns)
+
+
+def format_rows(columns: Sequence[str], rows, output_format: str = "json") -> str:
+    return get_format(output_format, columns).render_rows([shorten_row(row) for row in rows])
+
+
+def format_token_counts(columns: Sequence[str], rows, formats: Sequence[str] = AUTO_PREFERENCE) -> Dict[str, int]:
+    """Tokens each format needs for the same (already shortened) rows."""
+    return {name: count_tokens(get_format(name, columns).render_rows(rows)) for name in formats}
+
+
+def estimate_token_counts(
+    columns: Sequence[str], rows, formats: Sequence[str] = AUTO_PREFERENCE, sample_rows: int = TOKEN_SAMPLE_ROWS
+) -> Dict[str, int]:
+    """
+    format_token_counts from an evenly spaced sample of rows: each format's header once, plus
+    its tokens per sampled row times the number of rows. Exact when there are no more rows than the sample.
+    """
+    if len(rows) <= sample_rows:
+        return format_token_counts(columns, rows, formats)
+    step = len(rows) / sample_rows
+    sample = [rows[int(i * step)] for i in range(sample_rows)]
+    counts = {}
+    for name in formats:
+        row_format = get_format(name, columns)
+        header = count_tokens(row_format.render([]))
+        per_row = (count_tokens(row_format.render_rows(sample)) - header) / sample_rows
+        counts[name] = header + round(per_row * len(rows))
+    return counts
+
+
+def choose_format(
+    token_counts: Dict[str, int], token_budget: Optional[int] = None, preference: Sequence[str] = AUTO_PREFERENCE
+) -> str:
+    """The most readable format within token_budget, or the smallest one if none fits."""
+    if token_budget is not None:
+        for name in preference:
+            if name in token_counts and token_counts[name] <= token_budget:
+                return name
+    return min(token_counts, key=lambda name: (token_counts[name], preference.index(name)))
@@ -3,15 +3,56 @@ Purpose:
     Interact with the OpenAI API.
     Provide supporting prompt engineering functions.
 """
+import asyncio
+import codecs
+import json
 import os
-import sys
+import random
+import threading
+import time
+import weakref
+from collections import deque
+import httpx
 import openai
 from dotenv import load_dotenv
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from modules.completion_cache import CompletionCache
+from modules.prompt_budget import BudgetReport, fit_table_definitions
+from modules.tokens import DEFAULT_MODEL, count_tokens
 
 # load .env file
 load_dotenv()
 
+# the async client talks to any OpenAI-compatible endpoint, e.g. a local stub server
+# LLM_BASE_URL=http://127.0.0.1:8000/v1. Azure is used when LLM_API_VERSION is set.
+AZURE_OPENAI_API_BASE = os.environ.get("AZURE_OPENAI_API_BASE")
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL") or AZURE_OPENAI_API_BASE or "https://api.openai.com/v1"
+LLM_API_KEY = (
+    os.environ.get("LLM_API_KEY") or os.environ.get("AZURE_OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY")
+)
+LLM_API_VERSION = os.environ.get("LLM_API_VERSION") or ("2023-07-01-preview" if AZURE_OPENAI_API_BASE else None)
+LLM_MODEL = os.environ.get("LLM_MODEL", "autogen")
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 4))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 60))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# opt-in on-disk cache of completions, e.g. LLM_COMPLETION_CACHE=.cache/completions.sqlite
+LLM_COMPLETION_CACHE = os.environ.get("LLM_COMPLETION_CACHE")
+LLM_COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("LLM_COMPLETION_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+completion_cache = (
+    CompletionCache(LLM_COMPLETION_CACHE, max_bytes=LLM_COMPLETION_CACHE_MAX_BYTES) if LLM_COMPLETION_CACHE else None
+)
+
+
+class LLMError(Exception):
+    """The request failed for good: bad configuration, a non-retryable status, or retries used up."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
 # ------------------ helpers ------------------
 
 def safe_get(data, dot_chained_keys):
@@ -35,13 +76,71 @@ def response_parser(response: Dict[str, Any]):
     return safe_get(response, "choices.0.message.content")
 
 
+def delta_parser(chunk: Dict[str, Any]):
+    return safe_get(chunk, "choices.0.delta.content")
+
+
+class SSEDecoder:
+    """
+    Turns the bytes of a text/event-stream into the data of each event.
+    Network chunks can end anywhere, mid line or mid UTF-8 character: the unfinished tail is kept
+    until the next feed.
+    Example
+        decoder = SSEDecoder()
+        decoder.feed(b'data: {"a"') -> []
+        decoder.feed(b': 1}\n\ndata: [DONE]\n\n') -> ['{"a": 1}', '[DONE]']
+    """
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._data = []
+
+    def _line(self, line: str, events: List[str]):
+        line = line.rstrip("\r")
+        if not line:
+            # a blank line ends the event
+            if self._data:
+                events.append("\n".join(self._data))
+                self._data = []
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            if field == "data":
+                self._data.append(value[1:] if value.startswith(" ") else value)
+
+    def feed(self, chunk: bytes) -> List[str]:
+        self._buffer += self._text.decode(chunk)
+        *lines, self._buffer = self._buffer.split("\n")
+        events = []
+        for line in lines:
+            self._line(line, events)
+        return events
+
+    def flush(self) -> List[str]:
+        """Events left when the stream ends without a final blank line."""
+        events = []
+        self._buffer += self._text.decode(b"", final=True)
+        if self._buffer:
+            self._line(self._buffer, events)
+            self._buffer = ""
+        self._line("", events)
+        return events
+
+
 # ------------------ content generators ------------------
 
 
-def prompt(prompt: str, model: str = "") -> str:
+def prompt(prompt: str, model: str = "", use_cache: bool = True) -> str:
+    messages = [{"role": "user", "content": prompt}]
+    if use_cache and completion_cache is not None:
+        return completion_cache.get_or_call(model, messages, lambda: _prompt(messages, model))
+    return _prompt(messages, model)
+
+
+def _prompt(messages: List[Dict[str, Any]], model: str) -> str:
     # validate the openai api key - if it's not valid, raise an error
     if not openai.api_key:
-        sys.exit(
+        raise LLMError(
             """
 ERORR: OpenAI API key not found. Please export your key to OPENAI_API_KEY
 Example bash command:
@@ -51,17 +150,450 @@ Example bash command:
 
     response = openai.ChatCompletion.create(
         model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
+        messages=messages,
     )
 
     return response_parser(response)
 
 
+# ------------------ async client ------------------
+
+
+class LatencyRecorder:
+    """Latency of the last `window` requests, retries included."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+    def record(self, seconds: float, retries: int = 0, error: bool = False):
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.errors += int(error)
+            self._latencies.append(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {"requests": self.requests, "retries": self.retries, "errors": self.errors}
+        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            stats[name] = 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        stats["max_ms"] = 1000 * latencies[-1] if latencies else 0.0
+        return stats
+
+
+class CompletionStream:
+    """
+    Content deltas of a streamed completion, in arrival order.
+    time_to_first_token (seconds) and text are filled in while the stream is consumed.
+    Example
+        stream = client.stream_sync('Summarize these alerts ...')
+        for delta in stream:
+            print(delta, end='', flush=True)
+        stream.time_to_first_token -> 0.42
+    """
+
+    def __init__(self, deltas):
+        self._deltas = deltas
+        self.parts: List[str] = []
+        self.started = None
+        self.time_to_first_token: Optional[float] = None
+        self.elapsed: Optional[float] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def _add(self, delta: str):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.started
+        self.parts.append(delta)
+
+    def __iter__(self) -> Iterator[str]:
+        self.started = time.perf_counter()
+        for delta in self._deltas:
+            self._add(delta)
+            yield delta
+        self.elapsed = time.perf_counter() - self.started
+
+
+class AsyncCompletionStream(CompletionStream):
+    def __iter__(self):
+        raise TypeError("use async for with an AsyncCompletionStream")
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        self.started = time.perf_counter()
+        async for delta in self._deltas:
+            self._add(delta)
+            yield delta
+        self.elapsed = time.perf_counter() - self.started
+
+
+def _stream_deltas(events: List[str]):
+    """(deltas, done) for the events of one network chunk."""
+    deltas = []
+    for data in events:
+        if data == "[DONE]":
+            return deltas, True
+        delta = delta_parser(json.loads(data))
+        # Azure sends chunks without choices, e.g. content filter results
+        if delta:
+            deltas.append(delta)
+    return deltas, False
+
+
+class StreamAttempts:
+    """
+    Retries, time to first token, latency and caching of one streamed completion. The async and
+    the sync stream of AsyncLLMClient only differ in how they do IO, everything else happens here.
+    """
+
+    def __init__(self, client: "AsyncLLMClient", payload: Dict[str, Any]):
+        self.client = client
+        self.payload = payload
+        self.options = {key: value for key, value in payload.items() if key not in ("model", "messages")}
+        self.request = {**payload, "stream": True}
+        self.start = time.perf_counter()
+        self.parts: List[str] = []
+        self.attempt = 0
+        self.decoder = SSEDecoder()
+
+    def cached(self) -> Optional[str]:
+        return self.client._cached(self.payload, self.options)
+
+    def streams(self, response: httpx.Response) -> bool:
+        """
+        True when response streams the completion, False when it is retried.
+        Raises LLMError for other errors, whose body the caller has read.
+        """
+        if response.status_code in RETRY_STATUS_CODES:
+            return False
+        if response.is_error:
+            raise LLMError(f"LLM returned {response.status_code}: {response.text[:500]}", response.status_code)
+        self.decoder = SSEDecoder()
+        return True
+
+    def _add(self, deltas: List[str]):
+        if deltas and not self.parts:
+            self.client.time_to_first_token.record(time.perf_counter() - self.start, self.attempt)
+        self.parts.extend(deltas)
+
+    def feed(self, chunk: bytes) -> Tuple[List[str], bool]:
+        """(deltas, done) of a network chunk."""
+        deltas, done = _stream_deltas(self.decoder.feed(chunk))
+        self._add(deltas)
+        return deltas, done
+
+    def finish(self, done: bool) -> List[str]:
+        """
+        The deltas left when the stream ended without [DONE]. Records the latency and caches the
+        completion.
+        """
+        deltas = [] if done else _stream_deltas(self.decoder.flush())[0]
+        self._add(deltas)
+        self.client.latency.record(time.perf_counter() - self.start, self.attempt)
+        self.client._store(self.payload, self.options, self.parts)
+        return deltas
+
+    def broke_off(self, error: Exception) -> Exception:
+        """The connection error to retry, LLMError once the caller already has part of the answer."""
+        if self.parts:
+            # a retry would repeat the part the caller already has
+            self.client.latency.record(time.perf_counter() - self.start, self.attempt, error=True)
+            raise LLMError(f"LLM stream broke off: {error!r}")
+        return error
+
+    def backoff(self, response: Optional[httpx.Response], error: Optional[Exception]) -> float:
+        """Seconds to wait before the next attempt, raises LLMError when the retries are spent."""
+        if self.attempt >= self.client.max_retries:
+            self.client.latency.record(time.perf_counter() - self.start, self.attempt, error=True)
+            raise self.client._failure(response, error)
+        delay = self.client._backoff(self.attempt, response)
+        self.attempt += 1
+        return delay
+
+
+class AsyncLLMClient:
+    """
+    Chat completions over one shared httpx connection pool.
+    At most max_concurrency requests are in flight, 429 and 5xx responses are retried with
+    jittered exponential backoff (or after Retry-After when the server sends it).
+    Each event loop gets its own pool and concurrency limit, e.g. one asyncio.run() per Gradio request.
+    Example
+        async with AsyncLLMClient(base_url="http://127.0.0.1:8000/v1", api_key="stub") as client:
+            answers = await client.prompt_many(["What is 1 + 1?", "What is 2 + 2?"])
+    """
+
+    def __init__(
+        self,
+        base_url: str = LLM_BASE_URL,
+        api_key: Optional[str] = LLM_API_KEY,
+        model: str = LLM_MODEL,
+        api_version: Optional[str] = LLM_API_VERSION,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_retries: int = LLM_MAX_RETRIES,
+        timeout: float = LLM_TIMEOUT,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        cache: Optional[CompletionCache] = completion_cache,
+    ):
+        self.cache = cache
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.api_version = api_version
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency = LatencyRecorder()
+        self.time_to_first_token = LatencyRecorder()
+        self._sync_client = None
+        # (pool, semaphore) by event loop: both only work on the loop they were created on
+        self._loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, asyncio.Semaphore]]"
+        self._loops = weakref.WeakKeyDictionary()
+        self._loops_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def _client_options(self) -> Dict[str, Any]:
+        if not self.api_key:
+            raise LLMError("No API key for the LLM, set LLM_API_KEY, AZURE_OPENAI_API_KEY or OPENAI_API_KEY.")
+        headers = {"api-key": self.api_key} if self.api_version else {"Authorization": f"Bearer {self.api_key}"}
+        return {
+            "headers": headers,
+            "timeout": httpx.Timeout(self.timeout, connect=min(self.timeout, 10.0)),
+            "limits": httpx.Limits(
+                max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency
+            ),
+        }
+
+    def _loop_state(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """The pool and semaphore of the running event loop, created on its first request."""
+        loop = asyncio.get_running_loop()
+        with self._loops_lock:
+            state = self._loops.get(loop)
+            if state is None:
+                # the pools of closed loops cannot be closed any more, their sockets go with them
+                for closed in [other for other in self._loops if other.is_closed()]:
+                    del self._loops[closed]
+                state = (httpx.AsyncClient(**self._client_options()), asyncio.Semaphore(self.max_concurrency))
+                self._loops[loop] = state
+            return state
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Pool of the running event loop."""
+        return self._loop_state()[0]
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        """Pool for callers without an event loop, its max_connections bounds their concurrency."""
+        if self._sync_client is None:
+            self._sync_client = httpx.Client(**self._client_options())
+        return self._sync_client
+
+    async def aclose(self):
+        """Closes the pool of the running event loop and the synchronous pool."""
+        with self._loops_lock:
+            state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    def completions_url(self, model: str) -> str:
+        if self.api_version:
+            return f"{self.base_url}/openai/deployments/{model}/chat/completions?api-version={self.api_version}"
+        return f"{self.base_url}/chat/completions"
+
+    def payload(self, prompt: str, model: str, **options) -> Dict[str, Any]:
+        return {"model": model, "messages": [{"role": "user", "content": prompt}], **options}
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # full jitter: concurrent callers that failed together do not retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def post(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        POSTs one chat completion request, retrying 429, 5xx and connection errors.
+        The concurrency slot is given back while backing off, so other requests can use it.
+        """
+        client, semaphore = self._loop_state()
+        url = self.completions_url(payload["model"])
+        start = None
+        attempt = 0
+        while True:
+            response, error = None, None
+            async with semaphore:
+                # latency is measured from the first attempt, time spent queueing for a slot is not included
+                start = start or time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    error = e
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                break
+            if attempt >= self.max_retries:
+                self.latency.record(time.perf_counter() - start, attempt, error=True)
+                raise self._failure(response, error)
+            await asyncio.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+        self.latency.record(time.perf_counter() - start, attempt, error=response.is_error)
+        if response.is_error:
+            raise LLMError(f"LLM returned {response.status_code}: {response.text[:500]}", response.status_code)
+        return response.json()
+
+    async def prompt(self, prompt: str, model: Optional[str] = None, **options) -> str:
+        payload = self.payload(prompt, model or self.model, **options)
+        if self.cache is not None:
+            # a local SQLite read, well under a millisecond, not worth a thread hop
+            cached = self.cache.get(payload["model"], payload["messages"], **options)
+            if cached is not None:
+                return cached
+        answer = response_parser(await self.post(payload))
+        if self.cache is not None and answer:
+            self.cache.put(payload["model"], payload["messages"], answer, **options)
+        return answer
+
+    def stream(self, prompt: str, model: Optional[str] = None, **options) -> AsyncCompletionStream:
+        """
+        Streams the completion of prompt: async for delta in client.stream(prompt).
+        Failures before the first byte are retried like post(), a stream that breaks later raises LLMError.
+        """
+        return AsyncCompletionStream(self._arequest_deltas(self.payload(prompt, model or self.model, **options)))
+
+    def stream_sync(self, prompt: str, model: Optional[str] = None, **options) -> CompletionStream:
+        """stream() for synchronous callers such as Gradio handlers: for delta in client.stream_sync(prompt)."""
+        return CompletionStream(self._request_deltas(self.payload(prompt, model or self.model, **options)))
+
+    def _cached(self, payload: Dict[str, Any], options: Dict[str, Any]) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return self.cache.get(payload["model"], payload["messages"], **options)
+
+    def _store(self, payload: Dict[str, Any], options: Dict[str, Any], parts: List[str]):
+        if self.cache is not None and parts:
+            self.cache.put(payload["model"], payload["messages"], "".join(parts), **options)
+
+    def _failure(self, response: Optional[httpx.Response], error: Optional[Exception]) -> LLMError:
+        if response is None:
+            return LLMError(f"LLM request failed: {error!r}")
+        return LLMError(f"LLM returned {response.status_code}", response.status_code)
+
+    async def _arequest_deltas(self, payload: Dict[str, Any]):
+        attempts = StreamAttempts(self, payload)
+        cached = attempts.cached()
+        if cached is not None:
+            yield cached
+            return
+
+        client, semaphore = self._loop_state()
+        url = self.completions_url(payload["model"])
+        while True:
+            response, error = None, None
+            async with semaphore:
+                try:
+                    async with client.stream("POST", url, json=attempts.request) as response:
+                        if response.is_error:
+                            await response.aread()
+                        if attempts.streams(response):
+                            done = False
+                            async for chunk in response.aiter_bytes():
+                                deltas, done = attempts.feed(chunk)
+                                for delta in deltas:
+                                    yield delta
+                                if done:
+                                    break
+                            for delta in attempts.finish(done):
+                                yield delta
+                            return
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    error = attempts.broke_off(e)
+            await asyncio.sleep(attempts.backoff(response, error))
+
+    def _request_deltas(self, payload: Dict[str, Any]):
+        attempts = StreamAttempts(self, payload)
+        cached = attempts.cached()
+        if cached is not None:
+            yield cached
+            return
+
+        client = self.sync_client
+        url = self.completions_url(payload["model"])
+        while True:
+            response, error = None, None
+            try:
+                with client.stream("POST", url, json=attempts.request) as response:
+                    if response.is_error:
+                        response.read()
+                    if attempts.streams(response):
+                        done = False
+                        for chunk in response.iter_bytes():
+                            deltas, done = attempts.feed(chunk)
+                            yield from deltas
+                            if done:
+                                break
+                        yield from attempts.finish(done)
+                        return
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = attempts.broke_off(e)
+            time.sleep(attempts.backoff(response, error))
+
+    async def prompt_many(
+        self, prompts: List[str], model: Optional[str] = None, return_exceptions: bool = False, **options
+    ) -> List[Any]:
+        """Answers in the order of prompts, at most max_concurrency requests at a time."""
+        return await asyncio.gather(
+            *(self.prompt(prompt, model, **options) for prompt in prompts), return_exceptions=return_exceptions
+        )
+
+
+# shared by every caller in this process; callers on one event loop share its connection pool and concurrency limit
+async_client = AsyncLLMClient()
+
+
+async def aprompt(prompt: str, model: str = "") -> str:
+    """Async prompt() on the shared client."""
+    return await async_client.prompt(prompt, model or None)
+
+
+async def prompt_many(prompts: List[str], model: str = "") -> List[str]:
+    return await async_client.prompt_many(prompts, model or None)
+
+
+def prompt_stream(prompt: str, model: str = "") -> CompletionStream:
+    """
+    The completion of prompt as it is generated, on the shared client.
+    Example
+        for delta in llm.prompt_stream('Summarize these alerts ...'):
+            print(delta, end='', flush=True)
+    """
+    return async_client.stream_sync(prompt, model or None)
+
+
+def aprompt_stream(prompt: str, model: str = "") -> AsyncCompletionStream:
+    """Async prompt_stream(): async for delta in llm.aprompt_stream(prompt)."""
+    return async_client.stream(prompt, model or None)
+
+
 def add_cap_ref(
     prompt: str, prompt_suffix: str, cap_ref: str, cap_ref_content: str
 ) -> str:
@@ -77,4 +609,29 @@ def add_cap_ref(
 
     new_prompt = f"""{prompt} {prompt_suffix}\n\n{cap_ref}\n\n{cap_ref_content}"""
 
-    return new_prompt
\ No newline at end of file
+    return new_prompt
+
+
+def add_cap_ref_within_budget(
+    prompt: str,
+    prompt_suffix: str,
+    cap_ref: str,
+    cap_ref_content: str,
+    token_budget: int,
+    model: str = DEFAULT_MODEL,
+) -> Tuple[str, BudgetReport]:
+    """
+    add_cap_ref, trimming cap_ref_content so the whole prompt stays within token_budget.
+    Table definitions lose bookkeeping columns first and then whole tables, anything else is cut
+    at a line boundary. The report has the tokens of the returned prompt and what was dropped.
+    Example
+        prompt, report = add_cap_ref_within_budget(prompt, suffix, 'TABLE_DEFINITIONS', definitions, 3000)
+        report.dropped_tables -> ['dbo.AuditLog']
+    """
+    frame = add_cap_ref(prompt, prompt_suffix, cap_ref, "")
+    content_budget = max(0, token_budget - count_tokens(frame, model))
+    content, report = fit_table_definitions(cap_ref_content, content_budget, model)
+    new_prompt = add_cap_ref(prompt, prompt_suffix, cap_ref, content)
+    report.token_budget = token_budget
+    report.tokens = count_tokens(new_prompt, model)
+    return new_prompt, report
@@ -0,0 +1,171 @@
+"""
+Purpose:
+    Lift the literals out of generated SQL into bound parameters, so queries that only differ
+    in their dates, ids or reference codes share one server plan instead of compiling a new one.
+    Example
+        SELECT COUNT(*) FROM fact.IndividualAlarmsUS WHERE SiteId = 42 AND DateTimeAlarmClosed >= '2023-11-01'
+    runs as
+        SELECT COUNT(*) FROM fact.IndividualAlarmsUS WHERE SiteId = :p0 AND DateTimeAlarmClosed >= :p1
+"""
+import threading
+from collections import Counter
+from decimal import Decimal
+from typing import Any, Dict, FrozenSet, NamedTuple
+
+from sqlalchemy import Numeric, String, Unicode, bindparam, text
+
+from modules.sql_utils import Token, normalize_tokens, tokenize
+
+# only literals in these clauses are lifted: a parameter in the select list or GROUP BY
+# would make SQL Server reject expressions that have to match between the two
+PARAMETERIZED_CLAUSES = {"WHERE", "ON", "HAVING"}
+# words that start a clause, JOIN starts its table list
+CLAUSE_WORDS = {
+    "SELECT": "SELECT",
+    "FROM": "FROM",
+    "JOIN": "FROM",
+    "WHERE": "WHERE",
+    "ON": "ON",
+    "GROUP": "GROUP",
+    "HAVING": "HAVING",
+    "ORDER": "ORDER",
+    "TOP": "TOP",
+    "LIMIT": "LIMIT",
+    "OFFSET": "OFFSET",
+    "FETCH": "FETCH",
+    "UNION": None,
+    "EXCEPT": None,
+    "INTERSECT": None,
+}
+# the length, precision or scale in e.g. VARCHAR(50) or DECIMAL(10, 2) has to stay a literal
+TYPE_NAMES = {
+    "CHAR",
+    "VARCHAR",
+    "NCHAR",
+    "NVARCHAR",
+    "BINARY",
+    "VARBINARY",
+    "DECIMAL",
+    "NUMERIC",
+    "FLOAT",
+    "DATETIME2",
+    "DATETIMEOFFSET",
+    "TIME",
+}
+MAX_TRACKED_TEMPLATES = 10_000
+
+
+class ParameterizedQuery(NamedTuple):
+    sql: str
+    params: Dict[str, Any]
+    # normalized sql with every lifted literal shown as ?
+    template: str
+    # parameters that were N'...' literals
+    national: FrozenSet[str] = frozenset()
+
+    def clause(self):
+        # each parameter bound as the type its literal had, so SQL Server compares it with the column as is:
+        # pyodbc sends a plain str as NVARCHAR, which converts a VARCHAR column (CONVERT_IMPLICIT) and
+        # scans it instead of seeking its index; 'x' goes out as VARCHAR and N'x' as NVARCHAR.
+        # Decimals as NUMERIC for the same reason, and because the sqlite driver does not take Decimal.
+        params = []
+        for name, value in self.params.items():
+            if isinstance(value, Decimal):
+                params.append(bindparam(name, type_=Numeric()))
+            elif isinstance(value, str):
+                params.append(bindparam(name, type_=Unicode() if name in self.national else String()))
+        return text(self.sql).bindparams(*params)
+
+
+def _literal_value(token: Token):
+    if token.kind == "number":
+        if "." in token.value or "e" in token.value.lower():
+            return Decimal(token.value)
+        return int(token.value)
+    value = token.value[1:] if _is_national(token) else token.value
+    return value[1:-1].replace("''", "'")
+
+
+def _is_national(token: Token) -> bool:
+    return token.kind == "string" and token.value[0] in "Nn"
+
+
+def parameterize(sql: str) -> ParameterizedQuery:
+    """
+    Replaces the string and number literals in WHERE, ON and HAVING with :p0, :p1, ...
+    The same literal twice gets the same parameter. Row limits (TOP, LIMIT, OFFSET, FETCH),
+    ORDER BY / GROUP BY ordinals and type lengths are left alone, they are part of the query shape.
+    """
+    tokens = tokenize(sql, keep_whitespace=True)
+    params = {}
+    names = {}
+    national = set()
+    pieces = []
+    template = []
+    # one entry per open parenthesis: (clause, are these type arguments)
+    stack = [(None, False)]
+    previous_word = None
+
+    for token in tokens:
+        kind, value = token
+        clause, type_arguments = stack[-1]
+        if kind == "op" and value == "(":
+            stack.append((clause, previous_word in TYPE_NAMES))
+        elif kind == "op" and value == ")" and len(stack) > 1:
+            stack.pop()
+        elif kind == "word" and value.upper() in CLAUSE_WORDS:
+            stack[-1] = (CLAUSE_WORDS[value.upper()], type_arguments)
+
+        if kind in ("string", "number") and clause in PARAMETERIZED_CLAUSES and not type_arguments:
+            literal = _literal_value(token)
+            # 'x' and N'x' are different types, they do not share a parameter
+            key = (kind, _is_national(token), literal)
+            if key not in names:
+                names[key] = f"p{len(names)}"
+                params[names[key]] = literal
+                if _is_national(token):
+                    national.add(names[key])
+            pieces.append(":" + names[key])
+            template.append(Token("op", "?"))
+        else:
+            pieces.append(value)
+            template.append(token)
+
+        if kind not in ("ws", "comment"):
+            previous_word = value.upper() if kind == "word" else None
+
+    return ParameterizedQuery("".join(pieces), params, normalize_tokens(template), frozenset(national))
+
+
+class TemplateStats:
+    """Executions vs distinct templates, the closer the two are the less plans are reused."""
+
+    def __init__(self, max_templates: int = MAX_TRACKED_TEMPLATES):
+        self.max_templates = max_templates
+        self.templates = Counter()
+        self.executions = 0
+        self.untracked = 0
+        self._lock = threading.Lock()
+
+    def record(self, template: str):
+        with self._lock:
+            self.executions += 1
+            if template in self.templates or len(self.templates) < self.max_templates:
+                self.templates[template] += 1
+            else:
+                self.untracked += 1
+
+    def stats(self):
+        with self._lock:
+            distinct = len(self.templates)
+            return {
+                "executions": self.executions,
+                "distinct_templates": distinct,
+                "untracked_executions": self.untracked,
+                "executions_per_template": self.executions / distinct if distinct else 0.0,
+                "most_common": self.templates.most_common(5),
+            }
+
+
+# shared by every SQLManager in this process
+template_stats = TemplateStats()
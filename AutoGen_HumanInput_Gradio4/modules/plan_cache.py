@@ -0,0 +1,303 @@
+"""
+Purpose:
+    Local store of approved question -> SQL -> summary plans, so a question the team already
+    answered, in other words, re-runs the approved SQL instead of a whole group chat.
+    Questions are compared by cosine similarity of hashed term embeddings, no model or service needed.
+    Every lookup and store is recorded in the decisions table of the same SQLite file.
+    Example
+        cache = PlanCache('.cache/plans.sqlite')
+        decision = cache.lookup('SLA breaches last month')
+        if decision.plan:
+            db.run_sql(decision.plan.sql)
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from modules.table_index import canonical_terms
+
+# rewordings of one question score about 0.85-0.95, different questions rarely above 0.6
+DEFAULT_THRESHOLD = 0.85
+EMBEDDING_DIM = 512
+# feature weights: whole terms carry the meaning, bigrams the word order, trigrams absorb typos
+TERM_WEIGHT = 1.0
+BIGRAM_WEIGHT = 0.5
+TRIGRAM_WEIGHT = 0.25
+# words of a question that say nothing about the data
+FILLER_WORDS = set("were did do does we our have had has be been there i you can please tell".split())
+# decisions kept in the log, older ones are deleted
+MAX_DECISIONS = 10_000
+
+# words that change the SQL even though they barely change the embedding, e.g. last vs this month
+# or average vs max: two questions only match when they use the same ones
+DISCRIMINATING_WORDS = set(
+    "today yesterday tomorrow hour day week month quarter year weekend ytd mtd "
+    "last this previous current next since before after between "
+    "january february march april may june july august september october november december "
+    "monday tuesday wednesday thursday friday saturday sunday "
+    "not no without exclude excluding except only "
+    "top bottom most least highest lowest best worst max maximum min minimum "
+    "average avg mean median total sum count percentage percent rate "
+    "us emea apac uk eu".split()
+)
+_LITERAL_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\b\w+(?:-\w+)+\b|\d+(?:\.\d+)?")
+_WORD_RE = re.compile(r"[A-Za-z]+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    question TEXT NOT NULL,
+    key_terms TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    sql TEXT NOT NULL,
+    summary TEXT,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS decisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at REAL NOT NULL,
+    question TEXT NOT NULL,
+    decision TEXT NOT NULL,
+    plan_id INTEGER,
+    similarity REAL,
+    detail TEXT
+);
+"""
+
+
+def _hash(feature: str) -> Tuple[int, float]:
+    # blake2b rather than hash(): the index has to be the same in every process
+    digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % EMBEDDING_DIM, 1.0 if digest >> 63 else -1.0
+
+
+def embed(question: str) -> array:
+    """Unit-length hashed embedding of the question's terms, see table_index.canonical_terms."""
+    terms = [term for term in canonical_terms(question) if term not in FILLER_WORDS]
+    vector = [0.0] * EMBEDDING_DIM
+    features = [(term, TERM_WEIGHT) for term in set(terms)]
+    features += [(f"{a} {b}", BIGRAM_WEIGHT) for a, b in zip(terms, terms[1:])]
+    features += [
+        (f"#{term[i:i + 3]}", TRIGRAM_WEIGHT) for term in terms if len(term) > 3 for i in range(len(term) - 2)
+    ]
+    for feature, weight in features:
+        index, sign = _hash(feature)
+        vector[index] += sign * weight
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return array("f", (value / norm for value in vector))
+
+
+def key_terms(question: str) -> List[str]:
+    """
+    Literals (numbers, quoted strings, reference codes) and discriminating words of the question.
+    Example
+        key_terms("Alarms at site s-us-0042 last month") -> ['last', 'month', 's-us-0042']
+    """
+    found = {match.group(0).strip("'\"").lower() for match in _LITERAL_RE.finditer(question)}
+    words = [word.lower() for word in _WORD_RE.findall(_LITERAL_RE.sub(" ", question))]
+    found.update(word for word in words if word in DISCRIMINATING_WORDS)
+    # plurals, e.g. weeks
+    found.update(word[:-1] for word in words if word.endswith("s") and word[:-1] in DISCRIMINATING_WORDS)
+    return sorted(found)
+
+
+def sparse(vector: array) -> Dict[int, float]:
+    # a question lights up a few dozen of the EMBEDDING_DIM slots
+    return {index: value for index, value in enumerate(vector) if value}
+
+
+def cosine(a: array, b: Dict[int, float]) -> float:
+    # both are unit length
+    return sum(a[index] * value for index, value in b.items())
+
+
+@dataclass
+class Plan:
+    id: int
+    question: str
+    sql: str
+    summary: Optional[str]
+    hits: int
+
+
+@dataclass
+class PlanDecision:
+    """hit, miss, miss_key_terms (a close question with other literals), stored, updated, skipped, invalidated."""
+
+    decision: str
+    question: str
+    plan: Optional[Plan] = None
+    similarity: Optional[float] = None
+    detail: Optional[str] = None
+
+    def __str__(self):
+        similarity = "" if self.similarity is None else f" similarity={self.similarity:.3f}"
+        plan = "" if self.plan is None else f" plan={self.plan.id} ({self.plan.question!r})"
+        detail = f" {self.detail}" if self.detail else ""
+        return f"plan cache {self.decision}: {self.question!r}{similarity}{plan}{detail}"
+
+
+class PlanCache:
+    """
+    Approved plans in a SQLite file shared by every process on the host, WAL mode as in CompletionCache.
+    Embeddings are kept in memory and topped up with the rows other processes added since.
+    """
+
+    def __init__(self, path: str, threshold: float = DEFAULT_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # id -> (sparse embedding, key terms)
+        self._vectors: Dict[int, Tuple[Dict[int, float], List[str]]] = {}
+        self._last_id = 0
+        self.counts: Dict[str, int] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    def _refresh(self):
+        rows = self._connection().execute(
+            "SELECT id, key_terms, embedding FROM plans WHERE id > ? ORDER BY id", (self._last_id,)
+        ).fetchall()
+        with self._lock:
+            for plan_id, terms, blob in rows:
+                self._vectors[plan_id] = (sparse(array("f", blob)), json.loads(terms))
+                self._last_id = max(self._last_id, plan_id)
+
+    def _ranked(self, vector: array) -> List[Tuple[float, int, List[str]]]:
+        with self._lock:
+            candidates = list(self._vectors.items())
+        return sorted(((cosine(vector, v), plan_id, terms) for plan_id, (v, terms) in candidates), reverse=True)
+
+    def _plan(self, plan_id: int) -> Optional[Plan]:
+        row = self._connection().execute(
+            "SELECT id, question, sql, summary, hits FROM plans WHERE id = ?", (plan_id,)
+        ).fetchone()
+        if row is None:
+            # deleted by another process
+            with self._lock:
+                self._vectors.pop(plan_id, None)
+            return None
+        return Plan(*row)
+
+    def _log(self, decision: PlanDecision) -> PlanDecision:
+        connection = self._connection()
+        cursor = connection.execute(
+            "INSERT INTO decisions (at, question, decision, plan_id, similarity, detail) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                time.time(),
+                decision.question,
+                decision.decision,
+                decision.plan.id if decision.plan else None,
+                decision.similarity,
+                decision.detail,
+            ),
+        )
+        if cursor.lastrowid % 1000 == 0:
+            connection.execute("DELETE FROM decisions WHERE id <= ?", (cursor.lastrowid - MAX_DECISIONS,))
+        with self._lock:
+            self.counts[decision.decision] = self.counts.get(decision.decision, 0) + 1
+        return decision
+
+    def _best_match(self, question: str, vector: array, terms: List[str]) -> PlanDecision:
+        self._refresh()
+        close = None
+        ranked = self._ranked(vector)
+        for similarity, plan_id, plan_terms in ranked:
+            if similarity < self.threshold:
+                break
+            if plan_terms != terms:
+                close = close or (similarity, plan_id, plan_terms)
+                continue
+            plan = self._plan(plan_id)
+            if plan is not None:
+                return PlanDecision("hit", question, plan, similarity)
+        if close is not None:
+            similarity, plan_id, plan_terms = close
+            return PlanDecision(
+                "miss_key_terms", question, self._plan(plan_id), similarity, f"{terms} != {plan_terms}"
+            )
+        if not ranked:
+            return PlanDecision("miss", question, detail="no plans")
+        # the closest plan's score, to tune the threshold from the decisions table
+        return PlanDecision("miss", question, similarity=ranked[0][0])
+
+    def lookup(self, question: str) -> PlanDecision:
+        """A hit carries the plan to re-run, any other decision means the question goes to the team."""
+        decision = self._best_match(question, embed(question), key_terms(question))
+        if decision.decision == "hit":
+            self._connection().execute(
+                "UPDATE plans SET hits = hits + 1, used = ? WHERE id = ?", (time.time(), decision.plan.id)
+            )
+        return self._log(decision)
+
+    def store(self, question: str, sql: str, summary: Optional[str] = None) -> PlanDecision:
+        """Records an approved plan, replacing the plan of a question that matches this one."""
+        if not sql or not sql.strip():
+            return self._log(PlanDecision("skipped", question, detail="no sql"))
+        vector = embed(question)
+        terms = key_terms(question)
+        match = self._best_match(question, vector, terms)
+        now = time.time()
+        connection = self._connection()
+        if match.decision == "hit":
+            connection.execute(
+                "UPDATE plans SET sql = ?, summary = ?, used = ? WHERE id = ?", (sql, summary, now, match.plan.id)
+            )
+            return self._log(PlanDecision("updated", question, match.plan, match.similarity))
+        cursor = connection.execute(
+            "INSERT INTO plans (question, key_terms, embedding, sql, summary, created, used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (question, json.dumps(terms), vector.tobytes(), sql, summary, now, now),
+        )
+        return self._log(PlanDecision("stored", question, Plan(cursor.lastrowid, question, sql, summary, 0)))
+
+    def invalidate(self, plan: Plan, question: str, reason: str) -> PlanDecision:
+        """Drops a plan whose SQL no longer runs, e.g. after a schema change."""
+        self._connection().execute("DELETE FROM plans WHERE id = ?", (plan.id,))
+        with self._lock:
+            self._vectors.pop(plan.id, None)
+        return self._log(PlanDecision("invalidated", question, plan, detail=reason))
+
+    def decisions(self, limit: int = 50) -> List[Tuple]:
+        """The latest decisions, newest first: (at, question, decision, plan_id, similarity, detail)."""
+        return self._connection().execute(
+            "SELECT at, question, decision, plan_id, similarity, detail FROM decisions ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+
+    def clear(self):
+        self._connection().executescript("DELETE FROM plans; DELETE FROM decisions;")
+        with self._lock:
+            self._vectors.clear()
+
+    def stats(self) -> Dict[str, object]:
+        plans = self._connection().execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+        with self._lock:
+            lookups = sum(self.counts.get(name, 0) for name in ("hit", "miss", "miss_key_terms"))
+            return {
+                "plans": plans,
+                "threshold": self.threshold,
+                **self.counts,
+                "hit_rate": self.counts.get("hit", 0) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,128 @@
+"""
+Purpose:
+    Fit reference content into a token budget before it goes into a prompt, so an oversized
+    schema is trimmed locally instead of failing at the model after a paid round trip.
+    Table definitions (the CREATE TABLE text from schema_cache) lose their low-priority
+    columns first, then whole tables, least relevant last table first.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from modules.tokens import DEFAULT_MODEL, count_tokens
+
+CREATE_TABLE_RE = re.compile(r"^CREATE TABLE (?P<name>\S+) \(\n(?P<columns>.*)\);$", re.DOTALL)
+
+# bookkeeping columns the agents never need to answer a question
+LOW_PRIORITY_COLUMN_RE = re.compile(
+    r"^(last)?(created|modified|updated|inserted|changed)(on|at|by|date|datetime|time|user)?$"
+    r"|^date(created|modified|updated)$|^(etl|audit)|^(load|batch)(id|date|datetime|time)?$"
+    r"|^sys(start|end)time$|^valid(from|to)$|^(rowversion|timestamp|checksum|rowhash|hashkey|isdeleted)$",
+    re.IGNORECASE,
+)
+TRUNCATION_NOTE = "\n-- truncated to fit the token budget"
+
+
+@dataclass
+class BudgetReport:
+    """What fit_table_definitions / fit_text did to the content."""
+
+    token_budget: int
+    tokens: int = 0
+    dropped_columns: Dict[str, List[str]] = field(default_factory=dict)
+    dropped_tables: List[str] = field(default_factory=list)
+    truncated: bool = False
+
+    @property
+    def trimmed(self) -> bool:
+        return bool(self.dropped_columns or self.dropped_tables or self.truncated)
+
+
+@dataclass
+class TableDefinition:
+    name: str
+    # "Name TYPE" per column, in table order
+    columns: List[str]
+
+    def render(self) -> str:
+        return "CREATE TABLE {} (\n  {});".format(self.name, ",\n  ".join(self.columns))
+
+
+def parse_table_definitions(text: str) -> Optional[List[TableDefinition]]:
+    """The tables in text as rendered by schema_cache.render_table_definition, None if text is anything else."""
+    tables = []
+    for block in text.split("\n\n"):
+        match = CREATE_TABLE_RE.match(block.strip())
+        if match is None:
+            return None
+        columns = [line.strip() for line in match.group("columns").split(",\n")]
+        tables.append(TableDefinition(match.group("name"), columns))
+    return tables
+
+
+def is_low_priority_column(column: str) -> bool:
+    return LOW_PRIORITY_COLUMN_RE.search(column.split(" ", 1)[0]) is not None
+
+
+def fit_text(text: str, token_budget: int, model: str = DEFAULT_MODEL, report: Optional[BudgetReport] = None):
+    """(text cut at a line boundary to fit token_budget, report)."""
+    report = report or BudgetReport(token_budget)
+    tokens = count_tokens(text, model)
+    if tokens <= token_budget:
+        report.tokens = tokens
+        return text, report
+
+    # binary search for the most lines that fit, the note included
+    lines = text.split("\n")
+    low, high = 0, len(lines)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens("\n".join(lines[:middle]) + TRUNCATION_NOTE, model) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    text = "\n".join(lines[:low]) + TRUNCATION_NOTE if low else ""
+    report.tokens = count_tokens(text, model)
+    report.truncated = True
+    return text, report
+
+
+def fit_table_definitions(text: str, token_budget: int, model: str = DEFAULT_MODEL):
+    """
+    (table definitions trimmed to fit token_budget, report).
+    Tables are expected most relevant first, as select_table_definitions returns them.
+    Anything that is not table definitions is cut with fit_text.
+    """
+    report = BudgetReport(token_budget)
+    tables = parse_table_definitions(text)
+    if tables is None:
+        return fit_text(text, token_budget, model, report)
+
+    # separators between tables are counted once here instead of re-rendering the whole text per step
+    separator = count_tokens("\n\n", model)
+    sizes = [count_tokens(table.render(), model) for table in tables]
+    total = sum(sizes) + separator * (len(tables) - 1)
+
+    # 1. bookkeeping columns, least relevant table first, keeping at least one column per table
+    for i in reversed(range(len(tables))):
+        if total <= token_budget:
+            break
+        table = tables[i]
+        keep = [column for column in table.columns if not is_low_priority_column(column)] or table.columns[:1]
+        dropped = [column.split(" ", 1)[0] for column in table.columns if column not in keep]
+        if dropped:
+            table.columns = keep
+            report.dropped_columns[table.name] = dropped
+            new_size = count_tokens(table.render(), model)
+            total -= sizes[i] - new_size
+            sizes[i] = new_size
+
+    # 2. whole tables, least relevant first, the most relevant one is cut with fit_text at worst
+    while total > token_budget and len(tables) > 1:
+        table = tables.pop()
+        total -= sizes.pop() + separator
+        report.dropped_tables.append(table.name)
+        report.dropped_columns.pop(table.name, None)
+
+    text = "\n\n".join(table.render() for table in tables)
+    return fit_text(text, token_budget, model, report)
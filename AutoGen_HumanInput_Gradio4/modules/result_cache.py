@@ -0,0 +1,131 @@
+"""
+Purpose:
+    Opt-in cache of run_sql results keyed by normalized SQL text.
+    The agents of one group chat, and different users, often run the same query again;
+    a hit is served from memory instead of re-scanning the fact tables.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from modules.sql_utils import is_nondeterministic, is_read_only, is_time_relative, normalize_tokens, tokenize
+
+
+class ResultCache:
+    """
+    Bounded LRU cache with per-entry TTLs.
+    Queries using GETUTCDATE() and friends get time_relative_ttl, queries using NEWID()/RAND()
+    and anything that is not a read-only SELECT are never cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl: float = 600,
+        time_relative_ttl: float = 30,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.time_relative_ttl = time_relative_ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _key_and_ttl(self, scope: Hashable, sql: str) -> Tuple[Optional[Hashable], float]:
+        tokens = tokenize(sql)
+        if not is_read_only(tokens) or is_nondeterministic(tokens):
+            return None, 0
+        ttl = self.time_relative_ttl if is_time_relative(tokens) else self.ttl
+        if ttl <= 0:
+            return None, 0
+        return (scope, normalize_tokens(tokens)), ttl
+
+    def _get(self, key) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _put(self, key, value: str, ttl: float):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def get_or_execute(self, scope: Hashable, sql: str, execute: Callable[[str], str]) -> str:
+        """
+        Returns the cached result of sql for this scope, or runs execute(sql) and caches it.
+        scope separates results that differ for the same SQL, e.g. another database or row cap.
+        """
+        key, ttl = self._key_and_ttl(scope, sql)
+        if key is None:
+            with self._lock:
+                self.bypassed += 1
+            return execute(sql)
+
+        value = self._get(key)
+        if value is None:
+            value = execute(sql)
+            self._put(key, value, ttl)
+        return value
+
+    async def aget_or_execute(self, scope: Hashable, sql: str, execute: Callable[[str], Awaitable[str]]) -> str:
+        """Async version of get_or_execute for AsyncSQLManager."""
+        key, ttl = self._key_and_ttl(scope, sql)
+        if key is None:
+            with self._lock:
+                self.bypassed += 1
+            return await execute(sql)
+
+        value = self._get(key)
+        if value is None:
+            value = await execute(sql)
+            self._put(key, value, ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
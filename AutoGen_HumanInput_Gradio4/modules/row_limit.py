@@ -0,0 +1,93 @@
+"""
+Purpose:
+    Check the SQL the agents generate before it reaches the database, and add a row limit
+    in the right syntax for the dialect when the query has none:
+        SQL Server:         SELECT TOP n ...
+        PostgreSQL, SQLite: SELECT ... LIMIT n
+    Works on the tokens from sql_utils, no round trip needed.
+"""
+import os
+from typing import List
+
+from modules.cost_guard import QueryRejected
+from modules.sql_utils import Token, is_read_only, tokenize
+
+# one more than run_sql's row cap, so run_sql can still tell the agent the result was truncated
+DEFAULT_ROW_LIMIT = int(os.environ.get("SQL_ROW_LIMIT", 501))
+
+TOP_DIALECTS = {"mssql"}
+LIMIT_DIALECTS = {"postgresql", "sqlite", "mysql"}
+SET_OPERATORS = {"UNION", "EXCEPT", "INTERSECT"}
+
+
+def _significant(tokens: List[Token]) -> List[int]:
+    """Indexes of the tokens that are not whitespace or comments."""
+    return [i for i, (kind, _) in enumerate(tokens) if kind not in ("ws", "comment")]
+
+
+def check_statement(tokens: List[Token]):
+    """Raises QueryRejected unless tokens (without whitespace) are one read-only statement."""
+    if not tokens:
+        raise QueryRejected("empty_statement", "The query is empty.")
+    body = list(tokens)
+    while body and body[-1].value == ";":
+        body.pop()
+    if any(kind == "op" and value == ";" for kind, value in body):
+        raise QueryRejected(
+            "multiple_statements", "Send one SELECT statement per run_sql call, without ';' between statements."
+        )
+    if not is_read_only(body):
+        raise QueryRejected("not_read_only", "Only SELECT statements are allowed, the database is read only.")
+
+
+def _top_level_words(tokens: List[Token]):
+    """(index, upper-cased word) for every word outside parentheses."""
+    depth = 0
+    for i, (kind, value) in enumerate(tokens):
+        if kind == "op" and value == "(":
+            depth += 1
+        elif kind == "op" and value == ")":
+            depth -= 1
+        elif kind == "word" and depth == 0:
+            yield i, value.upper()
+
+
+def limit_rows(sql: str, dialect: str, limit: int = DEFAULT_ROW_LIMIT) -> str:
+    """
+    Checks sql with check_statement and returns it with a row limit added if it has none.
+    Queries that already have one, and dialects without a known syntax, are returned unchanged.
+    SQL Server set operations are left alone as well, TOP would only limit their first SELECT.
+    Example
+        limit_rows("SELECT * FROM dim.Site;", "mssql", 501) -> 'SELECT TOP 501 * FROM dim.Site'
+        limit_rows("SELECT * FROM dim.Site", "sqlite", 501) -> 'SELECT * FROM dim.Site LIMIT 501'
+    """
+    tokens = tokenize(sql, keep_whitespace=True)
+    significant = _significant(tokens)
+    check_statement([tokens[i] for i in significant])
+    if limit is None or dialect not in TOP_DIALECTS | LIMIT_DIALECTS:
+        return sql
+
+    # drop the trailing ';' and comments, a LIMIT after a '--' comment would be commented out
+    end = significant[-1]
+    if tokens[end].value == ";":
+        end = max(i for i in significant if tokens[i].value != ";")
+    tokens = tokens[: end + 1]
+    top_level = list(_top_level_words(tokens))
+    upper = [word for _, word in top_level]
+
+    if dialect in TOP_DIALECTS:
+        if "TOP" in upper or "OFFSET" in upper or SET_OPERATORS & set(upper):
+            return sql
+        # the first SELECT outside parentheses is the outer one, CTE bodies are in parentheses
+        position = next((n for n, word in enumerate(upper) if word == "SELECT"), None)
+        if position is None:
+            return sql
+        insert_at = top_level[position][0]
+        if position + 1 < len(upper) and upper[position + 1] in ("DISTINCT", "ALL"):
+            insert_at = top_level[position + 1][0]
+        values = [value for _, value in tokens]
+        return "".join(values[: insert_at + 1]) + f" TOP {int(limit)}" + "".join(values[insert_at + 1 :])
+
+    if "LIMIT" in upper or "FETCH" in upper:
+        return sql
+    return "".join(value for _, value in tokens) + f" LIMIT {int(limit)}"
@@ -0,0 +1,259 @@
+"""
+Purpose:
+    Process-wide cache of reflected table definitions.
+    Entries are keyed by engine URL and schema list, and are invalidated table by table
+    using a cheap catalog fingerprint instead of re-reflecting every schema on each request.
+"""
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import MetaData, Table, bindparam, inspect, text
+from sqlalchemy.engine import Engine
+
+# ------------------ fingerprints ------------------
+
+# one row per table: (schema_name, table_name, fingerprint)
+FINGERPRINT_QUERIES = {
+    # modify_date changes on every ALTER TABLE, so it is enough to detect column changes
+    "mssql": """
+        SELECT s.name, t.name, CONVERT(varchar(33), t.modify_date, 126)
+        FROM sys.tables t
+        JOIN sys.schemas s ON s.schema_id = t.schema_id
+        WHERE s.name IN :schemas
+    """,
+    "postgresql": """
+        SELECT table_schema, table_name,
+               md5(string_agg(column_name || ':' || data_type || ':' || is_nullable, ',' ORDER BY ordinal_position))
+        FROM information_schema.columns
+        WHERE table_schema IN :schemas
+        GROUP BY table_schema, table_name
+    """,
+}
+
+
+def _sqlite_fingerprints(connection, schemas):
+    rows = []
+    for schema in schemas:
+        # every attached sqlite database has its own catalog
+        result = connection.execute(text(f'SELECT name, sql FROM "{schema}".sqlite_master WHERE type = \'table\''))
+        for name, sql in result:
+            if name.startswith("sqlite_"):
+                continue
+            rows.append((schema, name, hashlib.sha1((sql or "").encode()).hexdigest()))
+    return rows
+
+
+def _inspector_fingerprints(connection, schemas):
+    # no cheap catalog checksum for this dialect: only added and dropped tables are detected
+    inspector = inspect(connection)
+    return [(schema, name, "") for schema in schemas for name in inspector.get_table_names(schema=schema)]
+
+
+def get_table_fingerprints(bind, schemas: Iterable[str]) -> Dict[str, str]:
+    """
+    Returns {'schema.table': fingerprint} for every table in the given schemas.
+    A table whose fingerprint changed has to be reflected again.
+    bind is an Engine or an open Connection (e.g. the sync side of an AsyncConnection).
+    """
+    schemas = list(schemas)
+    if isinstance(bind, Engine):
+        with bind.connect() as connection:
+            return get_table_fingerprints(connection, schemas)
+
+    dialect = bind.dialect.name
+    if dialect in FINGERPRINT_QUERIES:
+        stmt = text(FINGERPRINT_QUERIES[dialect]).bindparams(bindparam("schemas", expanding=True))
+        rows = bind.execute(stmt, {"schemas": schemas}).fetchall()
+    elif dialect == "sqlite":
+        rows = _sqlite_fingerprints(bind, schemas)
+    else:
+        rows = _inspector_fingerprints(bind, schemas)
+
+    # keep the configured schema order, then table name order, so the rendered prompt is stable
+    order = {schema: i for i, schema in enumerate(schemas)}
+    rows = sorted(rows, key=lambda row: (order.get(row[0], len(order)), row[1]))
+    return {f"{schema}.{table}": str(fingerprint) for schema, table, fingerprint in rows}
+
+
+# ------------------ rendering ------------------
+
+
+def render_table_definition(table_name: str, table: Table) -> str:
+    columns = ["{} {}".format(column.name, column.type) for column in table.columns]
+    return "CREATE TABLE {} (\n  {});".format(table_name, ",\n  ".join(columns))
+
+
+# ------------------ cache ------------------
+
+
+@dataclass
+class SchemaCacheEntry:
+    metadata: MetaData
+    fingerprints: Dict[str, str] = field(default_factory=dict)
+    definitions: Dict[str, str] = field(default_factory=dict)
+    text: str = ""
+    # TableIndex over metadata, built on first use and dropped whenever a table is re-reflected
+    index: Any = None
+
+
+class SchemaCache:
+    """
+    Caches the reflected MetaData and rendered CREATE TABLE text per (engine url, schemas).
+
+    reflect(metadata, {schema: table names}) is supplied by the caller so the cache does not
+    decide how reflection is done, only which tables need it.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, Tuple[str, ...]], SchemaCacheEntry] = {}
+        # only held to look up or publish an entry, never while reflecting
+        self._lock = threading.Lock()
+        # sync callers refresh one at a time, so concurrent requests do not reflect the same schema twice
+        self._reflect_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tables_reflected = 0
+        self.tables_reused = 0
+
+    @staticmethod
+    def _key(bind, schemas):
+        # Connection.engine and Engine.engine both give the engine
+        return bind.engine.url.render_as_string(hide_password=False), tuple(schemas)
+
+    def _lookup(self, key) -> Optional[SchemaCacheEntry]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def _publish(self, key, old: Optional[SchemaCacheEntry], new: SchemaCacheEntry) -> SchemaCacheEntry:
+        """Swaps new in for old, unless another caller published a newer entry meanwhile, which stays."""
+        with self._lock:
+            current = self._entries.get(key)
+            if current is old:
+                self._entries[key] = new
+                return new
+        if current is not None and current.fingerprints == new.fingerprints:
+            return current
+        return new
+
+    def get(
+        self,
+        bind,
+        schemas: Iterable[str],
+        reflect: Callable[[MetaData, Dict[str, list]], None],
+    ) -> SchemaCacheEntry:
+        """
+        The entry for bind's engine and schemas, reflecting the tables that changed since it was cached.
+        Published entries are never changed, a refresh builds a new one, so a caller can keep using
+        the entry it got while another caller refreshes.
+        """
+        schemas = tuple(schemas)
+        key = self._key(bind, schemas)
+        fingerprints = get_table_fingerprints(bind, schemas)
+
+        entry = self._lookup(key)
+        if entry is not None and entry.fingerprints == fingerprints:
+            self._count(hits=1)
+            return entry
+        with self._reflect_lock:
+            # another thread may have refreshed it while this one waited
+            entry = self._lookup(key)
+            if entry is not None and entry.fingerprints == fingerprints:
+                self._count(hits=1)
+                return entry
+            return self._publish(key, entry, self._refreshed(entry, fingerprints, reflect))
+
+    def get_unlocked(
+        self,
+        bind,
+        schemas: Iterable[str],
+        reflect: Callable[[MetaData, Dict[str, list]], None],
+    ) -> SchemaCacheEntry:
+        """
+        get() without waiting for a thread that is reflecting, for callers on an event loop
+        (AsyncSQLManager runs this through run_sync). At worst two callers reflect the same tables once each.
+        """
+        schemas = tuple(schemas)
+        key = self._key(bind, schemas)
+        fingerprints = get_table_fingerprints(bind, schemas)
+
+        entry = self._lookup(key)
+        if entry is not None and entry.fingerprints == fingerprints:
+            self._count(hits=1)
+            return entry
+        return self._publish(key, entry, self._refreshed(entry, fingerprints, reflect))
+
+    def _count(self, hits=0, misses=0, reflected=0, reused=0):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+            self.tables_reflected += reflected
+            self.tables_reused += reused
+
+    def _refreshed(
+        self,
+        entry: Optional[SchemaCacheEntry],
+        fingerprints: Dict[str, str],
+        reflect: Callable[[MetaData, Dict[str, list]], None],
+    ) -> SchemaCacheEntry:
+        """
+        A new entry for fingerprints: the unchanged tables of entry are copied, the changed ones
+        reflected again. entry itself is left as it is.
+        """
+        old_fingerprints = entry.fingerprints if entry is not None else {}
+        changed = [name for name, fp in fingerprints.items() if old_fingerprints.get(name) != fp]
+        stale = set(changed) | {name for name in old_fingerprints if name not in fingerprints}
+
+        fresh = SchemaCacheEntry(metadata=MetaData())
+        if entry is not None:
+            for table_name, table in entry.metadata.tables.items():
+                if table_name not in stale:
+                    table.to_metadata(fresh.metadata)
+            fresh.definitions = {name: text for name, text in entry.definitions.items() if name not in stale}
+
+        by_schema: Dict[str, list] = {}
+        for table_name in changed:
+            schema, table = table_name.split(".", 1)
+            by_schema.setdefault(schema, []).append(table)
+        reflect(fresh.metadata, by_schema)
+
+        definitions = []
+        for table_name in fingerprints:
+            if table_name not in fresh.definitions:
+                table = fresh.metadata.tables.get(table_name)
+                if table is None:
+                    print("Error accessing " + table_name)
+                    continue
+                fresh.definitions[table_name] = render_table_definition(table_name, table)
+            definitions.append(fresh.definitions[table_name])
+
+        self._count(misses=1, reflected=len(changed), reused=len(fingerprints) - len(changed))
+        fresh.fingerprints = fingerprints
+        fresh.text = "\n\n".join(definitions)
+        return fresh
+
+    def invalidate(self, engine=None):
+        """Drop every entry, or only the entries of one engine."""
+        with self._lock:
+            if engine is None:
+                self._entries.clear()
+                return
+            url = engine.url.render_as_string(hide_password=False)
+            for key in [key for key in self._entries if key[0] == url]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "tables_reflected": self.tables_reflected,
+            "tables_reused": self.tables_reused,
+        }
+
+
+# shared by every SQLManager in the process
+schema_cache = SchemaCache()
@@ -0,0 +1,130 @@
+"""
+Purpose:
+    Live agents per browser session, so a new message is appended to the conversation the agents
+    already hold instead of rebuilding it from the Chatbot history on every turn. Sessions idle for
+    idle_seconds, and the least recently used ones beyond max_sessions, are dropped.
+    Example
+        store = SessionStore(lambda: initialize_agents(config_list))
+        with store.acquire(request.session_hash) as session:
+            assistant, userproxy = session.agents
+            userproxy.initiate_chat(assistant, message=message, clear_history=False)
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_IDLE_SECONDS = 30 * 60
+DEFAULT_MAX_SESSIONS = 100
+
+
+@dataclass
+class Session:
+    id: str
+    agents: Any
+    created: float
+    last_used: float
+    # turns the agents took part in; 0 for a new session, which may have to catch up with the Chatbot history
+    turns: int = 0
+    # one turn at a time per session, e.g. when a message is sent while the last one still runs
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # requests holding or waiting for the session, it is not evicted while there are any
+    users: int = 0
+
+
+class SessionStore:
+    """
+    Sessions by id, most recently used last. Building a session's agents happens outside the
+    store's lock, like TeamPool in modules/team.py; two first requests of one session keep the first.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.factory = factory
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.built = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _evict(self, now: float):
+        # called with the lock held; least recently used first, sessions in use stay
+        for session_id, session in list(self._sessions.items()):
+            if session.users:
+                continue
+            if now - session.last_used > self.idle_seconds or len(self._sessions) > self.max_sessions:
+                del self._sessions[session_id]
+                self.evicted += 1
+
+    def evict_idle(self) -> int:
+        """Drops the idle sessions now, returns how many. acquire does it as well."""
+        with self._lock:
+            before = self.evicted
+            self._evict(self.clock())
+            return self.evicted - before
+
+    def _checkout(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.users += 1
+                self._sessions.move_to_end(session_id)
+                self.reused += 1
+                self._evict(self.clock())
+                return session
+        # built outside the lock, it is the slow part
+        agents = self.factory()
+        now = self.clock()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id, agents, now, now)
+                self.built += 1
+            else:
+                self.reused += 1
+            session.users += 1
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+            return session
+
+    @contextmanager
+    def acquire(self, session_id: str):
+        """The session's agents for one turn, built on first use."""
+        session = self._checkout(session_id)
+        try:
+            with session.lock:
+                yield session
+                session.turns += 1
+        finally:
+            with self._lock:
+                session.users -= 1
+                session.last_used = self.clock()
+
+    def discard(self, session_id: str) -> Optional[Session]:
+        """Forgets a session, e.g. one whose agents were left mid-turn. A request holding it keeps its agents."""
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "in_use": sum(1 for session in self._sessions.values() if session.users),
+                "built": self.built,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,121 @@
+"""
+Purpose:
+    Pick the next speaker of a group chat from a transition graph instead of asking the LLM
+    every round. The LLM is only asked at real branches, e.g. whether the Product Manager's
+    review sends the work back to the Engineer or to the Sr Data Analyst.
+"""
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from autogen import Agent, ConversableAgent, GroupChat
+
+
+@dataclass
+class SelectionStats:
+    # picked from the graph, each one an LLM call the default selection would have made
+    by_rule: int = 0
+    # picked by the LLM at a branch
+    by_llm: int = 0
+    # function calls go to the agent that can run them, the default selection does that without the LLM too
+    by_function: int = 0
+
+    @property
+    def saved(self) -> int:
+        return self.by_rule
+
+    def clear(self):
+        self.by_rule = self.by_llm = self.by_function = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"by_rule": self.by_rule, "by_llm": self.by_llm, "by_function": self.by_function, "saved": self.saved}
+
+
+class SelectionTotals:
+    """Selection counts over every chat in the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chats = 0
+        self.totals = SelectionStats()
+
+    def add(self, stats: SelectionStats):
+        with self._lock:
+            self.chats += 1
+            self.totals.by_rule += stats.by_rule
+            self.totals.by_llm += stats.by_llm
+            self.totals.by_function += stats.by_function
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "chats": self.chats,
+                **self.totals.as_dict(),
+                "saved_per_chat": self.totals.saved / self.chats if self.chats else 0.0,
+            }
+
+
+selection_totals = SelectionTotals()
+
+
+@dataclass
+class StateMachineGroupChat(GroupChat):
+    """
+    GroupChat whose next speaker comes from transitions, {speaker name: [next speaker names]}.
+    One name is followed without asking the LLM, several names are a branch and the LLM picks
+    among them only. Speakers missing from transitions fall back to the default selection.
+    Function calls go to the agent that can run it, and a function result goes back to the agent
+    that ran it, so it can read the result.
+    """
+
+    transitions: Dict[str, List[str]] = field(default_factory=dict)
+    # once the last message ends the chat, any speaker will stop it: no need to ask the LLM who
+    is_termination_msg: Optional[Callable[[Dict], bool]] = None
+    stats: SelectionStats = field(default_factory=SelectionStats)
+
+    def reset(self):
+        super().reset()
+        if self.stats.by_rule or self.stats.by_llm or self.stats.by_function:
+            selection_totals.add(self.stats)
+        # cleared in place: GroupChatManager selects with a shallow copy of this group chat, sharing stats
+        self.stats.clear()
+
+    def select_speaker(self, last_speaker: Agent, selector: ConversableAgent):
+        last_message = self.messages[-1] if self.messages else {}
+        if self.func_call_filter and "function_call" in last_message:
+            self.stats.by_function += 1
+            return super().select_speaker(last_speaker, selector)
+        if last_message.get("role") == "function":
+            self.stats.by_rule += 1
+            return last_speaker
+
+        names = [name for name in self.transitions.get(last_speaker.name, []) if name in self.agent_names]
+        if not names:
+            self.stats.by_llm += 1
+            return super().select_speaker(last_speaker, selector)
+        if len(names) == 1 or (self.is_termination_msg is not None and self.is_termination_msg(last_message)):
+            self.stats.by_rule += 1
+            return self.agent_by_name(names[0])
+
+        self.stats.by_llm += 1
+        return self._select_with_llm([self.agent_by_name(name) for name in names], selector)
+
+    def _select_with_llm(self, agents: List[Agent], selector: ConversableAgent) -> Agent:
+        names = [agent.name for agent in agents]
+        selector.update_system_message(self.select_speaker_msg(agents))
+        final, reply = selector.generate_oai_reply(
+            self.messages
+            + [
+                {
+                    "role": "system",
+                    "content": f"Read the above conversation. Then select the next role from {names} to play. "
+                    "Only return the role.",
+                }
+            ]
+        )
+        reply = reply if final and isinstance(reply, str) else ""
+        # the reply is usually the bare name, sometimes with punctuation or a sentence around it
+        for agent in agents:
+            if agent.name in reply:
+                return agent
+        return agents[0]
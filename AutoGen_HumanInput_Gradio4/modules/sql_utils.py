@@ -0,0 +1,156 @@
+"""
+Purpose:
+    Lightweight helpers for the SQL text the agents generate.
+    A small tokenizer is enough here: we only need to tell literals, identifiers,
+    keywords and punctuation apart, not to fully parse T-SQL.
+"""
+import re
+from decimal import Context, Decimal
+from typing import List, NamedTuple
+
+TOKEN_RE = re.compile(
+    r"""
+      (?P<ws>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>[Nn]?'(?:[^']|'')*')
+    | (?P<qident>\[[^\]]*\]|"(?:[^"]|"")*"|`[^`]*`)
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<word>[A-Za-z_@#][\w@#$]*)
+    | (?P<op><>|!=|>=|<=|\|\||::|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# functions whose result depends on when the query runs
+TIME_RELATIVE_FUNCTIONS = {
+    "GETDATE",
+    "GETUTCDATE",
+    "SYSDATETIME",
+    "SYSUTCDATETIME",
+    "SYSDATETIMEOFFSET",
+    "CURRENT_TIMESTAMP",
+    "CURRENT_DATE",
+    "CURRENT_TIME",
+    "LOCALTIMESTAMP",
+    "NOW",
+}
+# sqlite spells "now" as a string argument, e.g. date('now', '-1 month')
+TIME_RELATIVE_LITERALS = {"'now'"}
+
+# functions whose result changes on every execution
+NONDETERMINISTIC_FUNCTIONS = {"NEWID", "NEWSEQUENTIALID", "RAND", "RANDOM"}
+
+# keywords that make a statement something other than a plain read
+WRITE_KEYWORDS = {
+    "INSERT",
+    "UPDATE",
+    "DELETE",
+    "MERGE",
+    "INTO",
+    "CREATE",
+    "ALTER",
+    "DROP",
+    "TRUNCATE",
+    "GRANT",
+    "REVOKE",
+    "DENY",
+    "EXEC",
+    "EXECUTE",
+    "BULK",
+    "BACKUP",
+    "RESTORE",
+    "SHUTDOWN",
+    "DBCC",
+}
+
+
+class Token(NamedTuple):
+    kind: str
+    value: str
+
+
+def tokenize(sql: str, keep_whitespace: bool = False) -> List[Token]:
+    """
+    Splits sql into tokens of kind ws, comment, string, qident, number, word or op.
+    Whitespace and comments are dropped unless keep_whitespace is set.
+    """
+    tokens = []
+    for match in TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        if not keep_whitespace and kind in ("ws", "comment"):
+            continue
+        tokens.append(Token(kind, match.group()))
+    return tokens
+
+
+def _canonical_number(value: str) -> str:
+    """
+    The same text for literals of the same value and type, exact: 0.10 and 0.1 match,
+    0.10000000000000001 and 0.1 do not. 1.0 stays a decimal and 1e2 a float, they compute differently than 1 and 100.
+    """
+    if "." not in value and "e" not in value.lower():
+        return str(int(value))
+    number = Decimal(value)
+    number = number.normalize(Context(prec=max(len(number.as_tuple().digits), 1)))
+    if "e" in value.lower():
+        # scientific notation, 1e999 stays short
+        return str(number) if "E" in str(number) else str(number) + "E0"
+    text = format(number, "f")
+    return text if "." in text else text + ".0"
+
+
+def normalize_tokens(tokens: List[Token]) -> str:
+    parts = []
+    for kind, value in tokens:
+        if kind in ("ws", "comment"):
+            continue
+        if kind == "word":
+            parts.append(value.upper())
+        elif kind == "qident":
+            # [Order], "Order" and Order name the same column once the query is valid
+            parts.append(value[1:-1].upper())
+        elif kind == "number":
+            parts.append(_canonical_number(value))
+        elif kind == "string":
+            # the N prefix does not change which rows match
+            parts.append(value[1:] if value[0] in "Nn" else value)
+        else:
+            parts.append(value)
+    while parts and parts[-1] == ";":
+        parts.pop()
+    return " ".join(parts)
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Canonical text of a query: comments and redundant whitespace removed, keywords and
+    identifiers upper-cased, quoting and number formatting unified. String literals keep their case.
+    Example
+        normalize_sql("select  top 10 * from [dim].[Site]  where Id = 007;")
+        returns 'SELECT TOP 10 * FROM DIM . SITE WHERE ID = 7'
+    """
+    return normalize_tokens(tokenize(sql))
+
+
+def words(tokens: List[Token]) -> List[str]:
+    return [value.upper() for kind, value in tokens if kind == "word"]
+
+
+def is_read_only(tokens: List[Token]) -> bool:
+    """True if the statement is a SELECT (optionally with CTEs) that writes nothing."""
+    upper = words(tokens)
+    if not upper or upper[0] not in ("SELECT", "WITH"):
+        return False
+    return not any(word in WRITE_KEYWORDS for word in upper)
+
+
+def is_time_relative(tokens: List[Token]) -> bool:
+    return any(
+        (kind == "word" and value.upper() in TIME_RELATIVE_FUNCTIONS)
+        or (kind == "string" and value.lower() in TIME_RELATIVE_LITERALS)
+        for kind, value in tokens
+    )
+
+
+def is_nondeterministic(tokens: List[Token]) -> bool:
+    return any(kind == "word" and value.upper() in NONDETERMINISTIC_FUNCTIONS for kind, value in tokens)
@@ -0,0 +1,305 @@
+"""
+Purpose:
+    End group chat rounds that go nowhere. The detector reads the transcript before each speaker
+    selection and counts messages that make no progress: a near copy of a recent message, a function
+    call with the same name and arguments as an earlier one, or an empty reply.
+    After patience such messages in a row the Admin posts a correction; when the chat stalls again
+    the Admin stops it, and the rounds and tokens the chat would have used up to max_round are counted.
+    Example
+        groupchat = StallAwareGroupChat(agents, [], max_round=20, stall_detector=StallDetector())
+        user_proxy.register_reply([Agent, None], stop_reply, config=groupchat.stall_detector)
+"""
+import json
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from autogen import Agent, ConversableAgent, GroupChat
+
+from modules.sql_utils import normalize_sql
+from modules.tokens import count_tokens
+
+# messages in a row without progress before the Admin steps in
+DEFAULT_PATIENCE = 2
+# word 3-gram overlap above which two messages say the same thing
+DEFAULT_SIMILARITY = 0.9
+# earlier messages a new message is compared with
+DEFAULT_WINDOW = 8
+# corrections before the chat is stopped
+DEFAULT_MAX_CORRECTIONS = 1
+
+CORRECTION = (
+    "The last {count} messages repeat the conversation so far ({reason}), repeating them will not change the result. "
+    "Work from the queries and results already above: answer the question with them, take a different approach "
+    "if they cannot answer it, or approve the answer if it is already complete."
+)
+STOP = "Stopping the chat, it stalled again after a correction ({reason})."
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = 3) -> FrozenSet[Tuple[str, ...]]:
+    """Word size-grams of text, lower case. A shorter text is one shingle."""
+    words = [word.lower() for word in _WORD_RE.findall(text)]
+    if len(words) <= size:
+        return frozenset([tuple(words)]) if words else frozenset()
+    return frozenset(tuple(words[i : i + size]) for i in range(len(words) - size + 1))
+
+
+def jaccard(a: FrozenSet, b: FrozenSet) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def function_call_key(function_call) -> Tuple[str, str]:
+    """
+    (name, arguments) of a function call, with JSON arguments sorted and SQL normalized.
+    Example
+        function_call_key({"name": "run_sql", "arguments": '{"sql": "select 1;"}'})
+        returns ('run_sql', '{"sql": "SELECT 1"}')
+    """
+    # a dict, or the client's FunctionCall model when it comes straight from the LLM reply
+    function_call = dict(function_call)
+    arguments = function_call.get("arguments") or ""
+    try:
+        parsed = json.loads(arguments)
+    except (TypeError, ValueError):
+        return function_call.get("name"), arguments.strip()
+    if isinstance(parsed, dict):
+        parsed = {key: normalize_sql(value) if key == "sql" else value for key, value in parsed.items()}
+    return function_call.get("name"), json.dumps(parsed, sort_keys=True, default=str)
+
+
+def _message_text(message: Dict) -> str:
+    if message.get("function_call"):
+        return json.dumps(function_call_key(message["function_call"]))
+    return message.get("content") or ""
+
+
+@dataclass
+class StallReport:
+    # messages that made no progress
+    stalls: int = 0
+    corrections: int = 0
+    stopped: bool = False
+    reason: Optional[str] = None
+    # messages in the transcript when the chat was stopped
+    rounds: int = 0
+    # rounds left until max_round, and an estimate of the LLM tokens they would have used
+    rounds_saved: int = 0
+    tokens_saved: int = 0
+
+    def clear(self):
+        self.stalls = self.corrections = self.rounds = self.rounds_saved = self.tokens_saved = 0
+        self.stopped = False
+        self.reason = None
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "stalls": self.stalls,
+            "corrections": self.corrections,
+            "stopped": self.stopped,
+            "reason": self.reason,
+            "rounds": self.rounds,
+            "rounds_saved": self.rounds_saved,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+class StallTotals:
+    """Stall counts over every chat in the process, see selection_totals in speaker_selection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chats = 0
+        self.stalled_chats = 0
+        self.corrections = 0
+        self.stopped = 0
+        self.rounds_saved = 0
+        self.tokens_saved = 0
+
+    def add(self, report: StallReport):
+        with self._lock:
+            self.chats += 1
+            self.stalled_chats += bool(report.stalls)
+            self.corrections += report.corrections
+            self.stopped += report.stopped
+            self.rounds_saved += report.rounds_saved
+            self.tokens_saved += report.tokens_saved
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "chats": self.chats,
+                "stalled_chats": self.stalled_chats,
+                "corrections": self.corrections,
+                "stopped": self.stopped,
+                "rounds_saved": self.rounds_saved,
+                "tokens_saved": self.tokens_saved,
+            }
+
+
+stall_totals = StallTotals()
+
+
+@dataclass
+class Intervention:
+    text: str
+    stop: bool
+
+
+class StallDetector:
+    """
+    Reads a group chat transcript incrementally, see check. One detector per group chat,
+    reset between chats. Messages of the ignored speakers, e.g. the Admin's question and
+    its own corrections, and function results are neither progress nor stalls.
+    """
+
+    def __init__(
+        self,
+        patience: int = DEFAULT_PATIENCE,
+        similarity: float = DEFAULT_SIMILARITY,
+        window: int = DEFAULT_WINDOW,
+        max_corrections: int = DEFAULT_MAX_CORRECTIONS,
+        is_termination_msg: Optional[Callable[[Dict], bool]] = None,
+        ignore: Tuple[str, ...] = ("Admin",),
+    ):
+        self.patience = patience
+        self.similarity = similarity
+        self.window = window
+        self.max_corrections = max_corrections
+        self.is_termination_msg = is_termination_msg
+        self.ignore = ignore
+        self.report = StallReport()
+        self._read = 0
+        self._stalled = 0
+        self._reason: Optional[str] = None
+        self._recent: List[Tuple[str, FrozenSet]] = []
+        self._calls: set = set()
+
+    @property
+    def stopped(self) -> bool:
+        return self.report.stopped
+
+    def reset(self):
+        if self._read:
+            stall_totals.add(self.report)
+        # cleared in place: GroupChatManager selects with a shallow copy of the group chat, sharing the detector
+        self.report.clear()
+        self._read = self._stalled = 0
+        self._reason = None
+        self._recent.clear()
+        self._calls.clear()
+
+    def _no_progress(self, message: Dict) -> Optional[str]:
+        """Why message makes no progress, None when it does."""
+        name = message.get("name")
+        if message.get("function_call"):
+            key = function_call_key(message["function_call"])
+            if key in self._calls:
+                return f"{name} repeated the call {key[0]}({key[1][:200]})"
+            self._calls.add(key)
+            return None
+        content = message.get("content")
+        if not content or not content.strip():
+            return f"{name} sent an empty message"
+        current = shingles(content)
+        for other_name, other in self._recent[-self.window :]:
+            if jaccard(current, other) >= self.similarity:
+                repeated = "repeated its message" if other_name == name else f"repeated {other_name}'s message"
+                self._recent.append((name, current))
+                return f"{name} {repeated}"
+        self._recent.append((name, current))
+        return None
+
+    def check(self, messages: List[Dict], max_round: int) -> Optional[Intervention]:
+        """
+        Reads the messages added since the last check. An Intervention is the Admin's message
+        to post: a correction, or with stop set the end of the chat.
+        """
+        new, self._read = messages[self._read :], len(messages)
+        for message in new:
+            if message.get("role") == "function" or message.get("name") in self.ignore:
+                continue
+            reason = self._no_progress(message)
+            if reason is None:
+                self._stalled = 0
+                continue
+            self.report.stalls += 1
+            self._stalled += 1
+            self._reason = reason
+
+        if not messages or self._stalled < self.patience:
+            return None
+        if self.is_termination_msg is not None and self.is_termination_msg(messages[-1]):
+            return None
+        count, reason = self._stalled, self._reason
+        self._stalled = 0
+        if self.report.corrections < self.max_corrections:
+            self.report.corrections += 1
+            return Intervention(CORRECTION.format(count=count, reason=reason), stop=False)
+
+        # the stop message is one more round
+        self._stop(messages, max_round, len(messages) + 1, reason)
+        return Intervention(STOP.format(reason=reason), stop=True)
+
+    def _stop(self, messages: List[Dict], max_round: int, rounds: int, reason: str):
+        report = self.report
+        report.stopped = True
+        report.reason = reason
+        report.rounds = rounds
+        report.rounds_saved = max(0, max_round - rounds)
+        # each remaining round is at least one LLM call reading the whole transcript and writing
+        # an average message, the transcript growing by that message every round
+        sizes = [count_tokens(_message_text(message)) for message in messages]
+        transcript = sum(sizes)
+        average = transcript // len(sizes) if sizes else 0
+        for _ in range(report.rounds_saved):
+            report.tokens_saved += transcript + average
+            transcript += average
+
+
+def stop_reply(recipient: ConversableAgent, messages=None, sender=None, config: StallDetector = None):
+    """Reply function of the Admin: no reply once the detector stopped the chat, which ends run_chat."""
+    if config is not None and config.stopped:
+        return True, None
+    return False, None
+
+
+@dataclass
+class StallAwareGroupChat(GroupChat):
+    """
+    GroupChat that checks stall_detector before each speaker selection. The Admin posts the
+    detector's correction and the selection goes on from the Admin; when the detector stops
+    the chat the Admin is selected, and stop_reply ends the chat.
+    """
+
+    stall_detector: Optional[StallDetector] = None
+
+    def reset(self):
+        super().reset()
+        if self.stall_detector is not None:
+            self.stall_detector.reset()
+
+    def _post(self, text: str, admin: Agent, selector: ConversableAgent):
+        # what run_chat does with a reply: the manager receives it, then broadcasts it to the others
+        message = {"role": "user", "name": admin.name, "content": text}
+        admin.send(message, selector, request_reply=False, silent=True)
+        self.messages.append(message)
+        for agent in self.agents:
+            if agent != admin:
+                selector.send(message, agent, request_reply=False, silent=True)
+
+    def select_speaker(self, last_speaker: Agent, selector: ConversableAgent):
+        if self.stall_detector is None or self.admin_name not in self.agent_names:
+            return super().select_speaker(last_speaker, selector)
+        intervention = self.stall_detector.check(self.messages, self.max_round)
+        if intervention is None:
+            return super().select_speaker(last_speaker, selector)
+        admin = self.agent_by_name(self.admin_name)
+        self._post(intervention.text, admin, selector)
+        if intervention.stop:
+            return admin
+        return super().select_speaker(admin, selector)
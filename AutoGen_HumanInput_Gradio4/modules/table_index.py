@@ -0,0 +1,182 @@
+"""
+Purpose:
+    Local index over the reflected tables so only the tables relevant to a question
+    go into the prompt, instead of every table of every schema.
+    Scoring is BM25 over table names, column names and comments, with a few domain synonyms.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData
+
+from modules.tokens import count_tokens
+
+DEFAULT_TOP_K = 8
+
+# words the analysts use interchangeably, see the agent prompts in main.py
+SYNONYMS = {
+    "alert": ["alarm", "event"],
+    "alarm": ["alert", "event"],
+    "event": ["alarm", "alert"],
+    "incident": ["alarm"],
+    "quad": ["alarm"],
+    "user": ["specialist", "operator"],
+    "specialist": ["user", "operator"],
+    "camera": ["device"],
+    "transmitter": ["nvr", "system"],
+    "nvr": ["transmitter", "system"],
+    "sla": ["response", "responsetime"],
+    "software": ["cars", "isolation"],
+}
+
+# table names describe a table better than any one of its columns
+TABLE_NAME_WEIGHT = 3
+STOPWORDS = set(
+    "the a an of for in on by and or to is are was what how many much which with per from me show give list this that".split()
+)
+
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def _stem(term: str) -> str:
+    if len(term) > 3 and term.endswith("ies"):
+        return term[:-3] + "y"
+    if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        return term[:-1]
+    return term
+
+
+def split_identifier(name: str) -> List[str]:
+    """
+    Example
+        split_identifier('IndividualAlarmsUS_Day') -> ['individual', 'alarm', 'us', 'day', 'individualalarmsus_day']
+    """
+    terms = [_stem(part.lower()) for part in _CAMEL_RE.findall(name)]
+    whole = name.lower()
+    if whole not in terms:
+        terms.append(whole)
+    return terms
+
+
+def question_terms(question: str) -> List[str]:
+    terms = []
+    for word in re.findall(r"[A-Za-z0-9_]+", question):
+        for term in split_identifier(word):
+            if term in STOPWORDS:
+                continue
+            terms.append(term)
+            terms.extend(SYNONYMS.get(term, []))
+    return terms
+
+
+def canonical_terms(question: str) -> List[str]:
+    """
+    The question's terms in order, stemmed, without stopwords, each synonym group reduced to one term.
+    Example
+        canonical_terms('alerts handled by software') -> ['alarm', 'handled', 'car']
+    """
+    terms = []
+    for word in re.findall(r"[A-Za-z0-9_]+", question):
+        parts = split_identifier(word)
+        # split_identifier ends with the whole word when it has several parts
+        for term in parts[:-1] if len(parts) > 1 else parts:
+            if term not in STOPWORDS:
+                terms.append(min(_stem(synonym) for synonym in [term, *SYNONYMS.get(term, [])]))
+    return terms
+
+
+class TableIndex:
+    """BM25 index with one document per table, built from reflected MetaData."""
+
+    def __init__(self, metadata: MetaData, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents: Dict[str, Counter] = {}
+        self.neighbours: Dict[str, set] = defaultdict(set)
+
+        for table_name, table in metadata.tables.items():
+            terms = Counter()
+            for term in split_identifier(table.name):
+                terms[term] += TABLE_NAME_WEIGHT
+            for column in table.columns:
+                terms.update(split_identifier(column.name))
+                if column.comment:
+                    terms.update(question_terms(column.comment))
+            if table.comment:
+                terms.update(question_terms(table.comment))
+            self.documents[table_name] = terms
+
+            for fk in table.foreign_keys:
+                other = fk.column.table.fullname
+                if other != table_name:
+                    self.neighbours[table_name].add(other)
+                    self.neighbours[other].add(table_name)
+
+        self.lengths = {name: sum(terms.values()) for name, terms in self.documents.items()}
+        self.avg_length = sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0.0
+        document_frequency = Counter()
+        for terms in self.documents.values():
+            document_frequency.update(terms.keys())
+        n = len(self.documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+    def search(self, question: str, k: int = DEFAULT_TOP_K) -> List[Tuple[str, float]]:
+        """Top k (table name, score) pairs, best first. Tables that match nothing are left out."""
+        query = Counter(question_terms(question))
+        scores = []
+        for name, terms in self.documents.items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[name] / (self.avg_length or 1))
+            score = 0.0
+            for term, weight in query.items():
+                tf = terms.get(term)
+                if tf:
+                    score += weight * self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scores.append((name, score))
+        scores.sort(key=lambda pair: (-pair[1], pair[0]))
+        return scores[:k]
+
+    def select(self, question: str, k: int = DEFAULT_TOP_K, expand_foreign_keys: bool = True) -> List[str]:
+        """Top k tables for the question, followed by their foreign-key neighbours."""
+        selected = [name for name, _ in self.search(question, k)]
+        if expand_foreign_keys:
+            for name in list(selected):
+                for neighbour in sorted(self.neighbours.get(name, ())):
+                    if neighbour not in selected and neighbour in self.documents:
+                        selected.append(neighbour)
+        return selected
+
+
+def select_table_definitions(
+    entry, question: Optional[str] = None, token_budget: Optional[int] = None, top_k: int = DEFAULT_TOP_K
+) -> str:
+    """
+    Renders the definitions of the tables relevant to question from a schema cache entry,
+    most relevant first. A table that does not fit in what is left of token_budget is skipped
+    and the next, smaller ones still go in while they fit.
+    Without a question every table is a candidate, in catalog order.
+    """
+    if question:
+        if entry.index is None:
+            entry.index = TableIndex(entry.metadata)
+        table_names = entry.index.select(question, top_k)
+        if not table_names:
+            # nothing matched, better to show everything than nothing
+            table_names = list(entry.definitions)
+    else:
+        table_names = list(entry.definitions)
+
+    definitions = []
+    used_tokens = 0
+    for table_name in table_names:
+        definition = entry.definitions.get(table_name)
+        if definition is None:
+            continue
+        tokens = count_tokens(definition) + 1
+        if token_budget is not None and used_tokens + tokens > token_budget:
+            continue
+        definitions.append(definition)
+        used_tokens += tokens
+    return "\n\n".join(definitions)
@@ -0,0 +1,348 @@
+"""
+Purpose:
+    Build the SQL group chat (Admin, Engineer, Sr_Data_Analyst, Product_Manager and their
+    GroupChatManager) once per configuration, and lend out reset teams per request.
+    Building a team parses the prompts and creates an OpenAI client per agent, a pooled
+    team only needs its history cleared.
+"""
+import json
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import autogen
+
+from modules.cancellation import install_checkpoints
+from modules.speaker_selection import StateMachineGroupChat
+from modules.stall_detector import StallAwareGroupChat, StallDetector, stop_reply
+from modules.tracing import instrument_agents
+
+DEFAULT_MAX_ROUND = 20
+# idle teams kept per configuration, more are built when more requests run at once
+DEFAULT_MAX_IDLE = 8
+SPEAKER_SELECTIONS = ("auto", "state_machine")
+
+# who speaks after whom; after the review the LLM decides whether the SQL or the summary needs another pass
+SQL_TEAM_TRANSITIONS = {
+    "Admin": ["Engineer"],
+    "Engineer": ["Sr_Data_Analyst"],
+    "Sr_Data_Analyst": ["Product_Manager"],
+    "Product_Manager": ["Engineer", "Sr_Data_Analyst"],
+}
+
+
+def is_termination_msg(content):
+    have_content = content.get("content", None) is not None
+    if have_content and "APPROVED" in content["content"]:
+        return True
+    return False
+
+
+class StreamingGroupChatManager(autogen.GroupChatManager):
+    """
+    GroupChatManager that hands every message it receives to listener(message, sender) as well,
+    the admin's question, each agent's reply and each function result, while the chat is still running.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.listener: Optional[Callable[[Dict, autogen.Agent], None]] = None
+
+    def _process_received_message(self, message, sender, silent):
+        super()._process_received_message(message, sender, silent)
+        if self.listener is not None:
+            self.listener(self._message_to_dict(message), sender)
+
+
+@dataclass
+class StallAwareStateMachineGroupChat(StallAwareGroupChat, StateMachineGroupChat):
+    """State machine speaker selection, with the stall detector checked before each selection."""
+
+
+def is_function_error(content: Optional[str]) -> bool:
+    # autogen turns an exception in a function into "Error: ...", run_sql rejections are {"error": ...}
+    if not content or content.startswith("Error"):
+        return True
+    try:
+        result = json.loads(content)
+    except ValueError:
+        return False
+    return isinstance(result, dict) and "error" in result
+
+
+def is_empty_result(content: Optional[str]) -> bool:
+    """True when a run_sql result has no rows, in any of the output formats of modules/formats.py."""
+    # the truncation note is not a row
+    lines = [line for line in (content or "").splitlines() if line.strip() and not line.startswith("-- truncated")]
+    try:
+        result = json.loads("\n".join(lines))
+    except ValueError:
+        # csv is its header line, markdown its header and separator lines
+        header_lines = 2 if lines and lines[0].startswith("|") else 1
+        return len(lines) <= header_lines
+    if isinstance(result, list):
+        return not result
+    if isinstance(result, dict):
+        if set(result) == {"columns", "rows"}:
+            return not result["rows"]
+        return all(isinstance(values, list) and not values for values in result.values())
+    return False
+
+
+@dataclass(frozen=True)
+class TeamPrompts:
+    user_proxy: str
+    data_engineer: str
+    sr_data_analyst: str
+    product_manager: str
+
+
+@dataclass
+class AgentTeam:
+    user_proxy: autogen.UserProxyAgent
+    data_engineer: autogen.AssistantAgent
+    sr_data_analyst: autogen.AssistantAgent
+    product_manager: autogen.AssistantAgent
+    groupchat: autogen.GroupChat
+    manager: StreamingGroupChatManager
+
+    @property
+    def agents(self) -> List[autogen.ConversableAgent]:
+        return [self.user_proxy, self.data_engineer, self.sr_data_analyst, self.product_manager, self.manager]
+
+    def selection_stats(self) -> Optional[Dict[str, int]]:
+        """How the speakers of the current chat were picked, None with the default selection."""
+        if isinstance(self.groupchat, StateMachineGroupChat):
+            return self.groupchat.stats.as_dict()
+        return None
+
+    def stall_report(self) -> Optional[Dict[str, object]]:
+        """Stalls of the current chat and what stopping it saved, None without stall detection."""
+        detector = getattr(self.groupchat, "stall_detector", None)
+        return detector.report.as_dict() if detector is not None else None
+
+    def reset(self):
+        """Forgets every message, so the next request starts from a clean team."""
+        for agent in self.agents:
+            agent.reset()
+        self.groupchat.reset()
+
+    def bind_functions(self, function_map: Dict[str, Callable]):
+        """Points the analyst's functions at this request's objects, e.g. {'run_sql': db.run_sql}."""
+        self.sr_data_analyst.register_function(function_map)
+
+    def initiate_chat(self, message: str, listener: Optional[Callable[[Dict, autogen.Agent], None]] = None):
+        """Runs the chat, listener(message, sender) is called with each message the manager receives."""
+        self.manager.listener = listener
+        try:
+            self.user_proxy.initiate_chat(self.manager, clear_history=False, message=message)
+        finally:
+            self.manager.listener = None
+
+    def approved_plan(self) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        (sql, summary) when the chat ended with the Product Manager's approval: the last run_sql
+        call that returned rows, and the analyst's last message after it. None otherwise, an
+        approval of an error or of an empty result is not a plan worth replaying.
+        """
+        messages = self.groupchat.messages
+        if not messages or messages[-1].get("name") != self.product_manager.name:
+            return None
+        if not is_termination_msg(messages[-1]):
+            return None
+        sql = summary = None
+        for i, message in enumerate(messages):
+            function_call = message.get("function_call")
+            if function_call and dict(function_call).get("name") == "run_sql":
+                result = messages[i + 1] if i + 1 < len(messages) else {}
+                content = result.get("content")
+                if result.get("role") == "function" and not is_function_error(content) and not is_empty_result(content):
+                    try:
+                        sql = json.loads(dict(function_call).get("arguments") or "{}").get("sql")
+                    except (TypeError, ValueError, AttributeError):
+                        continue
+                    summary = None
+            elif sql and message.get("name") == self.sr_data_analyst.name and message.get("content"):
+                summary = message["content"]
+        return (sql, summary) if sql else None
+
+    def chat_history(self) -> List[List[Optional[str]]]:
+        """[[name, content], ...] of the chat, as shown by gr.Chatbot."""
+        return [
+            [message.get("name"), message.get("content")]
+            for messages in self.manager.chat_messages.values()
+            for message in messages
+            if "content" in message
+        ]
+
+
+def build_team(
+    llm_config: Dict[str, Any],
+    prompts: TeamPrompts,
+    max_round: int = DEFAULT_MAX_ROUND,
+    speaker_selection: str = "auto",
+    stall_patience: Optional[int] = None,
+) -> AgentTeam:
+    """
+    speaker_selection 'auto' asks the LLM for the next speaker every round,
+    'state_machine' follows SQL_TEAM_TRANSITIONS and only asks it after the Product Manager.
+    stall_patience is the number of messages in a row without progress before the Admin corrects
+    the team, and stops the chat the second time, see stall_detector. None never steps in.
+    """
+    if speaker_selection not in SPEAKER_SELECTIONS:
+        raise ValueError(f"speaker_selection must be one of {SPEAKER_SELECTIONS}, got {speaker_selection!r}")
+
+    # admin user proxy agent - takes in the prompt and manages the group chat
+    user_proxy = autogen.UserProxyAgent(
+        name="Admin",
+        system_message=prompts.user_proxy,
+        code_execution_config=False,
+        human_input_mode="NEVER",
+        is_termination_msg=is_termination_msg,
+    )
+
+    # data engineer agent - generates the sql query
+    data_engineer = autogen.AssistantAgent(
+        name="Engineer",
+        llm_config=llm_config,
+        system_message=prompts.data_engineer,
+        code_execution_config=False,
+        human_input_mode="NEVER",
+        is_termination_msg=is_termination_msg,
+    )
+
+    # sr data analyst agent - run the sql query and generate the response
+    sr_data_analyst = autogen.AssistantAgent(
+        name="Sr_Data_Analyst",
+        llm_config=llm_config,
+        system_message=prompts.sr_data_analyst,
+        code_execution_config=False,
+        human_input_mode="NEVER",
+        is_termination_msg=is_termination_msg,
+    )
+
+    # product manager - validate the response to make sure it's correct
+    product_manager = autogen.AssistantAgent(
+        name="Product_Manager",
+        llm_config=llm_config,
+        system_message=prompts.product_manager,
+        code_execution_config=False,
+        human_input_mode="NEVER",
+        is_termination_msg=is_termination_msg,
+    )
+
+    agents = [user_proxy, data_engineer, sr_data_analyst, product_manager]
+    stall_detector = None
+    if stall_patience:
+        stall_detector = StallDetector(
+            patience=stall_patience, is_termination_msg=is_termination_msg, ignore=(user_proxy.name,)
+        )
+        user_proxy.register_reply([autogen.Agent, None], stop_reply, config=stall_detector)
+    if speaker_selection == "state_machine":
+        groupchat_class = StallAwareStateMachineGroupChat if stall_detector else StateMachineGroupChat
+        groupchat = groupchat_class(
+            agents=agents,
+            messages=[],
+            max_round=max_round,
+            transitions=SQL_TEAM_TRANSITIONS,
+            is_termination_msg=is_termination_msg,
+            **({"stall_detector": stall_detector} if stall_detector else {}),
+        )
+    elif stall_detector:
+        groupchat = StallAwareGroupChat(agents=agents, messages=[], max_round=max_round, stall_detector=stall_detector)
+    else:
+        groupchat = autogen.GroupChat(agents=agents, messages=[], max_round=max_round)
+    manager = StreamingGroupChatManager(groupchat=groupchat, llm_config=llm_config)
+    # replies stop with ChatCancelled once the CancelToken active on the chat's thread is cancelled
+    install_checkpoints([*agents, manager])
+    # spans are only recorded inside tracing.tracer.chat()
+    instrument_agents([*agents, manager])
+    return AgentTeam(user_proxy, data_engineer, sr_data_analyst, product_manager, groupchat, manager)
+
+
+class TeamPool:
+    """
+    Idle teams of one configuration. A team is lent to one request at a time and reset
+    on the way out and on the way back, so requests never see each other's messages.
+    Example
+        with pool.acquire({"run_sql": db.run_sql}) as team:
+            team.initiate_chat(prompt)
+            history = team.chat_history()
+    """
+
+    def __init__(self, factory: Callable[[], AgentTeam], max_idle: int = DEFAULT_MAX_IDLE):
+        self.factory = factory
+        self.max_idle = max_idle
+        self._idle: List[AgentTeam] = []
+        self._lock = threading.Lock()
+        self.built = 0
+        self.reused = 0
+        self.in_use = 0
+
+    def _checkout(self) -> AgentTeam:
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.built += 1
+        try:
+            # built outside the lock, it is the slow part
+            return self.factory()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    def _checkin(self, team: AgentTeam):
+        team.reset()
+        with self._lock:
+            self.in_use -= 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(team)
+
+    @contextmanager
+    def acquire(self, function_map: Optional[Dict[str, Callable]] = None):
+        team = self._checkout()
+        try:
+            # a team that broke mid-chat last time may still hold messages
+            team.reset()
+            if function_map:
+                team.bind_functions(function_map)
+        except BaseException:
+            self._checkin(team)
+            raise
+        try:
+            yield team
+        finally:
+            self._checkin(team)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"built": self.built, "reused": self.reused, "in_use": self.in_use, "idle": len(self._idle)}
+
+
+_pools: Dict[str, TeamPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_team_pool(
+    llm_config: Dict[str, Any],
+    prompts: TeamPrompts,
+    max_round: int = DEFAULT_MAX_ROUND,
+    max_idle: int = DEFAULT_MAX_IDLE,
+    speaker_selection: str = "auto",
+    stall_patience: Optional[int] = None,
+) -> TeamPool:
+    """The process-wide pool for this configuration, created on first use."""
+    key = json.dumps(
+        [llm_config, asdict(prompts), max_round, speaker_selection, stall_patience], sort_keys=True, default=str
+    )
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = TeamPool(
+                lambda: build_team(llm_config, prompts, max_round, speaker_selection, stall_patience), max_idle
+            )
+        return pool
@@ -0,0 +1,40 @@
+"""
+Purpose:
+    Local token counting for prompt budgets, no API call needed.
+"""
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_MODEL = "gpt-35-turbo"
+# used for deployment names tiktoken does not know, e.g. Azure's gpt-35-turbo
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    """The model's encoding, None when tiktoken is missing or cannot load it. Tried once per model."""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        # tiktoken downloads the encoding file on first use, which fails on hosts without internet access
+        print(f"tiktoken cannot load the encoding for {model!r}, estimating 4 characters per token: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Number of tokens in text, roughly 4 characters per token when tiktoken is missing or offline."""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,454 @@
+"""
+Purpose:
+    Spans for group chats: one per chat, per round (speaker selection + the speaker's reply),
+    per agent reply function, per speaker selection and per function call, with their duration
+    and the prompt / completion tokens spent. Written as JSON lines to TRACE_FILE, and exported
+    to OpenTelemetry as well when TRACE_OTEL=1 and the opentelemetry package is installed.
+    Example
+        instrument_agents([user_proxy, engineer, manager])
+        with tracer.chat(question=question):
+            user_proxy.initiate_chat(manager, message=question)
+    Summarize a trace file, p50/p95 per agent and per round:
+        python -m modules.tracing traces.jsonl
+"""
+import argparse
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+import autogen
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# spans as JSON lines, e.g. TRACE_FILE=.cache/traces.jsonl
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# spans to the OpenTelemetry tracer provider the app configured, e.g. with an OTLP exporter
+TRACE_OTEL = os.environ.get("TRACE_OTEL", "0") == "1"
+# reply functions that decline quicker than this and return nothing are not worth a span
+MIN_REPLY_SPAN_MS = 1.0
+
+_current = contextvars.ContextVar("chat_trace", default=None)
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent: Optional["Span"]
+    name: str
+    # chat, round, reply, selection or function
+    kind: str
+    agent: Optional[str]
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    # epoch seconds
+    start: float = field(default_factory=time.time)
+    duration_ms: float = 0.0
+    _perf_start: float = field(default_factory=time.perf_counter)
+    _otel: Any = None
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int):
+        self.attributes["prompt_tokens"] = self.attributes.get("prompt_tokens", 0) + prompt_tokens
+        self.attributes["completion_tokens"] = self.attributes.get("completion_tokens", 0) + completion_tokens
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "kind": self.kind,
+            "agent": self.agent,
+            "start": self.start,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+        }
+
+
+class ChatTrace:
+    """The spans of one chat. Lives in a context variable of the thread running the chat."""
+
+    def __init__(self, tracer: "Tracer", attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        # spans open inside the current round, innermost last
+        self._stack: List[Span] = []
+        self.root = self._new_span(None, "chat", "chat", None, attributes)
+        self.round: Optional[Span] = None
+        self.rounds = 0
+
+    def _new_span(self, parent, name, kind, agent, attributes) -> Span:
+        span = Span(self.trace_id, uuid.uuid4().hex[:16], parent, name, kind, agent, attributes)
+        self.tracer.started(span)
+        return span
+
+    def start(self, name: str, kind: str, agent: Optional[str], **attributes) -> Span:
+        parent = self._stack[-1] if self._stack else self.round or self.root
+        span = self._new_span(parent, name, kind, agent, attributes)
+        self._stack.append(span)
+        return span
+
+    def end(self, span: Span, **attributes):
+        span.duration_ms = (time.perf_counter() - span._perf_start) * 1000
+        span.attributes.update(attributes)
+        if span in self._stack:
+            self._stack.remove(span)
+        self.tracer.export(span)
+
+    def discard(self, span: Span):
+        """Drops a span that turned out not to be worth recording."""
+        if span in self._stack:
+            self._stack.remove(span)
+        self.tracer.discarded(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str, agent: Optional[str] = None, **attributes):
+        span = self.start(name, kind, agent, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.end(span)
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int):
+        """Counted on the innermost open span, its round and the chat."""
+        spans = [self._stack[-1] if self._stack else None, self.round, self.root]
+        for span in {id(span): span for span in spans if span is not None}.values():
+            span.add_tokens(prompt_tokens, completion_tokens)
+
+    def next_round(self, speaker: Optional[str]):
+        """
+        Called with each message the manager receives: ends the round that produced it, spoken
+        by speaker, and starts the next one. The first message, the question, only starts round 1.
+        """
+        if self.round is not None:
+            self.round.agent = speaker
+            self.round.name = f"round {self.rounds}: {speaker}"
+            self._end_round()
+        self.rounds += 1
+        self.round = self._new_span(self.root, f"round {self.rounds}", "round", None, {"round": self.rounds})
+
+    def _end_round(self):
+        round_span, self.round = self.round, None
+        self.end(round_span)
+
+    def close(self, error: Optional[BaseException] = None):
+        if self.round is not None:
+            # the selection and termination check after the last message
+            self.round.attributes["final"] = True
+            self._end_round()
+        if error is not None:
+            self.root.attributes["error"] = f"{type(error).__name__}: {error}"
+        self.end(self.root, rounds=max(self.rounds - 1, 0))
+
+
+class Tracer:
+    """
+    Writes finished spans as JSON lines to path, and mirrors them to OpenTelemetry when otel is set.
+    With neither, chat() is a no-op and instrumented agents run untouched.
+    """
+
+    def __init__(self, path: Optional[str] = None, otel: bool = False, service_name: str = "sql-query-assistant"):
+        if otel and otel_trace is None:
+            raise ImportError("TRACE_OTEL=1 needs the opentelemetry-api package, and an SDK to export")
+        self.path = path
+        self._otel_tracer = otel_trace.get_tracer(service_name) if otel else None
+        self._lock = threading.Lock()
+        self._file = None
+        self.exported = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self._otel_tracer)
+
+    @contextmanager
+    def chat(self, **attributes):
+        """Traces the chat run inside the block, on this thread."""
+        if not self.enabled:
+            yield None
+            return
+        trace = ChatTrace(self, attributes)
+        token = _current.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.close(e)
+            raise
+        else:
+            trace.close()
+        finally:
+            _current.reset(token)
+
+    def _start_otel(self, span: Span):
+        if span._otel is None:
+            context = None
+            if span.parent is not None:
+                self._start_otel(span.parent)
+                context = otel_trace.set_span_in_context(span.parent._otel)
+            span._otel = self._otel_tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+
+    def started(self, span: Span):
+        # reply spans may still be discarded, they start in OpenTelemetry on export or with their first child
+        if self._otel_tracer is not None and span.kind != "reply":
+            self._start_otel(span)
+
+    def discarded(self, span: Span):
+        if span._otel is not None:
+            span._otel.end()
+
+    def export(self, span: Span):
+        if self._otel_tracer is not None:
+            self._start_otel(span)
+            attributes = {f"chat.{key}": value for key, value in span.attributes.items() if value is not None}
+            attributes["chat.kind"] = span.kind
+            if span.agent:
+                attributes["chat.agent"] = span.agent
+            span._otel.update_name(span.name)
+            span._otel.set_attributes(attributes)
+            span._otel.end(end_time=int((span.start + span.duration_ms / 1000) * 1e9))
+        if self.path:
+            line = json.dumps(span.as_dict(), default=str) + "\n"
+            with self._lock:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(line)
+                self._file.flush()
+                self.exported += 1
+
+
+def current_trace() -> Optional[ChatTrace]:
+    return _current.get()
+
+
+# shared by every chat in this process
+tracer = Tracer(TRACE_FILE, TRACE_OTEL)
+
+
+# ------------------ agent instrumentation ------------------
+
+
+class _TracedClient:
+    """The agent's OpenAIWrapper, counting the tokens of each completion on the current trace."""
+
+    def __init__(self, client, trace: ChatTrace):
+        self._client = client
+        self._trace = trace
+
+    def create(self, **config):
+        response = self._client.create(**config)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self._trace.add_tokens(usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _traced_reply(agent, reply_func):
+    name = getattr(reply_func, "__name__", "reply")
+
+    def traced(recipient, messages=None, sender=None, config=None):
+        trace = _current.get()
+        # the manager's run_chat spans the whole chat, its rounds are traced instead
+        if trace is None or name == "run_chat":
+            return reply_func(recipient, messages=messages, sender=sender, config=config)
+        if name == "generate_oai_reply":
+            client = config if config is not None else recipient.client
+            config = _TracedClient(client, trace) if client is not None else None
+        span = trace.start(f"{agent.name}.{name}", "reply", agent.name)
+        try:
+            final, reply = reply_func(recipient, messages=messages, sender=sender, config=config)
+        except BaseException as e:
+            trace.end(span, error=f"{type(e).__name__}: {e}")
+            raise
+        if final or (time.perf_counter() - span._perf_start) * 1000 >= MIN_REPLY_SPAN_MS:
+            trace.end(span, final=final)
+        else:
+            trace.discard(span)
+        return final, reply
+
+    traced.__name__ = name
+    return traced
+
+
+def instrument_agents(agents: Iterable):
+    """
+    Wraps the reply functions, function calls, code execution and speaker selection of each agent,
+    once. The wrappers only record when a chat is traced on the calling thread.
+    """
+    for agent in agents:
+        if getattr(agent, "_traced", False):
+            continue
+        agent._traced = True
+        for reply_func_tuple in agent._reply_func_list:
+            # generate_reply tells the async reply functions apart by their type, they are left as they are
+            if not inspect.iscoroutinefunction(reply_func_tuple["reply_func"]):
+                reply_func_tuple["reply_func"] = _traced_reply(agent, reply_func_tuple["reply_func"])
+
+        execute_function = agent.execute_function
+
+        def traced_execute_function(func_call, agent=agent, execute_function=execute_function):
+            trace = _current.get()
+            if trace is None:
+                return execute_function(func_call)
+            func_call = dict(func_call)
+            with trace.span(f"function {func_call.get('name')}", "function", agent.name) as span:
+                span.attributes["function"] = func_call.get("name")
+                span.attributes["arguments_chars"] = len(func_call.get("arguments") or "")
+                is_success, result = execute_function(func_call)
+                content = str(result.get("content", ""))
+                span.attributes["result_chars"] = len(content)
+                span.attributes["success"] = is_success and not content.startswith("Error")
+            return is_success, result
+
+        agent.execute_function = traced_execute_function
+
+        run_code = agent.run_code
+
+        def traced_run_code(code, agent=agent, run_code=run_code, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return run_code(code, **kwargs)
+            with trace.span("run_code", "function", agent.name, lang=kwargs.get("lang")) as span:
+                exitcode, logs, image = run_code(code, **kwargs)
+                span.attributes["exitcode"] = exitcode
+            return exitcode, logs, image
+
+        agent.run_code = traced_run_code
+
+        if isinstance(agent, autogen.GroupChatManager):
+            _instrument_manager(agent)
+
+
+def _instrument_manager(manager):
+    # GroupChat.select_speaker asks the manager's LLM directly, not through its reply functions
+    generate_oai_reply = manager.generate_oai_reply
+
+    def traced_generate_oai_reply(messages=None, sender=None, config=None):
+        trace = _current.get()
+        if trace is None:
+            return generate_oai_reply(messages=messages, sender=sender, config=config)
+        client = config if config is not None else manager.client
+        with trace.span("select_speaker", "selection", manager.name):
+            return generate_oai_reply(
+                messages=messages, sender=sender, config=_TracedClient(client, trace) if client else None
+            )
+
+    manager.generate_oai_reply = traced_generate_oai_reply
+
+    process_received_message = manager._process_received_message
+
+    def traced_process_received_message(message, sender, silent):
+        process_received_message(message, sender, silent)
+        trace = _current.get()
+        if trace is not None:
+            trace.next_round(sender.name)
+
+    manager._process_received_message = traced_process_received_message
+
+
+# ------------------ summary ------------------
+
+
+def read_spans(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    spans = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def summarize(spans: List[Dict[str, Any]], group_by) -> List[Dict[str, Any]]:
+    """One row per group: count, p50 / p95 / total ms, mean prompt and completion tokens."""
+    groups = defaultdict(list)
+    for span in spans:
+        key = group_by(span)
+        if key is not None:
+            groups[key].append(span)
+    rows = []
+    for key, members in groups.items():
+        durations = [span["duration_ms"] for span in members]
+        prompt = [span["attributes"].get("prompt_tokens", 0) for span in members]
+        completion = [span["attributes"].get("completion_tokens", 0) for span in members]
+        rows.append(
+            {
+                "group": key,
+                "count": len(members),
+                "p50_ms": _percentile(durations, 0.5),
+                "p95_ms": _percentile(durations, 0.95),
+                "total_ms": sum(durations),
+                "prompt_tokens": sum(prompt) / len(members),
+                "completion_tokens": sum(completion) / len(members),
+            }
+        )
+    return rows
+
+
+def _print_table(title: str, rows: List[Dict[str, Any]]):
+    print(f"\n{title}")
+    print(f"{'':<32}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}{'prompt tok':>12}{'compl tok':>11}")
+    for row in rows:
+        print(
+            f"{str(row['group'])[:31]:<32}{row['count']:>7}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+            f"{row['total_ms'] / 1000:>10.2f}{row['prompt_tokens']:>12.0f}{row['completion_tokens']:>11.0f}"
+        )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="p50/p95 per agent and per round of traced group chats")
+    parser.add_argument("paths", nargs="+", help="JSONL trace files, see TRACE_FILE")
+    args = parser.parse_args(argv)
+
+    spans = read_spans(args.paths)
+    chats = [span for span in spans if span["kind"] == "chat"]
+    print(f"{len(chats)} chats, {len(spans)} spans")
+    _print_table("chats", summarize(chats, lambda span: "chat"))
+    # what each agent spends its turns on: replies and the functions it runs
+    _print_table(
+        "per agent",
+        sorted(
+            summarize(
+                spans,
+                lambda span: f"{span['agent']} {span['kind']}"
+                if span["kind"] in ("reply", "function") and span["attributes"].get("final", True)
+                else None,
+            ),
+            key=lambda row: -row["total_ms"],
+        ),
+    )
+    _print_table(
+        "speaker selection", summarize(spans, lambda span: span["agent"] if span["kind"] == "selection" else None)
+    )
+    _print_table(
+        "per round",
+        sorted(
+            summarize(spans, lambda span: span["attributes"].get("round") if span["kind"] == "round" else None),
+            key=lambda row: row["group"],
+        ),
+    )
+    _print_table(
+        "per function", summarize(spans, lambda span: span["name"] if span["kind"] == "function" else None)
+    )
+
+
+if __name__ == "__main__":
+    main()
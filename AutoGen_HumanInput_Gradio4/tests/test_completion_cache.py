@@ -0,0 +1,51 @@
+import itertools
+
+from modules import completion_cache
+from modules.completion_cache import CompletionCache, cache_key
+
+
+def messages(content):
+    return [{"role": "user", "content": content}]
+
+
+def test_key_ignores_line_endings_and_trailing_whitespace():
+    windows = messages("Summarize:\r\nrow 1  \r\n")
+    assert cache_key("gpt-4", windows) == cache_key("gpt-4", messages("Summarize:\nrow 1"))
+    assert cache_key("gpt-4", messages("q")) != cache_key("gpt-35-turbo", messages("q"))
+    assert cache_key("gpt-4", messages("q")) != cache_key("gpt-4", messages("q"), temperature=0)
+
+
+def test_completions_persist_across_instances(tmp_path):
+    path = str(tmp_path / "completions.sqlite")
+    CompletionCache(path).put("gpt-4", messages("q"), "answer")
+    cache = CompletionCache(path)
+    assert cache.get("gpt-4", messages("q")) == "answer"
+    assert cache.get("gpt-4", messages("other")) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_get_or_call_does_not_store_empty_completions(tmp_path):
+    cache = CompletionCache(str(tmp_path / "completions.sqlite"))
+    calls = []
+
+    def call():
+        calls.append(1)
+        return ""
+
+    cache.get_or_call("gpt-4", messages("q"), call)
+    cache.get_or_call("gpt-4", messages("q"), call)
+    assert len(calls) == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_completions_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(completion_cache.time, "time", lambda: next(clock))
+    cache = CompletionCache(str(tmp_path / "completions.sqlite"), max_bytes=30, touch_interval=0)
+    cache.put("gpt-4", messages("a"), "x" * 10)
+    cache.put("gpt-4", messages("b"), "x" * 10)
+    assert cache.get("gpt-4", messages("a")) is not None
+    cache.put("gpt-4", messages("c"), "x" * 15)
+    assert cache.get("gpt-4", messages("b")) is None
+    assert cache.get("gpt-4", messages("a")) is not None
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,96 @@
+import json
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from modules import cost_guard
+from modules.cost_guard import CostGuard, QueryRejected, estimate_mssql
+from modules.db import SQLManager
+
+
+@pytest.fixture
+def sqlite_url(tmp_path):
+    path = tmp_path / "guard.sqlite"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE Alarm (Id INTEGER PRIMARY KEY, SiteId INTEGER)")
+    connection.executemany("INSERT INTO Alarm (SiteId) VALUES (?)", [(i % 7,) for i in range(500)])
+    connection.commit()
+    connection.close()
+    return f"sqlite:///{path}"
+
+
+def test_subquery_alias_is_not_counted(sqlite_url):
+    db = SQLManager(cost_guard=CostGuard(), row_limit=None)
+    db.connect_with_url(sqlite_url)
+    result = json.loads(db.run_sql("SELECT COUNT(*) AS n FROM (SELECT SiteId FROM Alarm GROUP BY SiteId) s"))
+    assert result == [{"n": 7}]
+
+
+def test_scan_is_estimated_from_table_size(sqlite_url):
+    guard = CostGuard(max_rows=None, max_cost={"sqlite": 100})
+    with create_engine(sqlite_url).connect() as connection:
+        with pytest.raises(QueryRejected) as rejected:
+            guard.check(connection, "SELECT * FROM Alarm")
+        assert rejected.value.details["cost"] == 500
+
+
+def test_sqlite_stat1_is_preferred(sqlite_url):
+    connection = sqlite3.connect(sqlite_url[len("sqlite:///") :])
+    connection.execute("ANALYZE")
+    connection.execute("UPDATE sqlite_stat1 SET stat = '42' WHERE tbl = 'Alarm'")
+    connection.commit()
+    connection.close()
+    with create_engine(sqlite_url).connect() as connection:
+        assert CostGuard(max_rows=None).check(connection, "SELECT * FROM Alarm").cost == 42
+
+
+def test_estimator_failure_is_unknown_cost(sqlite_url):
+    guard = CostGuard()
+    with create_engine(sqlite_url).connect() as connection:
+        estimate = guard.check(connection, "SELECT * FROM Missing")
+    assert estimate.cost is None and estimate.source.startswith("unknown")
+    assert guard.failed == 1
+
+
+SHOWPLAN = (
+    '<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan"><BatchSequence><Batch>'
+    '<Statements><StmtSimple StatementEstRows="{rows}" StatementSubTreeCost="12.5"><QueryPlan>{plan}</QueryPlan>'
+    "</StmtSimple></Statements></Batch></BatchSequence></ShowPlanXML>"
+)
+SCAN = '<RelOp PhysicalOp="Clustered Index Scan" EstimateRows="2000000"/>'
+
+
+class ShowplanResult:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def scalar(self):
+        return self.plan
+
+
+class ShowplanConnection:
+    """SHOWPLAN_XML of a 2M row scan, with the estimate capped by TOP like SQL Server does."""
+
+    def __init__(self):
+        self.estimated = []
+
+    def exec_driver_sql(self, sql):
+        if not sql.startswith("SET SHOWPLAN_XML"):
+            self.estimated.append(sql)
+        top = "LIMIT" in sql.upper()
+        plan = f'<RelOp PhysicalOp="Top" EstimateRows="501">{SCAN}</RelOp>' if top else SCAN
+        return ShowplanResult(SHOWPLAN.format(rows=501 if top else 2000000, plan=plan))
+
+
+def test_a_large_scan_is_rejected_although_run_sql_adds_a_row_limit(sqlite_url, monkeypatch):
+    showplan = ShowplanConnection()
+    monkeypatch.setitem(cost_guard.ESTIMATORS, "sqlite", lambda connection, sql: estimate_mssql(showplan, sql))
+    db = SQLManager(cost_guard=CostGuard(max_rows=100_000), row_limit=501)
+    db.connect_with_url(sqlite_url)
+
+    result = json.loads(db.run_sql("SELECT * FROM Alarm"))
+    assert (result["reason"], result["rows"]) == ("estimated_rows_exceeded", 2000000)
+    assert showplan.estimated == ["SELECT * FROM Alarm"]
+    # a limit the agent wrote itself is kept, those rows are all it asked for
+    assert len(json.loads(db.run_sql("SELECT * FROM Alarm LIMIT 10"))) == 10
@@ -0,0 +1,42 @@
+import sqlite3
+
+import pytest
+
+from modules.db import SQLManager
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "db.sqlite"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE Site (Id INTEGER PRIMARY KEY, Region TEXT NOT NULL, Name TEXT)")
+    connection.executemany(
+        "INSERT INTO Site (Region, Name) VALUES (?, ?)", [(f"r{i % 3}", None if i % 5 else "x") for i in range(95)]
+    )
+    connection.execute("CREATE TABLE Log (SiteId INTEGER NOT NULL, Msg TEXT)")
+    connection.executemany("INSERT INTO Log VALUES (?, ?)", [(i % 10, str(i)) for i in range(100)])
+    connection.commit()
+    connection.close()
+    manager = SQLManager(row_limit=None)
+    manager.connect_with_url(f"sqlite:///{path}")
+    return manager
+
+
+def test_iter_all_pages_by_primary_key(db):
+    assert [row.Id for row in db.iter_all("Site", page_size=10)] == list(range(1, 96))
+
+
+def test_iter_all_order_by_is_made_unique(db):
+    rows = list(db.iter_all("Site", page_size=7, order_by=["Region"]))
+    assert sorted(row.Id for row in rows) == list(range(1, 96))
+    assert [(row.Region, row.Id) for row in rows] == sorted((row.Region, row.Id) for row in rows)
+
+
+def test_iter_all_refuses_a_key_that_is_not_unique(db):
+    with pytest.raises(ValueError):
+        list(db.iter_all("Log", page_size=10, order_by=["SiteId"]))
+
+
+def test_iter_all_refuses_nullable_order_by(db):
+    with pytest.raises(ValueError):
+        list(db.iter_all("Site", page_size=10, order_by=["Name"]))
@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from sqlalchemy.engine import URL
+
+from modules import engine_registry
+from modules.engine_registry import EngineRegistry
+
+
+def test_one_engine_per_url():
+    registry = EngineRegistry()
+    try:
+        assert registry.get_engine("sqlite://") is registry.get_engine("sqlite://")
+        with registry.session_scope("sqlite://") as session:
+            assert session.connection().exec_driver_sql("SELECT 1").scalar() == 1
+        assert registry.metrics()["sqlite://"]["checkouts"] == 1
+    finally:
+        registry.dispose()
+
+
+def test_urls_that_only_differ_in_their_password_get_their_own_engine(monkeypatch):
+    # no PostgreSQL driver needed, the engine is only created
+    monkeypatch.setattr(engine_registry, "create_engine", lambda url, **options: SimpleNamespace(url=url))
+    registry = EngineRegistry()
+    first = URL.create("postgresql", username="app", password="first", host="db", database="alerts")
+    second = first.set(password="second")
+    assert str(first) == str(second)
+    assert registry.get_engine(first) is not registry.get_engine(second)
+    assert registry.get_engine(second).url == "postgresql://app:second@db/alerts"
+    assert registry.get_engine(first) is registry.get_engine("postgresql://app:first@db/alerts")
@@ -0,0 +1,72 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from modules import formats
+from modules.db import BoundedRowEncoder
+from modules.formats import AUTO_PREFERENCE, estimate_token_counts, format_rows, format_token_counts, shorten
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (Decimal("1234567.89"), 1234567.89),
+        (Decimal("12.500000"), 12.5),
+        (Decimal("1E+3"), 1000),
+        (Decimal("12345678901234567890.123456789"), "12345678901234567890.123456789"),
+        (1234567.89, 1234567.89),
+        (0.1 + 0.2, 0.1 + 0.2),
+        (datetime(2023, 11, 1), "2023-11-01"),
+    ],
+)
+def test_shorten_keeps_every_digit(value, expected):
+    assert shorten(value) == expected
+    assert type(shorten(value)) is type(expected)
+
+
+def test_shorten_cuts_long_strings():
+    assert shorten("x" * 300, max_string=10) == "x" * 9 + "…"
+
+
+@pytest.mark.parametrize("output_format", ["json", "csv", "tuples"])
+def test_format_rows_keeps_amounts(output_format):
+    assert "1234567.89" in format_rows(["Amount"], [(Decimal("1234567.89"),)], output_format)
+
+
+COLUMNS = ["SiteId", "AlarmType", "ResponseTime"]
+
+
+def alarm_rows(count):
+    return [[i, ["Door", "Fire", "Intrusion"][i % 3], i * 0.25] for i in range(count)]
+
+
+def test_token_estimate_is_exact_for_a_sample_sized_result():
+    rows = alarm_rows(formats.TOKEN_SAMPLE_ROWS)
+    assert estimate_token_counts(COLUMNS, rows) == format_token_counts(COLUMNS, rows)
+
+
+def test_token_estimate_of_a_large_result_is_close():
+    rows = alarm_rows(2000)
+    estimated, exact = estimate_token_counts(COLUMNS, rows), format_token_counts(COLUMNS, rows)
+    for name in AUTO_PREFERENCE:
+        assert abs(estimated[name] - exact[name]) <= 0.1 * exact[name]
+
+
+def test_auto_encodes_only_the_chosen_format(monkeypatch):
+    rendered = []
+    render_rows = formats.RowFormat.render_rows
+
+    def counting_render_rows(self, rows):
+        rendered.append((self.name, len(rows)))
+        return render_rows(self, rows)
+
+    monkeypatch.setattr(formats.RowFormat, "render_rows", counting_render_rows)
+    encoder = BoundedRowEncoder(COLUMNS, max_rows=1000, max_bytes=10**6, output_format="auto", token_budget=10)
+    for row in alarm_rows(500):
+        assert encoder.add(row)
+    result = encoder.getvalue()
+    chosen = min(encoder.token_counts, key=encoder.token_counts.get)
+    # every format measures the sample, one format encodes all 500 rows
+    assert [name for name, count in rendered if count == 500] == [chosen]
+    assert result == format_rows(COLUMNS, alarm_rows(500), chosen)
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from benchmarks import StubLLMHandler, start_stub_llm_server
+from modules.llm import AsyncLLMClient, LLMError, SSEDecoder
+
+
+def test_sse_decoder_joins_events_split_across_chunks():
+    decoder = SSEDecoder()
+    assert decoder.feed(b'data: {"a"') == []
+    assert decoder.feed(b": 1}\n\ndata: [DONE]\n\n") == ['{"a": 1}', "[DONE]"]
+
+
+def test_sse_decoder_keeps_utf8_characters_split_across_chunks():
+    event = "data: café\n\n".encode("utf-8")
+    split = event.index(b"\xa9")
+    decoder = SSEDecoder()
+    assert decoder.feed(event[:split]) == []
+    assert decoder.feed(event[split:]) == ["café"]
+
+
+def test_sse_decoder_skips_comments_and_other_fields():
+    decoder = SSEDecoder()
+    assert decoder.feed(b": keep-alive\r\nevent: message\r\ndata: one\r\ndata: two\r\n\r\n") == ["one\ntwo"]
+
+
+def test_sse_decoder_flushes_an_unterminated_event():
+    decoder = SSEDecoder()
+    assert decoder.feed(b"data: last") == []
+    assert decoder.flush() == ["last"]
+
+
+@pytest.fixture(scope="module")
+def stub_url():
+    server, base_url = start_stub_llm_server()
+    yield base_url
+    server.shutdown()
+
+
+class KeepAliveStubLLMHandler(StubLLMHandler):
+    # keeps the connection open after a JSON answer, so the client's pool holds on to it
+    protocol_version = "HTTP/1.1"
+
+
+def test_client_works_across_event_loops():
+    server, base_url = start_stub_llm_server(handler=KeepAliveStubLLMHandler)
+    client = AsyncLLMClient(base_url=base_url, api_key="stub", api_version=None, cache=None)
+    # each asyncio.run is a new event loop, a connection pooled on the first one dies with it
+    for question in ("one", "two", "three"):
+        assert asyncio.run(client.prompt(question)) == f"echo: {question}"
+    server.shutdown()
+
+
+def test_stream_works_across_event_loops(stub_url):
+    client = AsyncLLMClient(base_url=stub_url, api_key="stub", api_version=None, cache=None)
+
+    async def collect(question):
+        return "".join([delta async for delta in client.stream(question)])
+
+    for question in ("a b c", "d e"):
+        assert asyncio.run(collect(question)) == f"echo: {question}"
+
+
+def test_post_raises_the_last_failure_after_retries():
+    # nothing listens on port 9 of the loopback, the connection is refused
+    client = AsyncLLMClient(
+        base_url="http://127.0.0.1:9/v1", api_key="stub", api_version=None, max_retries=1, backoff_max=0, cache=None
+    )
+    with pytest.raises(LLMError, match="LLM request failed"):
+        asyncio.run(client.prompt("q"))
+
+
+class FlakyStubLLMHandler(StubLLMHandler):
+    # every other request is rate limited
+    requests = 0
+
+    def _answer(self, request):
+        cls = type(self)
+        cls.requests += 1
+        if cls.requests % 2:
+            return self._send_json(429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": "0"})
+        super()._answer(request)
+
+
+@pytest.mark.parametrize("sync", [True, False])
+def test_streams_retry_and_measure_the_same_way(sync):
+    server, base_url = start_stub_llm_server(handler=FlakyStubLLMHandler)
+    client = AsyncLLMClient(base_url=base_url, api_key="stub", api_version=None, backoff_max=0, cache=None)
+
+    async def collect():
+        return "".join([delta async for delta in client.stream("a b c")])
+
+    try:
+        text = "".join(client.stream_sync("a b c")) if sync else asyncio.run(collect())
+    finally:
+        server.shutdown()
+    assert text == "echo: a b c"
+    assert (client.latency.requests, client.latency.retries, client.latency.errors) == (1, 1, 0)
+    assert client.time_to_first_token.requests == 1
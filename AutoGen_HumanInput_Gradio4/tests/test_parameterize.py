@@ -0,0 +1,37 @@
+from decimal import Decimal
+
+from sqlalchemy import Numeric, String, Unicode
+
+from modules.parameterize import parameterize
+
+
+def test_literals_in_where_become_parameters():
+    query = parameterize("SELECT TOP 10 SiteId FROM Alarm WHERE SiteId = 42 AND Closed >= '2023-11-01' ORDER BY 1")
+    assert query.sql == "SELECT TOP 10 SiteId FROM Alarm WHERE SiteId = :p0 AND Closed >= :p1 ORDER BY 1"
+    assert query.params == {"p0": 42, "p1": "2023-11-01"}
+
+
+def test_same_literal_shares_a_parameter_and_template():
+    a = parameterize("SELECT * FROM Alarm WHERE SiteId = 1 OR ParentId = 1")
+    b = parameterize("SELECT * FROM Alarm WHERE SiteId = 2 OR ParentId = 2")
+    assert a.params == {"p0": 1}
+    assert a.template == b.template
+
+
+def test_type_lengths_stay_literals():
+    query = parameterize("SELECT * FROM Alarm WHERE CAST(Code AS VARCHAR(10)) = 'A1'")
+    assert "VARCHAR(10)" in query.sql
+
+
+def test_bind_types_follow_the_literal():
+    query = parameterize("SELECT * FROM Site WHERE Code = 'S-1' OR Name = N'Zürich' OR Rate > 1.5 OR Id = 7")
+    binds = query.clause()._bindparams
+    assert isinstance(binds["p0"].type, String) and not isinstance(binds["p0"].type, Unicode)
+    assert isinstance(binds["p1"].type, Unicode)
+    assert isinstance(binds["p2"].type, Numeric) and query.params["p2"] == Decimal("1.5")
+
+
+def test_plain_and_national_literals_do_not_share_a_parameter():
+    query = parameterize("SELECT * FROM Site WHERE Code = 'x' OR Name = N'x'")
+    assert query.params == {"p0": "x", "p1": "x"}
+    assert query.national == {"p1"}
@@ -0,0 +1,56 @@
+import pytest
+
+from modules.plan_cache import PlanCache, key_terms
+
+QUESTION = "How many alarms were closed per site last month?"
+SQL = "SELECT SiteId, COUNT(*) FROM fact.IndividualAlarmsUS GROUP BY SiteId"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PlanCache(str(tmp_path / "plans.sqlite"))
+
+
+def test_key_terms_are_literals_and_discriminating_words():
+    assert key_terms("Alarms at site s-us-0042 last month") == ["last", "month", "s-us-0042"]
+    assert key_terms("Top 5 sites in the last 2 weeks") == ["2", "5", "last", "top", "week"]
+
+
+def test_a_rewording_of_a_stored_question_is_a_hit(cache):
+    assert cache.lookup(QUESTION).decision == "miss"
+    cache.store(QUESTION, SQL, "Site 1 closed 42 alarms.")
+    decision = cache.lookup("Number of alarms closed per site last month")
+    assert decision.decision == "hit"
+    assert (decision.plan.sql, decision.plan.summary) == (SQL, "Site 1 closed 42 alarms.")
+
+
+def test_a_close_question_with_other_key_terms_is_a_miss(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.sqlite"), threshold=0.7)
+    cache.store(QUESTION, SQL)
+    decision = cache.lookup("How many alarms were closed per site this month?")
+    assert decision.decision == "miss_key_terms"
+    assert decision.plan is not None
+
+
+def test_storing_a_matching_question_again_updates_its_plan(cache):
+    cache.store(QUESTION, SQL)
+    newer = SQL + " ORDER BY SiteId"
+    assert cache.store(QUESTION, newer).decision == "updated"
+    assert cache.lookup(QUESTION).plan.sql == newer
+    assert cache.stats()["plans"] == 1
+
+
+def test_plans_without_sql_are_skipped(cache):
+    assert cache.store(QUESTION, "  ").decision == "skipped"
+    assert cache.stats()["plans"] == 0
+
+
+def test_an_invalidated_plan_is_gone_for_every_process(tmp_path):
+    path = str(tmp_path / "plans.sqlite")
+    cache, other = PlanCache(path), PlanCache(path)
+    plan = cache.store(QUESTION, SQL).plan
+    assert other.lookup(QUESTION).decision == "hit"
+    cache.invalidate(plan, QUESTION, "no such column: SiteId")
+    assert cache.lookup(QUESTION).decision == "miss"
+    assert other.lookup(QUESTION).decision == "miss"
+    assert [row[2] for row in cache.decisions(limit=2)] == ["miss", "miss"]
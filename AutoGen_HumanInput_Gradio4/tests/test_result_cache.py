@@ -0,0 +1,99 @@
+import sqlite3
+
+import pytest
+
+from modules.db import SQLManager
+from modules.result_cache import ResultCache
+
+
+class Counting:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, sql):
+        self.calls += 1
+        return f"result {self.calls}"
+
+
+def test_same_query_is_served_from_the_cache():
+    cache, execute = ResultCache(), Counting()
+    assert cache.get_or_execute("db", "SELECT * FROM dim.Site WHERE Id = 1", execute) == "result 1"
+    # normalized: case, whitespace and the trailing ';' do not matter
+    assert cache.get_or_execute("db", "select *  from dim.Site where Id = 1;", execute) == "result 1"
+    assert execute.calls == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_scopes_do_not_share_results():
+    cache, execute = ResultCache(), Counting()
+    cache.get_or_execute("db1", "SELECT 1", execute)
+    cache.get_or_execute("db2", "SELECT 1", execute)
+    assert execute.calls == 2
+
+
+@pytest.mark.parametrize("sql", ["SELECT NEWID()", "DELETE FROM dim.Site", "UPDATE dim.Site SET Name = 'x'"])
+def test_writes_and_nondeterministic_queries_are_never_cached(sql):
+    cache, execute = ResultCache(), Counting()
+    cache.get_or_execute("db", sql, execute)
+    cache.get_or_execute("db", sql, execute)
+    assert execute.calls == 2
+    assert cache.stats()["bypassed"] == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache, execute = ResultCache(max_entries=2), Counting()
+    cache.get_or_execute("db", "SELECT 1", execute)
+    cache.get_or_execute("db", "SELECT 2", execute)
+    cache.get_or_execute("db", "SELECT 1", execute)
+    cache.get_or_execute("db", "SELECT 3", execute)
+    assert cache.stats()["evictions"] == 1
+    cache.get_or_execute("db", "SELECT 1", execute)
+    assert execute.calls == 3
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "db.sqlite"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE Site (Id INTEGER PRIMARY KEY, Name TEXT)")
+    connection.executemany("INSERT INTO Site (Name) VALUES (?)", [(f"site {i}",) for i in range(20)])
+    connection.commit()
+    connection.close()
+    manager = SQLManager(result_cache=ResultCache(), output_format="auto")
+    manager.connect_with_url(f"sqlite:///{path}")
+    return manager
+
+
+@pytest.mark.parametrize("setting, value", [("token_budget", 50), ("row_limit", 5), ("parameterize", True)])
+def test_run_sql_cache_is_scoped_by_its_settings(db, setting, value):
+    sql = "SELECT Id, Name FROM Site WHERE Id > 2 LIMIT 10"
+    first = db.run_sql(sql)
+    assert db.run_sql(sql) == first
+    assert db.result_cache.stats()["hits"] == 1
+
+    setattr(db, setting, value)
+    db.run_sql(sql)
+    assert db.result_cache.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("0.1", "0.10000000000000001"),
+        ("12345678901234567.1", "12345678901234567.2"),
+        ("1", "1.0"),
+        ("100.0", "1e2"),
+    ],
+)
+def test_different_numbers_do_not_share_a_result(first, second):
+    cache, execute = ResultCache(), Counting()
+    cache.get_or_execute("db", f"SELECT * FROM fact.Alarm WHERE Value = {first}", execute)
+    cache.get_or_execute("db", f"SELECT * FROM fact.Alarm WHERE Value = {second}", execute)
+    assert execute.calls == 2
+
+
+def test_the_same_number_written_differently_shares_a_result():
+    cache, execute = ResultCache(), Counting()
+    cache.get_or_execute("db", "SELECT * FROM fact.Alarm WHERE Value = 0.10", execute)
+    cache.get_or_execute("db", "SELECT * FROM fact.Alarm WHERE Value = .1", execute)
+    assert execute.calls == 1
@@ -0,0 +1,41 @@
+import pytest
+
+from modules.cost_guard import QueryRejected
+from modules.row_limit import limit_rows
+
+
+def test_adds_top_on_sql_server():
+    assert limit_rows("SELECT * FROM dim.Site;", "mssql", 501) == "SELECT TOP 501 * FROM dim.Site"
+
+
+def test_adds_limit_on_sqlite_and_postgresql():
+    assert limit_rows("SELECT * FROM dim.Site", "sqlite", 501) == "SELECT * FROM dim.Site LIMIT 501"
+    assert limit_rows("SELECT * FROM dim.Site", "postgresql", 10) == "SELECT * FROM dim.Site LIMIT 10"
+
+
+def test_limit_goes_before_a_trailing_comment():
+    assert limit_rows("SELECT * FROM dim.Site -- all sites", "sqlite", 5) == "SELECT * FROM dim.Site LIMIT 5"
+
+
+@pytest.mark.parametrize(
+    "sql, dialect",
+    [
+        ("SELECT TOP 10 * FROM dim.Site", "mssql"),
+        ("SELECT * FROM dim.Site ORDER BY Id OFFSET 0 ROWS FETCH NEXT 10 ROWS ONLY", "mssql"),
+        ("SELECT Id FROM dim.Site UNION SELECT Id FROM dim.Region", "mssql"),
+        ("SELECT * FROM dim.Site LIMIT 10", "sqlite"),
+        ("SELECT * FROM dim.Site", "oracle"),
+    ],
+)
+def test_queries_with_a_limit_or_without_a_known_syntax_are_unchanged(sql, dialect):
+    assert limit_rows(sql, dialect, 501) == sql
+
+
+def test_no_limit_leaves_the_query_alone():
+    assert limit_rows("SELECT * FROM dim.Site", "sqlite", None) == "SELECT * FROM dim.Site"
+
+
+@pytest.mark.parametrize("sql", ["", "DROP TABLE dim.Site", "SELECT 1; SELECT 2"])
+def test_rejects_anything_but_one_select(sql):
+    with pytest.raises(QueryRejected):
+        limit_rows(sql, "sqlite", 501)
@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from modules.async_db import AsyncSQLManager
+from modules.schema_cache import SchemaCache, schema_cache
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / "db.sqlite"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE Site (Id INTEGER PRIMARY KEY, Name TEXT)")
+    connection.execute("CREATE TABLE Alarm (Id INTEGER PRIMARY KEY, SiteId INT, AlarmType TEXT)")
+    connection.commit()
+    connection.close()
+    return path
+
+
+def reflect_with(connection):
+    def reflect(metadata, tables_by_schema):
+        for schema, only in tables_by_schema.items():
+            metadata.reflect(bind=connection, schema=schema, only=only)
+
+    return reflect
+
+
+def test_only_changed_tables_are_reflected_again(path):
+    cache = SchemaCache()
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        first = cache.get(connection, ["main"], reflect_with(connection))
+        assert cache.get(connection, ["main"], reflect_with(connection)) is first
+        assert "CREATE TABLE main.Site" in first.text
+
+    with sqlite3.connect(path) as connection:
+        connection.execute("ALTER TABLE Site ADD COLUMN Region TEXT")
+    with engine.connect() as connection:
+        entry = cache.get(connection, ["main"], reflect_with(connection))
+    assert "Region TEXT" in entry.text
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3, "tables_reflected": 3, "tables_reused": 1}
+    engine.dispose()
+
+
+def test_get_unlocked_does_not_wait_for_a_reflecting_thread(path):
+    cache = SchemaCache()
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        before = cache.get(connection, ["main"], reflect_with(connection))
+    with sqlite3.connect(path) as connection:
+        connection.execute("ALTER TABLE Alarm ADD COLUMN Closed TEXT")
+
+    results = []
+
+    def lookup():
+        with engine.connect() as connection:
+            results.append(cache.get_unlocked(connection, ["main"], reflect_with(connection)))
+
+    # a sync SQLManager in the middle of reflecting holds the lock
+    with cache._reflect_lock:
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+    (after,) = results
+    assert "Closed TEXT" in after.text and "CREATE TABLE main.Site" in after.text
+    # refreshed as a copy, a caller holding the old entry keeps a consistent one
+    assert "Closed" not in before.text
+    with engine.connect() as connection:
+        assert cache.get(connection, ["main"], reflect_with(connection)) is after
+    engine.dispose()
+
+
+def test_a_refresh_never_changes_an_entry_a_caller_holds(path):
+    cache = SchemaCache()
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        before = cache.get(connection, ["main"], reflect_with(connection))
+    text, tables = before.text, dict(before.metadata.tables)
+    with sqlite3.connect(path) as connection:
+        connection.execute("ALTER TABLE Site ADD COLUMN Region TEXT")
+    with engine.connect() as connection:
+        after = cache.get(connection, ["main"], reflect_with(connection))
+    assert after is not before
+    assert (before.text, dict(before.metadata.tables)) == (text, tables)
+    assert "Region" not in before.metadata.tables["main.Site"].columns
+    assert "Region" in after.metadata.tables["main.Site"].columns
+    # the unchanged table is copied, not reflected again
+    assert cache.stats()["tables_reflected"] == 3
+    engine.dispose()
+
+
+def test_get_unlocked_keeps_an_entry_published_while_it_reflected(path):
+    cache = SchemaCache()
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as connection:
+        cache.get(connection, ["main"], reflect_with(connection))
+    with sqlite3.connect(path) as connection:
+        connection.execute("ALTER TABLE Site ADD COLUMN Region TEXT")
+
+    published = []
+
+    def reflect_while_another_caller_publishes(connection):
+        def reflect(metadata, tables_by_schema):
+            if not published:
+                # a sync request refreshes the same entry in the meantime
+                published.append(cache.get(connection, ["main"], reflect_with(connection)))
+            reflect_with(connection)(metadata, tables_by_schema)
+
+        return reflect
+
+    with engine.connect() as connection:
+        entry = cache.get_unlocked(connection, ["main"], reflect_while_another_caller_publishes(connection))
+        assert entry is published[0]
+        assert cache.get(connection, ["main"], reflect_with(connection)) is published[0]
+    engine.dispose()
+
+
+def test_async_definitions_work_across_event_loops(path):
+    manager = AsyncSQLManager(schemas=["main"])
+
+    async def definitions():
+        await manager.connect_with_url(f"sqlite:///{path}")
+        # concurrent callers wait for each other on the engine's schema lock
+        return await asyncio.gather(*(manager.get_table_definitions_for_prompt() for _ in range(3)))
+
+    for _ in range(2):
+        assert all("CREATE TABLE main.Alarm" in text for text in asyncio.run(definitions()))
+    schema_cache.invalidate(manager.engine.sync_engine)
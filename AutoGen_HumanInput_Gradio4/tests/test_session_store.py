@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+from modules.session_store import SessionStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def counting_factory():
+    built = []
+
+    def factory():
+        built.append(object())
+        return built[-1]
+
+    return factory, built
+
+
+def test_a_session_keeps_its_agents_between_turns(clock):
+    factory, built = counting_factory()
+    store = SessionStore(factory, clock=clock)
+    with store.acquire("a") as session:
+        assert session.turns == 0
+    with store.acquire("a") as session:
+        assert session.agents is built[0]
+        assert session.turns == 1
+    assert len(built) == 1
+    assert store.stats()["built"] == 1 and store.stats()["reused"] == 1
+
+
+def test_idle_sessions_are_evicted(clock):
+    factory, built = counting_factory()
+    store = SessionStore(factory, idle_seconds=60, clock=clock)
+    with store.acquire("a"):
+        pass
+    clock.now = 61
+    assert store.evict_idle() == 1
+    with store.acquire("a"):
+        pass
+    assert len(built) == 2
+
+
+def test_least_recently_used_sessions_beyond_max_sessions_are_evicted(clock):
+    factory, built = counting_factory()
+    store = SessionStore(factory, max_sessions=2, clock=clock)
+    for session_id in ("a", "b", "a", "c"):
+        clock.now += 1
+        with store.acquire(session_id):
+            pass
+    assert len(store) == 2
+    with store.acquire("a") as session:
+        assert session.agents is built[0]
+    with store.acquire("b"):
+        pass
+    assert len(built) == 4
+
+
+def test_a_session_in_use_is_not_evicted(clock):
+    factory, _ = counting_factory()
+    store = SessionStore(factory, idle_seconds=60, max_sessions=1, clock=clock)
+    with store.acquire("a"):
+        clock.now = 120
+        with store.acquire("b"):
+            assert store.evict_idle() == 0
+            assert store.stats()["in_use"] == 2
+    assert store.evict_idle() == 1
+    assert len(store) == 1
+
+
+def test_turns_of_one_session_run_one_at_a_time(clock):
+    factory, _ = counting_factory()
+    store = SessionStore(factory, clock=clock)
+    inside = threading.Event()
+    release = threading.Event()
+    second_in = threading.Event()
+
+    def first():
+        with store.acquire("a"):
+            inside.set()
+            release.wait(5)
+
+    def second():
+        with store.acquire("a"):
+            second_in.set()
+
+    threads = [threading.Thread(target=first)]
+    threads[0].start()
+    assert inside.wait(5)
+    threads.append(threading.Thread(target=second))
+    threads[1].start()
+    assert not second_in.wait(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert second_in.is_set()
+
+
+def test_discard_forgets_a_session(clock):
+    factory, built = counting_factory()
+    store = SessionStore(factory, clock=clock)
+    with store.acquire("a"):
+        pass
+    assert store.discard("a").agents is built[0]
+    assert store.discard("a") is None
+    with store.acquire("a"):
+        pass
+    assert len(built) == 2
@@ -0,0 +1,82 @@
+from modules.stall_detector import StallDetector, function_call_key, jaccard, shingles
+
+ANSWER = "Site 42 had the most alarms last month, 1200 of them, most of them door alarms."
+
+
+def message(name, content):
+    return {"role": "user", "name": name, "content": content}
+
+
+def run_sql(sql):
+    function_call = {"name": "run_sql", "arguments": sql}
+    return {"role": "assistant", "name": "Engineer", "content": None, "function_call": function_call}
+
+
+def test_near_copies_share_most_shingles():
+    assert jaccard(shingles(ANSWER), shingles(ANSWER.upper())) == 1.0
+    assert jaccard(shingles(ANSWER), shingles("Average response time per alarm type")) == 0.0
+    assert shingles("") == frozenset()
+
+
+def test_function_call_key_normalizes_the_sql():
+    assert function_call_key({"name": "run_sql", "arguments": '{"sql": "select 1;"}'}) == (
+        "run_sql",
+        '{"sql": "SELECT 1"}',
+    )
+    assert function_call_key({"name": "run_sql", "arguments": "not json "}) == ("run_sql", "not json")
+
+
+def test_repeats_get_a_correction_then_stop_the_chat():
+    detector = StallDetector(patience=2, max_corrections=1)
+    messages = [message("Admin", "Which site had the most alarms last month?"), message("Sr_Data_Analyst", ANSWER)]
+    assert detector.check(messages, max_round=20) is None
+
+    messages += [message("Product_Manager", ANSWER), message("Sr_Data_Analyst", ANSWER)]
+    correction = detector.check(messages, max_round=20)
+    assert not correction.stop
+    assert "The last 2 messages repeat" in correction.text
+
+    messages += [message("Admin", correction.text), message("Engineer", ANSWER), message("Sr_Data_Analyst", "")]
+    stop = detector.check(messages, max_round=20)
+    assert stop.stop
+    report = detector.report
+    assert (report.stalls, report.corrections, report.stopped) == (4, 1, True)
+    assert report.rounds == len(messages) + 1
+    assert report.rounds_saved == 20 - report.rounds
+    assert report.tokens_saved > 0
+
+
+def test_repeated_function_calls_are_stalls_but_new_ones_are_progress():
+    detector = StallDetector(patience=2)
+    messages = [run_sql('{"sql": "SELECT 1"}'), run_sql('{"sql": "select  1;"}')]
+    assert detector.check(messages, max_round=20) is None
+    messages += [run_sql('{"sql": "SELECT 2"}'), run_sql('{"sql": "SELECT 1"}')]
+    assert detector.check(messages, max_round=20) is None
+    messages += [run_sql('{"sql": "SELECT 2"}')]
+    assert detector.check(messages, max_round=20) is not None
+
+
+def test_function_results_and_ignored_speakers_do_not_count():
+    detector = StallDetector(patience=1)
+    messages = [
+        message("Admin", ANSWER),
+        message("Admin", ANSWER),
+        {"role": "function", "name": "run_sql", "content": "[]"},
+        {"role": "function", "name": "run_sql", "content": "[]"},
+    ]
+    assert detector.check(messages, max_round=20) is None
+    assert detector.report.stalls == 0
+
+
+def test_a_termination_message_is_never_interrupted():
+    detector = StallDetector(patience=1, is_termination_msg=lambda message: "APPROVED" in message["content"])
+    messages = [message("Product_Manager", "APPROVED"), message("Product_Manager", "APPROVED")]
+    assert detector.check(messages, max_round=20) is None
+
+
+def test_reset_starts_a_new_chat():
+    detector = StallDetector(patience=1)
+    detector.check([message("Engineer", ANSWER), message("Engineer", ANSWER)], max_round=20)
+    detector.reset()
+    assert detector.report.stalls == 0 and detector.report.corrections == 0
+    assert detector.check([message("Engineer", ANSWER)], max_round=20) is None
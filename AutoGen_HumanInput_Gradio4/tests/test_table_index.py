@@ -0,0 +1,15 @@
+from sqlalchemy import MetaData
+
+from modules.schema_cache import SchemaCacheEntry
+from modules.table_index import select_table_definitions
+from modules.tokens import count_tokens
+
+SMALL = "CREATE TABLE dim.Site (\n  Id INTEGER);"
+LARGE = "CREATE TABLE fact.Alarm (\n  " + ",\n  ".join(f"Column{i} INTEGER" for i in range(50)) + ");"
+
+
+def test_a_table_over_the_budget_is_skipped_and_smaller_ones_still_go_in():
+    entry = SchemaCacheEntry(metadata=MetaData(), definitions={"fact.Alarm": LARGE, "dim.Site": SMALL})
+    budget = count_tokens(SMALL) + 1
+    assert select_table_definitions(entry, token_budget=budget) == SMALL
+    assert select_table_definitions(entry) == LARGE + "\n\n" + SMALL
@@ -0,0 +1,67 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from modules.formats import format_rows
+from modules.team import AgentTeam, is_empty_result, is_function_error
+
+COLUMNS = ["SiteId", "Alarms"]
+
+
+@pytest.mark.parametrize("output_format", ["json", "columnar", "tuples", "csv", "markdown"])
+def test_no_rows_is_empty_in_every_format(output_format):
+    assert is_empty_result(format_rows(COLUMNS, [], output_format))
+    assert not is_empty_result(format_rows(COLUMNS, [(1, 42)], output_format))
+
+
+def test_run_sql_results_without_rows_are_empty():
+    assert is_empty_result("[]")
+    assert is_empty_result("")
+    assert is_empty_result("[]\n-- truncated after 0 rows, add filters or aggregate to see the rest")
+    assert not is_empty_result(json.dumps([{"SiteId": 1}], indent=4))
+
+
+def test_errors_are_function_errors():
+    assert is_function_error("Error: no such table: Site")
+    assert is_function_error('{"error": "not_read_only", "message": "Only SELECT statements are allowed"}')
+    assert not is_function_error("[]")
+
+
+def _team(messages):
+    agent = SimpleNamespace
+    return AgentTeam(
+        user_proxy=agent(name="Admin"),
+        data_engineer=agent(name="Engineer"),
+        sr_data_analyst=agent(name="Sr_Data_Analyst"),
+        product_manager=agent(name="Product_Manager"),
+        groupchat=SimpleNamespace(messages=messages),
+        manager=None,
+    )
+
+
+def _chat(result):
+    sql = "SELECT SiteId, COUNT(*) AS Alarms FROM fact.IndividualAlarmsUS GROUP BY SiteId"
+    return [
+        {"role": "user", "name": "Admin", "content": "Alarms per site?"},
+        {
+            "role": "assistant",
+            "name": "Engineer",
+            "content": None,
+            "function_call": {"name": "run_sql", "arguments": json.dumps({"sql": sql})},
+        },
+        {"role": "function", "name": "run_sql", "content": result},
+        {"role": "assistant", "name": "Sr_Data_Analyst", "content": "Site 1 has 42 alarms."},
+        {"role": "assistant", "name": "Product_Manager", "content": "APPROVED"},
+    ], sql
+
+
+def test_approved_plan_is_the_sql_that_returned_rows():
+    messages, sql = _chat(json.dumps([{"SiteId": 1, "Alarms": 42}]))
+    assert _team(messages).approved_plan() == (sql, "Site 1 has 42 alarms.")
+
+
+@pytest.mark.parametrize("result", ["[]", "SiteId,Alarms", "Error: no such table: fact.IndividualAlarmsUS"])
+def test_approval_of_an_empty_or_failed_result_is_no_plan(result):
+    messages, _ = _chat(result)
+    assert _team(messages).approved_plan() is None
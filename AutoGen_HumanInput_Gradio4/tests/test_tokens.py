@@ -0,0 +1,28 @@
+from modules import tokens
+
+
+class OfflineTiktoken:
+    calls = 0
+
+    @classmethod
+    def encoding_for_model(cls, model):
+        cls.calls += 1
+        raise ConnectionError("no route to openaipublic.blob.core.windows.net")
+
+    get_encoding = encoding_for_model
+
+
+def test_count_tokens_estimates_when_the_encoding_cannot_load(monkeypatch):
+    monkeypatch.setattr(tokens, "tiktoken", OfflineTiktoken)
+    tokens._encoding.cache_clear()
+    try:
+        assert tokens.count_tokens("x" * 40, model="offline-model") == 10
+        assert tokens.count_tokens("x" * 8, model="offline-model") == 2
+        # the failed load is not retried for every call
+        assert OfflineTiktoken.calls == 1
+    finally:
+        tokens._encoding.cache_clear()
+
+
+def test_count_tokens_of_nothing():
+    assert tokens.count_tokens("") == 0